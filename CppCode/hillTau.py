@@ -28,6 +28,7 @@ import sys
 import json
 import re
 import argparse
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import ht
@@ -129,205 +130,16 @@ def scaleDict( jsonDict, qs ):
                 if kmod:
                     scaleConst( reac, "Kmod", qs, consts, constDone )
 
-def extractSubs( expr, consts ):
-    # This function extracts the molecule names from a math expression.
-    isInMol = 0
-    mathFns = ["exp", "log", "ln", "log10", "abs", "sin", "cos", "tan", "sinh", "cosh", "tanh", "sqrt", "pow"]
-    molname = ""
-    lastch = ''
-    mols = []
-    for ch in expr:
-        if isInMol:
-            if ch.isalnum() or ch == '_':
-                molname += ch
-                continue
-            else:
-                isInMol = 0
-                if not molname in mathFns:
-                    mols.append( molname )
-        else:
-            if ch in "eE" and (lastch.isdigit() or lastch == '.'):
-                # This is the e in sci notation
-                lastch = ch
-                continue
-            if ch.isalpha():
-                molname = ch
-                isInMol = 1
-            else:
-                lastch = ch
-    if isInMol:
-        mols.append( molname )
-    s = []
-    c = []
-    for key in mols:
-        if key in consts:
-            c.append( key )
-        else:
-            s.append( key )
-    return s, c
-
-def convConst( consts, value ):
-    if isinstance( value, str ):
-        ret  = consts.get( value )
-        if ret:
-            return ret
-        else:
-            raise( ValueError( "Error: Const '{}' not found.".format( value ) ) )
-
-    return value
-
 def parseModel( jsonDict ):
-    model = ht.Model()
-    consts = jsonDict.get( "Constants" )
-    if not consts:
-        consts = {}
-    model.namedConsts = consts
-    eqnSubs = {}
-    # First, pull together all the species names. They crop up in
-    # the Species, the Reacs, and the Eqns. They should be used as
-    # an index to the conc and concInit vector.
-    # Note that we have an ordering to decide which mol goes in which group:
-    # Species; names of reacs, First term of Eqns, substrates.
+    # The whole of the model construction, including molecule discovery,
+    # constant resolution, reaction setup and sorting, is done in C++.
     # This assumes that every quantity term has already been scaled to mM.
-    for grpname, grp in jsonDict['Groups'].items():
-        model.addGrp( grpname )
-        # We may have repeats in the species names as they are used 
-        # in multiple places.
-        if "Reacs" in grp:
-            for reacname, reac in grp['Reacs'].items():
-                for subname in reac["subs"]:
-                    model.makeMol( subname, grpname )
-                    #mi[subname] = ht.MolInfo( subname, grpname, order=0)
-
-    for grpname, grp in jsonDict['Groups'].items():
-        if "Eqns" in grp:
-            for lhs, expr in grp["Eqns"].items():
-                subs, cs = extractSubs( expr, consts )
-                eqnSubs[ lhs ] = [ subs, cs ]
-                for subname in subs:
-                    model.makeMol( subname, grpname )
-
-                #model.makeEqn( lhs, grpname, expr )
-                #ei[lhs] = ht.EqnInfo( lhs, grpname, expr )
-                model.makeMol( lhs, grpname )
-                #mi[lhs] = ht.MolInfo( lhs, grpname, order=-1)
-        if "Reacs" in grp:
-            for reacname, reac in grp['Reacs'].items():
-                model.makeMol( reacname, grpname )
-
-    for grpname, grp in jsonDict['Groups'].items():
-        if "Species" in grp:
-            for molname, conc in grp['Species'].items():
-                conc = convConst( consts, conc )
-                model.makeMol( molname, grpname, concInit = conc )
-                #mi[molname] = ht.MolInfo( molname, grpname, order=0, concInit = conc )
-                grp['Species'][molname] = conc
-
-    # Then assign indices to these unique molnames, and build up the
-    # numpy arrays for concInit and conc.
-    model.allocConc();
-
-    # Now set up the reactions. we need the mols all defined first.
-    for grpname, grp in jsonDict['Groups'].items():
-        if "Reacs" in grp:
-            for reacname, reac in grp['Reacs'].items():
-                subs = reac['subs']
-                convReac = { key: convConst( consts, val ) for key,val in reac.items() }
-                # hack to interface with model::makeReac, which
-                # expects all args in reac to be floats.
-                convReac['subs'] = 0.0
-                model.makeReac( reacname, grpname, subs, convReac )
-
-    # Now set up the equation, again, we need the mols defined.
-    for grpname, grp in jsonDict['Groups'].items():
-        if "Eqns" in grp:
-            for lhs, expr in grp["Eqns"].items():
-                e = expr
-                subs = eqnSubs[ lhs ][0]
-                cs = eqnSubs[lhs][1]
-                # Replace the constant names with their values
-                for name in cs:
-                    val = consts.get( name )
-                    if val:
-                        e = e.replace( name, str( val ) )
-                    else:
-                        raise( ValueError( "Error: unknown const '{}' in equation '{    }'".format( name, expr ) ) )
-                model.makeEqn( lhs, grpname, e, subs )
-
-    model.allocConc()
-    sortReacs( model )
-    model.reinit()
-    return model
-
-def breakReacLoop( sri, model, maxOrder ):
-    for reacname, reac in sri:
-        if model.updateMolOrder( maxOrder, reacname ):
-            return
-        '''
-        if model.molInfo[reacname].order < 0:
-            model.molInfo[reacname].order = maxOrder
-            #print( " BREAK LOOP on ", reacname, " ", maxOrder)
-            #print("Warning; Reaction order loop. Breaking {} loop for {}, assigning order: {}".format( numLoopsBroken, reacname, maxOrder ) )
-            return
-        '''
-
-'''
-def breakEqnLoop( model, maxOrder, numLoopsBroken  ):
-    for eqname, eqn in model.eqnInfo.items():
-        if model.molInfo[eqname].order < 0:
-            model.molInfo[eqname].order = maxOrder
-            #print( "    FIX_Eqn ORDER = ", eqname, " ", maxOrder)
-            return
-'''
+    return ht.buildModel( jsonDict )
 
 def sortReacs( model ):
     # Go through and assign levels to the mols and reacs within a group.
     # This will be used later for deciding evaluation order.
-    maxOrder = 0
-    numLoopsBroken = 0
-    numOrdered = 0
-    numReac = len( model.reacInfo )
-    sri = sorted( model.reacInfo.items() )
-    while numOrdered < numReac: 
-        numOrdered = 0
-        stuck = True
-        #for reacname, reac in sorted( model.reacInfo.items() ):
-        for reacname, reac in sri:
-            #prevOrder = model.molInfo[reacname].order
-            prevOrder = model.getMolOrder(reacname)
-            maxOrder = max( maxOrder, prevOrder )
-            if prevOrder >= 0:
-                numOrdered += 1
-            else:
-                order = reac.getReacOrder( model )
-                # As a side effect it assigns model.molInfo[reacname].order
-                if order >= 0:
-                    maxOrder = max( maxOrder, order )
-                    numOrdered += 1
-                    stuck = False
-                '''
-                order = [ model.molInfo[i].order for i in reac.subs ]
-                if min( order ) >= 0:
-                    mo = max( order ) + 1
-                    model.molInfo[reacname].order = mo
-                    maxOrder = max( maxOrder, mo )
-                    numOrdered += 1
-                    stuck = False
-                '''
-        #print ( "numOrdered = ", numOrdered, " / ", numReac, " max = ", maxOrder )
-        if stuck:
-            breakReacLoop( sri, model, maxOrder+1 )
-            numLoopsBroken += 1
-
-    # We don't need to sort equations, because they do not cascade.
-    # They are all executed in a bunch after the reacs, at which point
-    # there should be no unknowns
-
-    maxOrder += 1
-    model.setReacSeqDepth( maxOrder )
-    for name, reac in model.reacInfo.items():
-        order = model.molInfo[name].order
-        model.assignReacSeq( name, order )
+    model.sortReacs()
 
 def writeOutput( fname, model, plotvec, x ):
     with open( fname, "w" ) as fd:
@@ -360,6 +172,8 @@ def main():
     parser.add_argument( '-s', '--stimulus', type = str, nargs = '+', action='append', help='Optional: Deliver stimulus as follows: --stimulus molecule conc [start [stop]]. Any number of stimuli may be given, each indicated by --stimulus. By default: start = 0, stop = runtime', default = [] )
     parser.add_argument( '-p', '--plots', type = str, help='Optional: plot just the specified molecule(s). The names are specified by a comma-separated list.', default = "" )
     parser.add_argument( '-o', '--output', type = str, metavar = "fname", help='Optional: Generate an output tab-separated text file with columns of time conc1 conc2 and so on.' )
+    parser.add_argument( '-m', '--multirate', action='store_true', help='Flag: Step each reac at the rate its own tau gives, rather than all of them at the rate of the fastest. Slow reacs hold their values between their steps.' )
+    parser.add_argument( '-v', '--validate', action='store_true', help='Flag: Run the model both single-rate and multirate, and report the largest difference of each molecule as a fraction of its range, and the run times. The plots show the multirate run.' )
     args = parser.parse_args()
     jsonDict = loadHillTau( args.model )
     qs = getQuantityScale( jsonDict )
@@ -400,22 +214,41 @@ def main():
     model.modifySched( saveList = [], deleteList = list( set( stimMolNames ) ) )
     
 
-    model.reinit()
-    currTime = 0.0
-    for s in stimvec:
-        model.advance( s.time - currTime )
-        model.conc[s.mol.index] = s.value
-        currTime = s.time
-    if runtime > currTime:
-        model.advance( runtime - currTime )
-
-    plotvec = np.transpose( np.array( model.plotvec ) )
+    def runStims():
+        model.reinit()
+        currTime = 0.0
+        for s in stimvec:
+            model.advance( s.time - currTime )
+            model.conc[s.mol.index] = s.value
+            currTime = s.time
+        if runtime > currTime:
+            model.advance( runtime - currTime )
+        return np.transpose( np.array( model.plotvec ) )
+
+    if args.validate:
+        t0 = time.time()
+        model.multirate = False
+        ref = runStims()
+        t1 = time.time()
+        model.multirate = True
+        plotvec = runStims()
+        t2 = time.time()
+        print( "Run time: single-rate = {:.4g} s, multirate = {:.4g} s".format( t1 - t0, t2 - t1 ) )
+        print( "Largest multirate difference as a fraction of range:" )
+        for name in sorted( model.molInfo ):
+            i = model.molInfo[name].index
+            rng = np.ptp( ref[i] )
+            err = np.max( np.abs( plotvec[i] - ref[i] ) )
+            print( "{:<24s}{:.3g}".format( name, err / rng if rng > 0 else err ) )
+    else:
+        model.multirate = args.multirate
+        plotvec = runStims()
     x = np.array( range( plotvec.shape[1] ) ) * model.dt
     clPlots = args.plots.split(',')
     if len( args.plots ) > 0 :
         clPlots = [ i.strip() for i in clPlots if i in model.molInfo]
     else: 
-        clPlots = [ i for i in model.molInfo ]
+        clPlots = sorted( model.molInfo )
 
     if args.output:
         writeOutput( args.output, model, plotvec, x )
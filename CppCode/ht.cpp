@@ -10,7 +10,12 @@
 #include <string>
 #include <vector>
 #include <map>
+#include <unordered_map>
+#include <memory>
+#include <algorithm>
+#include <functional>
 #include <iostream>
+#include <sstream>
 #include <cmath>
 #include <exprtk.hpp>
 #include <pybind11/stl.h>
@@ -24,6 +29,82 @@ PYBIND11_MAKE_OPAQUE(std::map<string, ReacInfo>);
 PYBIND11_MAKE_OPAQUE(std::map<string, EqnInfo>);
 
 const double INTERNAL_DT_SCALE = 0.02;
+const string EQN_CONC_NAME = "htconc"; // Name of conc vector in Eqn program
+// Field names for sensitivity params, in the order of SensField.
+const vector< string > SENS_FIELD_NAMES = { "KA", "tau", "tau2", "gain", "baseline", "Kmod", "Amod", "Nmod", "concInit" };
+const vector< string > MATH_FNS = { "exp", "log", "ln", "log10", "abs", "sin", "cos", "tan", "sinh", "cosh", "tanh", "sqrt", "pow" };
+
+////////////////////////////////////////////////////////////////////
+// Helpers for the compact binary encoding used to pickle a Model.
+////////////////////////////////////////////////////////////////////
+
+const string SERIAL_MAGIC = "HTModel";
+const unsigned int SERIAL_VERSION = 7;
+const unsigned int MAX_CYCLE_EVENTS = 16; // Longest stimulus cycle looked for
+const unsigned int NUM_INIT_PARAMS = 11; // Reac params used by reinit
+
+template< class T > void writePod( ostream& os, const T& val )
+{
+	os.write( reinterpret_cast< const char* >( &val ), sizeof( T ) );
+}
+
+template< class T > T readPod( istream& is )
+{
+	T val;
+	is.read( reinterpret_cast< char* >( &val ), sizeof( T ) );
+	if ( !is )
+		throw string( "Error: Model state is truncated" );
+	return val;
+}
+
+void writeStr( ostream& os, const string& str )
+{
+	writePod< unsigned int >( os, str.size() );
+	os.write( str.data(), str.size() );
+}
+
+string readStr( istream& is )
+{
+	string ret( readPod< unsigned int >( is ), '\0' );
+	is.read( &ret[0], ret.size() );
+	if ( !is )
+		throw string( "Error: Model state is truncated" );
+	return ret;
+}
+
+template< class T > void writeVec( ostream& os, const vector< T >& vec )
+{
+	writePod< unsigned int >( os, vec.size() );
+	os.write( reinterpret_cast< const char* >( vec.data() ), 
+					vec.size() * sizeof( T ) );
+}
+
+template< class T > vector< T > readVec( istream& is )
+{
+	vector< T > ret( readPod< unsigned int >( is ) );
+	is.read( reinterpret_cast< char* >( ret.data() ), 
+					ret.size() * sizeof( T ) );
+	if ( !is )
+		throw string( "Error: Model state is truncated" );
+	return ret;
+}
+
+void writeStrVec( ostream& os, const vector< string >& vec )
+{
+	writePod< unsigned int >( os, vec.size() );
+	for ( auto i = vec.begin(); i != vec.end(); ++i )
+		writeStr( os, *i );
+}
+
+vector< string > readStrVec( istream& is )
+{
+	vector< string > ret( readPod< unsigned int >( is ) );
+	for ( auto i = ret.begin(); i != ret.end(); ++i )
+		*i = readStr( is );
+	return ret;
+}
+
+////////////////////////////////////////////////////////////////////
 
 MolInfo::MolInfo( const std::string& name_, const std::string& grp_, double concInit_ = -1.0 ):
 	name(name_),
@@ -40,11 +121,30 @@ MolInfo::MolInfo( const std::string& name_, const std::string& grp_, double conc
 		}
 };
 
+MolInfo::MolInfo( istream& is ):
+	name( readStr( is ) ),
+	grp( readStr( is ) ),
+	order( readPod< int >( is ) ),
+	concInit( readPod< double >( is ) ),
+	index( readPod< unsigned int >( is ) ),
+	explicitConcInit( readPod< bool >( is ) )
+{;}
+
+void MolInfo::write( ostream& os ) const
+{
+	writeStr( os, name );
+	writeStr( os, grp );
+	writePod( os, order );
+	writePod( os, concInit );
+	writePod( os, index );
+	writePod( os, explicitConcInit );
+}
+
 
 ReacInfo::ReacInfo( const string& name_, const string& grp_, 
 	const vector< string >& subs_, 
 	const map< string, double>& reacObj, 
-	const map< string, MolInfo* >& molInfo ):
+	const unordered_map< string, MolInfo* >& molInfo ):
 	name(name_),
 	grp( grp_ ),
 	KA( reacObj.at("KA") ),
@@ -65,6 +165,8 @@ ReacInfo::ReacInfo( const string& name_, const string& grp_,
 	HillCoeff( 1.0 ),
 	overrideConcInit( false ),
 	subs( subs_ ),
+	id( 0 ),
+	grpId( 0 ),
 	hillIndex( 0 ),
 	reagIndex( 0 ),
 	modIndex( ~0U ),
@@ -75,8 +177,10 @@ ReacInfo::ReacInfo( const string& name_, const string& grp_,
 	if ( subs.size() == 0 ) {
 		throw "Error: Reaction " + name + " has zero reagents\n";
 	}
-	reagIndex = molInfo.at( subs[0] )->index;
-	hillIndex = molInfo.at( subs.back() )->index;
+	for ( auto s = subs.begin(); s != subs.end(); ++s )
+		subIndex.push_back( molInfo.at( *s )->index );
+	reagIndex = subIndex[0];
+	hillIndex = subIndex.back();
 	overrideConcInit = !molInfo.at( name )->explicitConcInit;
 	int numUnique = 1;
 	if ( reagIndex != hillIndex ) { // At least two subs
@@ -85,7 +189,7 @@ ReacInfo::ReacInfo( const string& name_, const string& grp_,
 		} else if ( subs.size() > 2 ) {
 			if ( subs.back() != subs[1] ) {	// A modifier too
 				numUnique = 3;
-				modIndex = molInfo.at(subs[1])->index;
+				modIndex = subIndex[1];
 			} else { // We have a reagent and multiple Hill ligands, no mod
 				numUnique = 2;
 			}
@@ -132,6 +236,71 @@ ReacInfo::ReacInfo( const string& name_, const string& grp_,
 	}
 }
 
+ReacInfo::ReacInfo( istream& is ):
+	name( readStr( is ) ),
+	grp( readStr( is ) ),
+	KA( readPod< double >( is ) ),
+	tau( readPod< double >( is ) ),
+	tau2( readPod< double >( is ) ),
+	Kmod( readPod< double >( is ) ),
+	Amod( readPod< double >( is ) ),
+	Nmod( readPod< double >( is ) ),
+	gain( readPod< double >( is ) ),
+	baseline( readPod< double >( is ) ),
+	inhibit( readPod< int >( is ) ),
+	prdIndex( readPod< int >( is ) ),
+	kh( readPod< double >( is ) ),
+	HillCoeff( readPod< double >( is ) ),
+	overrideConcInit( readPod< bool >( is ) ),
+	subs( readStrVec( is ) ),
+	id( 0 ),
+	grpId( 0 ),
+	subIndex( readVec< unsigned int >( is ) ),
+	hillIndex( readPod< unsigned int >( is ) ),
+	reagIndex( readPod< unsigned int >( is ) ),
+	modIndex( readPod< unsigned int >( is ) ),
+	oneSub( readPod< bool >( is ) )
+{;}
+
+void ReacInfo::write( ostream& os ) const
+{
+	writeStr( os, name );
+	writeStr( os, grp );
+	writePod( os, KA );
+	writePod( os, tau );
+	writePod( os, tau2 );
+	writePod( os, Kmod );
+	writePod( os, Amod );
+	writePod( os, Nmod );
+	writePod( os, gain );
+	writePod( os, baseline );
+	writePod( os, inhibit );
+	writePod( os, prdIndex );
+	writePod( os, kh );
+	writePod( os, HillCoeff );
+	writePod( os, overrideConcInit );
+	writeStrVec( os, subs );
+	writeVec( os, subIndex );
+	writePod( os, hillIndex );
+	writePod( os, reagIndex );
+	writePod( os, modIndex );
+	writePod( os, oneSub );
+}
+
+bool ReacInfo::indicesBelow( unsigned int numMols ) const
+{
+	// A prdIndex of -1 wraps to above any numMols.
+	if ( static_cast< unsigned int >( prdIndex ) >= numMols ||
+			hillIndex >= numMols || reagIndex >= numMols ||
+			( modIndex != ~0U && modIndex >= numMols ) )
+		return false;
+	for ( auto s = subIndex.begin(); s != subIndex.end(); s++ ) {
+		if ( *s >= numMols )
+			return false;
+	}
+	return true;
+}
+
 void ReacInfo::setKA( double val ) {
 	KA = val;
 	kh = pow( KA, HillCoeff);
@@ -180,101 +349,249 @@ double ReacInfo::concInf( const vector< double >& conc ) const
 	}
 }
 
+void ReacInfo::getInitParams( double* p ) const
+{
+	// The params that set this reac's concInit or its share of minTau.
+	p[0] = tau;
+	p[1] = tau2;
+	p[2] = KA;
+	p[3] = kh;
+	p[4] = Kmod;
+	p[5] = Amod;
+	p[6] = Nmod;
+	p[7] = gain;
+	p[8] = baseline;
+	p[9] = inhibit;
+	p[10] = overrideConcInit;
+}
+
+double ReacInfo::concInfSens( const vector< double >& conc, 
+		vector< pair< unsigned int, double > >& dc, double* dp ) const
+{
+	// Returns concInf, along with its partial derivatives with respect to
+	// the sub concs (as index, value pairs in dc) and to the reac 
+	// parameters (in dp, indexed by SensField).
+	dc.clear();
+	double ch = conc[ hillIndex ];
+	double h = pow( ch, HillCoeff );
+	double dh = HillCoeff * pow( ch, HillCoeff - 1.0 );
+	if ( oneSub ) {
+		dc.push_back( make_pair( hillIndex, dh / KA ) );
+		dp[ SENS_KA ] = -h / ( KA * KA );
+		return h / KA;
+	}
+
+	double mod = 1.0;
+	double dmodDc = 0.0;
+	if ( modIndex != ~0U ) {
+		double cm = conc[ modIndex ];
+		double x = pow( cm / Kmod, Nmod );
+		double den = 1.0 + Amod * x;
+		mod = ( 1.0 + x ) / den;
+		double dmodDx = ( 1.0 - Amod ) / ( den * den );
+		if ( cm > 0.0 || Nmod >= 1.0 )
+			dmodDc = dmodDx * Nmod * pow( cm / Kmod, Nmod - 1.0 ) / Kmod;
+		dp[ SENS_KMOD ] = -dmodDx * Nmod * x / Kmod;
+		dp[ SENS_AMOD ] = -( 1.0 + x ) * x / ( den * den );
+		if ( cm > 0.0 )
+			dp[ SENS_NMOD ] = dmodDx * x * log( cm / Kmod );
+	}
+
+	double q = kh * mod;
+	double d = h + q;
+	double s = conc[ reagIndex ] * gain;
+	double g, dgDh, dgDq;
+	if ( inhibit ) {
+		g = q / d;
+		dgDh = -q / ( d * d );
+		dgDq = h / ( d * d );
+	} else {
+		g = h / d;
+		dgDh = q / ( d * d );
+		dgDq = -h / ( d * d );
+	}
+	dc.push_back( make_pair( hillIndex, s * dgDh * dh ) );
+	dc.push_back( make_pair( reagIndex, gain * g ) );
+	if ( modIndex != ~0U ) {
+		dc.push_back( make_pair( modIndex, s * dgDq * kh * dmodDc ) );
+		// Chain the modifier params through mod.
+		dp[ SENS_KMOD ] *= s * dgDq * kh;
+		dp[ SENS_AMOD ] *= s * dgDq * kh;
+		dp[ SENS_NMOD ] *= s * dgDq * kh;
+	}
+	dp[ SENS_GAIN ] = conc[ reagIndex ] * g;
+	dp[ SENS_KA ] = s * dgDq * HillCoeff * pow( KA, HillCoeff - 1.0 ) * mod;
+	return s * g;
+}
+
 int ReacInfo::getReacOrder( const Model& model )
 {
 	int ret = 0;
-	for (auto s = subs.begin(); s != subs.end(); s++ ) {
-		int mo = model.molInfo.at( *s )->order;
+	for (auto s = subIndex.begin(); s != subIndex.end(); s++ ) {
+		int mo = model.getMol( *s )->order;
 		if (mo < 0)
 			return -1;
 		if ( ret < mo )
 			ret = mo;
 	}
 	ret += 1;
-	model.molInfo.at(name)->order = ret;
+	model.getMol( prdIndex )->order = ret;
 	return ret;
 }
 
 ////////////////////////////////////////////////////////////////////
 
-/*
 vector<unsigned int> EqnInfo::findMolTokens( const string& eqn )
 {
-	int isInMol = 0;
+	// Returns start and end positions of each name token in eqn.
+	// Numbers, including their exponent parts, are skipped.
 	vector< unsigned int > ret;
-
-	for ( unsigned int i = 0; i < eqn.length(); i++ ) {
-		if (!isInMol ) {
-			if (eqn[i] == 'e' || eqn[i] == 'E' ) {
-				if ( i < eqn.length() - 1 ) {
-					if ( eqn[i] == '+' || eqn[i] == '-' || isalnum(eqn[i]) )
-						continue;
-				}
-			}
-			if ( isalpha( eqn[i] ) ) {
-				isInMol = 1;
-				ret.push_back( i );
-			} else {
-				continue;
+	unsigned int i = 0;
+	unsigned int len = eqn.length();
+	while ( i < len ) {
+		if ( isdigit( eqn[i] ) || eqn[i] == '.' ) {
+			while ( i < len && ( isdigit( eqn[i] ) || eqn[i] == '.' ) )
+				i++;
+			if ( i < len && ( eqn[i] == 'e' || eqn[i] == 'E' ) ) {
+				i++;
+				if ( i < len && ( eqn[i] == '+' || eqn[i] == '-' ) )
+					i++;
+				while ( i < len && isdigit( eqn[i] ) )
+					i++;
 			}
+		} else if ( isalpha( eqn[i] ) ) {
+			ret.push_back( i );
+			while ( i < len && ( isalnum( eqn[i] ) || eqn[i] == '_' ) )
+				i++;
+			ret.push_back( i );
 		} else {
-			if ( isalnum( eqn[i] ) || eqn[i] == '_' ) {
-				continue;
-			} else {
-				ret.push_back( i );
-				isInMol = 0;
-			}
+			i++;
 		}
 	}
+	return ret;
+}
 
-	if (isInMol)
-		ret.push_back( eqn.length() );
-	if ( ret.size() % 2 != 0 )
-		throw "Error: equation token not ended? " + eqn;
-
+string EqnInfo::extractSubs( const string& eqn, 
+			const map< string, double >& consts, vector< string >& subs )
+{
+	// Fills subs with the molecule names used in eqn, and returns eqn
+	// with the named constants replaced by their values.
+	auto tokens = findMolTokens( eqn );
+	string ret;
+	unsigned int last = 0;
+	for ( auto i = tokens.begin(); i != tokens.end(); i += 2 ) {
+		string sstr = eqn.substr( *i, *(i+1) - *i );
+		ret += eqn.substr( last, *i - last );
+		auto c = consts.find( sstr );
+		if ( c != consts.end() ) {
+			ostringstream val;
+			val.precision( 17 );
+			val << c->second;
+			ret += val.str();
+		} else {
+			if ( find( MATH_FNS.begin(), MATH_FNS.end(), sstr ) == MATH_FNS.end() )
+				subs.push_back( sstr );
+			ret += sstr;
+		}
+		last = *(i+1);
+	}
+	ret += eqn.substr( last );
 	return ret;
 }
-*/
 
 EqnInfo::EqnInfo( const string& name_, const string& grp_, 
-			const string& eqnStr_, const vector< string >& eqnSubs, const map< string, MolInfo* >& molInfo,
-			vector< double >& conc ):
+			const string& eqnStr_, const vector< string >& eqnSubs, const unordered_map< string, MolInfo* >& molInfo ):
 	name(name_),
 	grp( grp_ ),
 	eqnStr( eqnStr_ ),
 	subs( eqnSubs ),
-	molIndex( 0 )
+	molIndex( 0 ),
+	id( 0 ),
+	grpId( 0 )
 {
 	for ( const auto& s: subs ) {
-		auto mi = molInfo.find( s );
-		if ( mi != molInfo.end() ) {
-			symbol_table.add_variable( s, conc[ mi->second->index ] );
-		} else {
+		if ( molInfo.find( s ) == molInfo.end() )
 			throw( "Error: Unable to find variable '" + s + "' in equation " + eqnStr );
-		}
 	}
-	/**
-	auto tokens = findMolTokens( eqnStr_ );
+	// Replace each mol name with a lookup into the conc vector, so that
+	// the compiled program does not hold references into conc.
+	auto tokens = findMolTokens( eqnStr );
+	unsigned int last = 0;
 	for ( auto i = tokens.begin(); i != tokens.end(); i += 2 ) {
-		string sstr = eqnStr_.substr( *i, *(i+1) - *i );
-		auto mi = molInfo.find( sstr );
-		if ( mi != molInfo.end() ) {
-			symbol_table.add_variable( sstr, conc[ mi->second->index ] );
-			subs.push_back( sstr );
+		string sstr = eqnStr.substr( *i, *(i+1) - *i );
+		indexedStr += eqnStr.substr( last, *i - last );
+		if ( find( subs.begin(), subs.end(), sstr ) != subs.end() ) {
+			indexedStr += EQN_CONC_NAME + "[" + 
+					to_string( molInfo.at( sstr )->index ) + "]";
+		} else {
+			indexedStr += sstr;
 		}
+		last = *(i+1);
 	}
-	*/
-	symbol_table.add_constants();
+	indexedStr += eqnStr.substr( last );
+	molIndex = molInfo.at( name )->index;
+};
+
+EqnInfo::EqnInfo( istream& is ):
+	name( readStr( is ) ),
+	grp( readStr( is ) ),
+	eqnStr( readStr( is ) ),
+	subs( readStrVec( is ) ),
+	molIndex( readPod< unsigned int >( is ) ),
+	id( 0 ),
+	grpId( 0 ),
+	indexedStr( readStr( is ) )
+{;}
+
+void EqnInfo::write( ostream& os ) const
+{
+	writeStr( os, name );
+	writeStr( os, grp );
+	writeStr( os, eqnStr );
+	writeStrVec( os, subs );
+	writePod( os, molIndex );
+	writeStr( os, indexedStr );
+}
 
+////////////////////////////////////////////////////////////////////
+
+EqnProgram::EqnProgram( const vector< const EqnInfo* >& eqns, 
+				vector< double >& conc ):
+	view( conc.data(), conc.size() )
+{
+	string prog;
+	for ( auto e = eqns.begin(); e != eqns.end(); ++e ) {
+		prog += EQN_CONC_NAME + "[" + to_string( (*e)->molIndex ) + 
+				"] := (" + (*e)->indexedStr + ");\n";
+	}
+	symbol_table.add_vector( EQN_CONC_NAME, view );
+	symbol_table.add_constants();
 	expression.register_symbol_table( symbol_table );
 	exprtk::parser< double > parser;
-	parser.compile( eqnStr, expression );
-	molIndex = molInfo.at( name )->index;
-};
+	if ( !parser.compile( prog, expression ) ) {
+		throw( "Error: Unable to compile equations: " + parser.error() );
+	}
+}
+
+void EqnProgram::eval( vector< double >& conc )
+{
+	if ( conc.data() != view.data() )
+		view.rebase( conc.data() );
+	expression.value();
+}
+
+size_t EqnProgram::size() const
+{
+	return view.size();
+}
 
 double EqnInfo::eval( vector< double >& conc ) const
 {
-	conc[molIndex] = expression.value();
+	// Evaluates just this Eqn into conc. It compiles a program on each 
+	// call, so it is for use from Python: the Model evaluates all of its 
+	// Eqns at once through its own EqnProgram.
+	EqnProgram prog( vector< const EqnInfo* >( 1, this ), conc );
+	prog.eval( conc );
 	return conc[molIndex];
 }
 
@@ -283,105 +600,239 @@ Model::Model()
 	: 
 			currentTime( 0.0 ),
 			step( 0 ),
-			dt( 1.0 )
+			dt( 1.0 ),
+			dtScale( INTERNAL_DT_SCALE ),
+			multirate( false ),
+			replaying( false ),
+			storePlots( true ),
+			numSkippedCycles( 0 ),
+			pruned( false ),
+			recording( false ),
+			tapeDt( 0.0 ),
+			tapeInternalDt( 0.0 ),
+			tapeMinTau( 0.0 ),
+			tapeNumReacs( 0 ),
+			tapeStep( 0 ),
+			numSamples( 0 ),
+			capturing( false )
 {;}
 
+void Model::sortReacs()
+{
+	// Go through and assign levels to the mols and reacs.
+	// This will be used later for deciding evaluation order.
+	// Reacs are visited in order of name.
+	vector< ReacInfo* > byName;
+	for ( auto r = reacArena.begin(); r != reacArena.end(); r++ )
+		byName.push_back( r->get() );
+	sort( byName.begin(), byName.end(), 
+		[]( const ReacInfo* a, const ReacInfo* b ) { return a->name < b->name; } );
+
+	int maxOrder = 0;
+	unsigned int numOrdered = 0;
+	unsigned int numReac = byName.size();
+	while ( numOrdered < numReac ) {
+		numOrdered = 0;
+		bool stuck = true;
+		for ( auto r = byName.begin(); r != byName.end(); r++ ) {
+			int prevOrder = molArena[ (*r)->prdIndex ]->order;
+			maxOrder = max( maxOrder, prevOrder );
+			if ( prevOrder >= 0 ) {
+				numOrdered++;
+			} else {
+				// As a side effect this assigns the order of the product mol
+				int order = (*r)->getReacOrder( *this );
+				if ( order >= 0 ) {
+					maxOrder = max( maxOrder, order );
+					numOrdered++;
+					stuck = false;
+				}
+			}
+		}
+		if ( stuck )
+			breakReacLoop( byName, maxOrder + 1 );
+	}
+
+	// We don't need to sort equations, because they do not cascade.
+	// They are all executed in a bunch after the reacs, at which point
+	// there should be no unknowns.
+	setReacSeqDepth( maxOrder + 1 );
+	for ( auto r = byName.begin(); r != byName.end(); r++ ) {
+		sortedReacInfo[ molArena[ (*r)->prdIndex ]->order ].push_back( *r );
+	}
+}
+
+void Model::breakReacLoop( const vector< ReacInfo* >& byName, int maxOrder )
+{
+	for ( auto r = byName.begin(); r != byName.end(); r++ ) {
+		MolInfo* mi = molArena[ (*r)->prdIndex ].get();
+		if ( mi->order < 0 ) {
+			mi->order = maxOrder;
+			return;
+		}
+	}
+}
+
+vector< const EqnInfo* > Model::eqnsByName() const
+{
+	vector< const EqnInfo* > ret;
+	for ( auto e = eqnArena.begin(); e != eqnArena.end(); e++ )
+		ret.push_back( e->get() );
+	sort( ret.begin(), ret.end(), 
+		[]( const EqnInfo* a, const EqnInfo* b ) { return a->name < b->name; } );
+	return ret;
+}
+
 void Model::setReacSeqDepth( int maxDepth )
 {
 	if ( maxDepth < 1 )
 		throw( "Error: maxDepth must be >= 1" );
 	sortedReacInfo.clear();
 	sortedReacInfo.resize( maxDepth );
-	sortedEqnInfo.clear();
-	for ( auto eri = eqnInfo.begin(); eri != eqnInfo.end(); eri++ ) {
-		sortedEqnInfo.push_back( eri->second );
-	}
+	sortedEqnInfo = eqnsByName();
+	eqnProgram.reset();
+	pruned = false;
+	unprunedReacInfo.clear();
+	unprunedEqnInfo.clear();
+	initConcInit.clear();
+	molComp.clear();
 }
 
 void Model::assignReacSeq( const string& name, int seq )
 {
 	auto ri = reacInfo.at( name ); // Assume it is good.
 	sortedReacInfo[seq].push_back( ri );
+	initConcInit.clear();
+	molComp.clear();
 }
 
-bool onnit( vector< const ReacInfo* >::const_iterator ri, const vector< string >& saveList )
+void Model::markSched( const vector< string >& names, 
+				vector< bool >& reacs, vector< bool >& eqns ) const
 {
-	for ( auto f = saveList.begin(); f != saveList.end(); f++ ) {
-		if ( *f == (*ri)->name || *f == (*ri)->grp )
-			return true;
+	// Flags, by id, each reac and eqn that is named in the list either 
+	// directly or through its group.
+	reacs.assign( reacArena.size(), false );
+	eqns.assign( eqnArena.size(), false );
+	vector< bool > grps( grpIds.size(), false );
+	for ( auto f = names.begin(); f != names.end(); f++ ) {
+		auto ri = reacInfo.find( *f );
+		if ( ri != reacInfo.end() )
+			reacs[ ri->second->id ] = true;
+		auto ei = eqnInfo.find( *f );
+		if ( ei != eqnInfo.end() )
+			eqns[ ei->second->id ] = true;
+		auto gi = grpIds.find( *f );
+		if ( gi != grpIds.end() )
+			grps[ gi->second ] = true;
 	}
-	return false;
+	for ( unsigned int i = 0; i < reacs.size(); i++ )
+		reacs[i] = reacs[i] || grps[ reacArena[i]->grpId ];
+	for ( unsigned int i = 0; i < eqns.size(); i++ )
+		eqns[i] = eqns[i] || grps[ eqnArena[i]->grpId ];
 }
 
-bool eonnit( const EqnInfo* eri, const vector< string >& saveList )
+void Model::modifySched( const vector< string >& saveList, const vector< string >& deleteList )
 {
-	for ( auto f = saveList.begin(); f != saveList.end(); f++ ) {
-		if ( *f == eri->name || *f == eri->grp ) {
-			return true;
+	// If both lists are empty, just retain original sortedReacInfo.
+	if ( saveList.size() == 0 && deleteList.size() == 0 ) {
+		eqnProgram.reset();
+		return;
+	}
+	initConcInit.clear();
+	molComp.clear();
+	bool useSave = ( saveList.size() > 0 );
+	vector< bool > saveReac, saveEqn, delReac, delEqn;
+	if ( useSave )
+		markSched( saveList, saveReac, saveEqn );
+	markSched( deleteList, delReac, delEqn );
+
+	vector< vector< const ReacInfo* > > newsri;
+	for ( auto sri = sortedReacInfo.begin(); sri != sortedReacInfo.end(); sri++ ) {
+		vector< const ReacInfo* > seq;
+		for( auto ri = sri->begin(); ri != sri->end(); ri++ ) {
+			unsigned int id = (*ri)->id;
+			if ( ( !useSave || saveReac[id] ) && !delReac[id] )
+				seq.push_back( *ri );
 		}
+		if ( seq.size() > 0 )
+			newsri.push_back( seq );
 	}
-	return false;
+	sortedReacInfo = newsri;
+	sortedEqnInfo.clear();
+	vector< const EqnInfo* > eqns = eqnsByName();
+	for ( auto e = eqns.begin(); e != eqns.end(); e++ ) {
+		unsigned int id = (*e)->id;
+		if ( ( !useSave || saveEqn[id] ) && !delEqn[id] )
+			sortedEqnInfo.push_back( *e );
+	}
+	eqnProgram.reset();
 }
 
-
-void Model::modifySched( const vector< string >& saveList, const vector< string >& deleteList )
+void Model::pruneTo( const vector< string >& outputs )
 {
-	unsigned int numSeq = sortedReacInfo.size();
-	vector< vector< const ReacInfo* > > newsri(numSeq);
-	if ( saveList.size() > 0 ) {
-		for (unsigned int seq = 0; seq < numSeq; seq++ ) {
-			auto sri = &(sortedReacInfo[seq] );
-			for( auto ri = sri->begin(); ri != sri->end(); ri++ ) {
-				if ( deleteList.size() > 0 ) {
-					if ( onnit( ri, saveList ) && !onnit( ri, deleteList ) )
-						newsri[seq].push_back( *ri );
-				} else {
-					if ( onnit( ri, saveList ) )
-						newsri[seq].push_back( *ri );
-				}
-			}
-		}
-        sortedReacInfo.clear();
-		for (auto sri = newsri.begin(); sri != newsri.end(); sri++ ) {
-            if ( sri->size() > 0 ) {
-                sortedReacInfo.push_back( *sri );
-			}
-        }
-		sortedEqnInfo.clear();
-		for ( auto eri = eqnInfo.begin(); eri != eqnInfo.end(); eri++ ) {
-			if ( deleteList.size() > 0 ) {
-				if ( eonnit( eri->second, saveList ) && !eonnit( eri->second, deleteList ) ) {
-					sortedEqnInfo.push_back( eri->second );
-				}
-			} else {
-				if ( eonnit( eri->second, saveList ) ) {
-					sortedEqnInfo.push_back( eri->second );
-				}
-			}
-		}
-	} else if ( deleteList.size() > 0 ) {
-		for (unsigned int seq = 0; seq < numSeq; seq++ ) {
-			auto sri = &(sortedReacInfo[seq] );
-			for( auto ri = sri->begin(); ri != sri->end(); ri++ ) {
-				if ( !onnit( ri, deleteList ) ) {
-					newsri[seq].push_back( *ri );
-				}
-			}
-		}
-        sortedReacInfo.clear();
-		for (auto sri = newsri.begin(); sri != newsri.end(); sri++ ) {
-            if ( sri->size() > 0 ) {
-                sortedReacInfo.push_back( *sri );
-			}
-        }
-		sortedEqnInfo.clear();
-		for ( auto eri = eqnInfo.begin(); eri != eqnInfo.end(); eri++ ) {
-			if ( !eonnit( eri->second, deleteList ) ) {
-					sortedEqnInfo.push_back( eri->second );
+	// Schedules only the reacs and eqns upstream of the outputs, through
+	// their subs, so that runs cost only as much as the part of the 
+	// model that they watch. The others hold their concs. Each call 
+	// starts from the schedule before the first one, and an empty list
+	// goes back to it.
+	if ( !pruned ) {
+		unprunedReacInfo = sortedReacInfo;
+		unprunedEqnInfo = sortedEqnInfo;
+	}
+	vector< bool > needed( molArena.size(), false );
+	vector< unsigned int > frontier;
+	for ( auto o = outputs.begin(); o != outputs.end(); o++ ) {
+		auto mi = molInfo.find( *o );
+		if ( mi == molInfo.end() )
+			throw string( "Error: Unknown output '" + *o + "' to prune to" );
+		needed[ mi->second->index ] = true;
+		frontier.push_back( mi->second->index );
+	}
+	vector< const ReacInfo* > reacOf( molArena.size(), 0 );
+	vector< const EqnInfo* > eqnOf( molArena.size(), 0 );
+	for ( auto sri = unprunedReacInfo.begin(); sri != unprunedReacInfo.end(); sri++ )
+		for ( auto ri = sri->begin(); ri != sri->end(); ri++ )
+			reacOf[ (*ri)->prdIndex ] = *ri;
+	for ( auto e = unprunedEqnInfo.begin(); e != unprunedEqnInfo.end(); e++ )
+		eqnOf[ (*e)->molIndex ] = *e;
+	while ( frontier.size() > 0 ) {
+		unsigned int i = frontier.back();
+		frontier.pop_back();
+		vector< unsigned int > subs;
+		if ( reacOf[i] )
+			subs = reacOf[i]->subIndex;
+		if ( eqnOf[i] )
+			for ( auto s = eqnOf[i]->subs.begin(); s != eqnOf[i]->subs.end(); s++ )
+				subs.push_back( molInfo.at( *s )->index );
+		for ( auto s = subs.begin(); s != subs.end(); s++ ) {
+			if ( !needed[ *s ] ) {
+				needed[ *s ] = true;
+				frontier.push_back( *s );
 			}
 		}
 	}
-	// If both lists are empty, just retain original sortedReacInfo.
+
+	pruned = ( outputs.size() > 0 );
+	sortedReacInfo.clear();
+	sortedEqnInfo.clear();
+	for ( auto sri = unprunedReacInfo.begin(); sri != unprunedReacInfo.end(); sri++ ) {
+		vector< const ReacInfo* > seq;
+		for ( auto ri = sri->begin(); ri != sri->end(); ri++ )
+			if ( !pruned || needed[ (*ri)->prdIndex ] )
+				seq.push_back( *ri );
+		if ( seq.size() > 0 || !pruned )
+			sortedReacInfo.push_back( seq );
+	}
+	for ( auto e = unprunedEqnInfo.begin(); e != unprunedEqnInfo.end(); e++ )
+		if ( !pruned || needed[ (*e)->molIndex ] )
+			sortedEqnInfo.push_back( *e );
+	if ( !pruned ) {
+		unprunedReacInfo.clear();
+		unprunedEqnInfo.clear();
+	}
+	eqnProgram.reset();
+	initConcInit.clear();
+	molComp.clear();
 }
 
 void Model::advance( double runtime, int settle )
@@ -390,6 +841,8 @@ void Model::advance( double runtime, int settle )
 	if (settle) {
 		double newdt = runtime / 10.0;
 		innerAdvance( runtime, newdt );
+	} else if ( groupDt.size() > 1 && reacGroup.size() == reacArena.size() ) {
+		advanceGroups( runtime );
 	} else {
 		double newdt = min( dt, internalDt);
 		double adv = max( minTau * 10.0, dt );
@@ -406,23 +859,115 @@ void Model::advance( double runtime, int settle )
 	}
 }
 
-void Model::innerAdvance( double runtime, double newdt )
+void Model::advanceGroups( double runtime )
 {
-	for (double t = 0.0; t < runtime; t += newdt ) {
-		if ( newdt > (runtime - t) )
-			newdt = runtime - t;
+	// Each group of reacs takes the steps that advance would give it on
+	// its own: steps from its own minTau at first, and then steps of dt.
+	// The step taken is the earliest one due among the groups, and the 
+	// others hold. All of them catch up for each sample and at the end.
+	unsigned int n = groupDt.size();
+	vector< double > h( n ), adv( n ), last( n, 0.0 ), next( n );
+	auto nextStep = [&]( unsigned int c, double t ) {
+		double end = t + ( t < adv[c] ? h[c] : dt );
+		if ( t < adv[c] && end > adv[c] )
+			end = adv[c];
+		return min( end, runtime );
+	};
+	for ( unsigned int c = 0; c < n; c++ ) {
+		h[c] = min( dt, groupDt[c] );
+		adv[c] = max( groupMinTau[c] * 10.0, dt );
+		if ( h[c] >= runtime / 2.0 ) {
+			h[c] = pow( 10.0, floor( log10( runtime / 2.0 ) ) );
+			adv[c] = runtime;
+		} else if ( 2.0 * adv[c] >= runtime ) {
+			adv[c] = runtime;
+		}
+		next[c] = nextStep( c, 0.0 );
+	}
+	groupElapsed.resize( n );
+	double t = 0.0;
+	while ( t < runtime ) {
+		double tNext = *min_element( next.begin(), next.end() );
+		bool doSample = ( floor( (currentTime + tNext ) / dt + 1.0e-9 ) > step );
+		for ( unsigned int c = 0; c < n; c++ ) {
+			if ( doSample || tNext >= runtime || next[c] <= tNext + 1.0e-9 * dt ) {
+				groupElapsed[c] = tNext - last[c];
+				last[c] = tNext;
+				next[c] = nextStep( c, tNext );
+			} else {
+				groupElapsed[c] = 0.0;
+			}
+		}
+		stepReacs();
+		evalEqns();
+		if ( doSample ) {
+			sample();
+			step += 1;
+		}
+		t = tNext;
+	}
+	currentTime += runtime;
+}
+
+void Model::stepReacs()
+{
+	// Advances each reac by the time that its group is due to advance,
+	// in groupElapsed. Reacs of groups that are not due this step hold 
+	// their concs.
+	bool byGroup = ( reacGroup.size() == reacArena.size() );
+	bool doSens = ( sensParams.size() > 0 );
+	if ( replaying && tapeStep < tape.size() && !doSens ) {
+		// Clean reacs take their products from the tape, at the same
+		// point in the schedule as they were computed.
+		const vector< double >& tv = tape[ tapeStep++ ];
+		unsigned int k = 0;
 		for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); 
 						r++) {
-			for (auto ri = r->begin(); ri != r->end(); ri++ ) {
-				(*ri)->eval( this, newdt );
+			for (auto ri = r->begin(); ri != r->end(); ri++, k++ ) {
+				double h = groupElapsed[ byGroup ? reacGroup[ (*ri)->id ] : 0 ];
+				if ( !replayDirty[ (*ri)->id ] )
+					conc[ (*ri)->prdIndex ] = tv[k];
+				else if ( h > 0.0 )
+					(*ri)->eval( this, h );
 			}
 		}
-		for (auto e = sortedEqnInfo.begin(); e != sortedEqnInfo.end(); ++e ) {
-			(*e)->eval( conc );
+	} else {
+		vector< double >* rec = 0;
+		if ( recording && !replaying ) {
+			tape.push_back( vector< double >() );
+			rec = &tape.back();
+			rec->reserve( tapeNumReacs );
 		}
+		for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); 
+						r++) {
+			for (auto ri = r->begin(); ri != r->end(); ri++ ) {
+				double h = groupElapsed[ byGroup ? reacGroup[ (*ri)->id ] : 0 ];
+				double v = conc[ (*ri)->prdIndex ];
+				if ( h > 0.0 ) {
+					if ( doSens )
+						reacSens( **ri, conc, h );
+					v = (*ri)->eval( this, h );
+				}
+				if ( rec )
+					rec->push_back( v );
+			}
+		}
+	}
+}
 
-		if ( floor( (currentTime + t + newdt ) / dt ) > step ) {
-			plotvec.push_back( conc );
+void Model::innerAdvance( double runtime, double newdt )
+{
+	for (double t = 0.0; t < runtime; t += newdt ) {
+		if ( newdt > (runtime - t) )
+			newdt = runtime - t;
+		groupElapsed.assign( max( groupDt.size(), size_t( 1 ) ), newdt );
+		stepReacs();
+		evalEqns();
+
+		// The tolerance keeps the samples on the dt grid, as the summed
+		// internal steps can fall just short of it.
+		if ( floor( (currentTime + t + newdt ) / dt + 1.0e-9 ) > step ) {
+			sample();
 			step += 1;
 		}
 	}
@@ -436,6 +981,21 @@ void Model::allocConc()
 		concInit[ m->second->index ] = m->second->concInit;
 	}
 	conc = concInit;
+	eqnProgram.reset();
+}
+
+void Model::parseEqns()
+{
+	eqnProgram.reset( new EqnProgram( sortedEqnInfo, conc ) );
+}
+
+void Model::evalEqns()
+{
+	if ( sortedEqnInfo.size() == 0 )
+		return;
+	if ( !eqnProgram || eqnProgram->size() != conc.size() )
+		parseEqns();
+	eqnProgram->eval( conc );
 }
 
 double neatRound( double x )
@@ -450,60 +1010,687 @@ double neatRound( double x )
 	return y;
 }
 
-void Model::reinit()
+void Model::reinit( bool full )
 {
 	// Logic: Any explicitly defined initialization value is to be used
 	// as is. This is happens if ReacInfo::overrideConcInit is false.
 	// Any others need to be estimated from the steady-state 
-	// value of the reacns.
+	// value of the reacns. Unless full is set, this is only done for
+	// the reacns that depend on a change since the last reinit.
 	currentTime = 0.0;
 	step = 0;
-	internalDt = dt;
-	minTau = 1e20; // dt should be < 0.25x smallest tau at input.
-	for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++) {
-		for (auto ri = r->begin(); ri != r->end(); ri++) {
-			minTau = min( min( minTau, (*ri)->tau ), (*ri)->tau2 );
-			if ( (*ri)->overrideConcInit ) {
-				unsigned int j = (*ri)->prdIndex;
-				if ((*ri)->inhibit ) {
-					concInit[j] = (*ri)->concInf( concInit ) + (*ri)->baseline;
-					if ( concInit[j] < 0.0 )
-						concInit[j] = 0.0;
-				} else {
-					concInit[j] = (*ri)->baseline;
+	bool doSens = ( sensParams.size() > 0 );
+	if ( doSens )
+		initSens();
+	if ( full || doSens || initConcInit.size() != concInit.size() ||
+			initParams.size() != NUM_INIT_PARAMS * reacArena.size() ) {
+		setTimesteps();
+		for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++) {
+			for (auto ri = r->begin(); ri != r->end(); ri++) {
+				if ( (*ri)->overrideConcInit ) {
+					unsigned int j = (*ri)->prdIndex;
+					if ( doSens )
+						reacSens( **ri, concInit, 0.0 );
+					if ((*ri)->inhibit ) {
+						concInit[j] = (*ri)->concInf( concInit ) + (*ri)->baseline;
+						if ( concInit[j] < 0.0 )
+							concInit[j] = 0.0;
+					} else {
+						concInit[j] = (*ri)->baseline;
+					}
 				}
 			}
 		}
+		initParams.resize( NUM_INIT_PARAMS * reacArena.size() );
+		for ( unsigned int i = 0; i < reacArena.size(); i++ )
+			reacArena[i]->getInitParams( &initParams[ i * NUM_INIT_PARAMS ] );
+		initSettings = timestepSettings();
+	} else {
+		updateConcInit();
 	}
-	if ( dt > INTERNAL_DT_SCALE * minTau ) {
-		internalDt = neatRound( INTERNAL_DT_SCALE * minTau );
+	initConcInit = concInit;
+
+	// A replay needs the same schedule and timesteps as the recording.
+	unsigned int numReacs = 0;
+	for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++)
+		numReacs += r->size();
+	tapeStep = 0;
+	if ( replayDirty.size() > 0 ) {
+		replaying = ( tape.size() > 0 && tapeDt == dt && 
+			tapeInternalDt == internalDt && tapeMinTau == minTau && 
+			tapeGroupMinTau == groupMinTau && tapeNumReacs == numReacs );
+	} else {
+		replaying = false;
+		if ( recording ) {
+			tape.clear();
+			tapeDt = dt;
+			tapeInternalDt = internalDt;
+			tapeMinTau = minTau;
+			tapeGroupMinTau = groupMinTau;
+			tapeNumReacs = numReacs;
+		}
 	}
 	auto ci = concInit.begin();
 	for (auto c = conc.begin(); c < conc.end(); c++, ci++ ) {
 		*c = *ci;
 	}
 
+	if ( sortedEqnInfo.size() > 0 && !eqnProgram )
+		parseEqns();
+	startSamples();
+}
+
+void Model::restart( const vector< double >& state )
+{
+	// Like reinit, but starts from the given concs, such as a snapshot 
+	// of the model once settled, rather than from concInit. 
+	if ( state.size() != conc.size() )
+		throw string( "Error: restart needs " + to_string( conc.size() ) + " concs, got " + to_string( state.size() ) );
+	if ( sensParams.size() > 0 )
+		throw string( "Error: restart does not support sensitivities" );
+	if ( recording || replayDirty.size() > 0 )
+		throw string( "Error: restart does not support recording or replay" );
+	currentTime = 0.0;
+	step = 0;
+	setTimesteps();
+	replaying = false;
+	tapeStep = 0;
+	conc = state;
+	if ( sortedEqnInfo.size() > 0 && !eqnProgram )
+		parseEqns();
+	startSamples();
+}
+
+void Model::updateConcInit()
+{
+	// Compares the reac params and concInits with those of the last 
+	// reinit. A reac is evaluated again if its params have changed, or 
+	// the concInit of any of its subs or its prd. This goes in schedule 
+	// order, so a change to a prd passes on to the reacs downstream.
+	// The timesteps are found again if a tau or a timestep setting has
+	// changed.
+	vector< bool > changed( concInit.size() );
+	for ( unsigned int i = 0; i < concInit.size(); i++ )
+		changed[i] = ( concInit[i] != initConcInit[i] );
+	vector< double > settings = timestepSettings();
+	bool tauChanged = ( settings != initSettings );
+	initSettings = settings;
+	double p[ NUM_INIT_PARAMS ];
+	for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++) {
+		for (auto ri = r->begin(); ri != r->end(); ri++) {
+			(*ri)->getInitParams( p );
+			double* q = &initParams[ (*ri)->id * NUM_INIT_PARAMS ];
+			bool dirty = !equal( p, p + NUM_INIT_PARAMS, q );
+			if ( dirty ) {
+				tauChanged = tauChanged || p[0] != q[0] || p[1] != q[1];
+				copy( p, p + NUM_INIT_PARAMS, q );
+			}
+			unsigned int j = (*ri)->prdIndex;
+			if ( !(*ri)->overrideConcInit )
+				continue;
+			for ( auto s = (*ri)->subIndex.begin(); s != (*ri)->subIndex.end(); s++ )
+				dirty = dirty || changed[ *s ];
+			if ( !( dirty || changed[j] ) )
+				continue;
+			if ((*ri)->inhibit ) {
+				concInit[j] = (*ri)->concInf( concInit ) + (*ri)->baseline;
+				if ( concInit[j] < 0.0 )
+					concInit[j] = 0.0;
+			} else {
+				concInit[j] = (*ri)->baseline;
+			}
+			changed[j] = ( concInit[j] != initConcInit[j] );
+		}
+	}
+	setTimesteps( tauChanged );
+}
+
+vector< double > Model::timestepSettings() const
+{
+	// The fields other than the taus that the timesteps depend on.
+	return vector< double >{ dt, dtScale, multirate ? 1.0 : 0.0 };
+}
+
+void Model::setTimesteps( bool findMinTau )
+{
+	// dt should be < 0.25x smallest tau at input.
+	internalDt = dt;
+	// The groups also depend on the timestep settings with multirate.
+	if ( findMinTau || groupSettings != timestepSettings() ) {
+		if ( molComp.size() != molArena.size() )
+			findComponents();
+		assignGroups();
+		minTau = 1e20;
+		for ( auto t = groupMinTau.begin(); t != groupMinTau.end(); t++ )
+			minTau = min( minTau, *t );
+	}
+	if ( dt > dtScale * minTau ) {
+		internalDt = neatRound( dtScale * minTau );
+	}
+	groupDt.resize( groupMinTau.size() );
+	for ( unsigned int c = 0; c < groupDt.size(); c++ )
+		groupDt[c] = ( dt > dtScale * groupMinTau[c] ) ? neatRound( dtScale * groupMinTau[c] ) : dt;
+}
+
+void Model::findComponents()
+{
+	// Joins each scheduled reac and eqn with its subs, and numbers the 
+	// resulting components in schedule order. A pruned model keeps the
+	// components, and so the timesteps, of its whole schedule, so that
+	// the reacs it runs step just as they would unpruned.
+	const auto& reacSched = pruned ? unprunedReacInfo : sortedReacInfo;
+	const auto& eqnSched = pruned ? unprunedEqnInfo : sortedEqnInfo;
+	vector< unsigned int > root( molArena.size() );
+	for ( unsigned int i = 0; i < root.size(); i++ )
+		root[i] = i;
+	auto findRoot = [&]( unsigned int i ) {
+		while ( root[i] != i )
+			i = root[i] = root[ root[i] ];
+		return i;
+	};
+	for (auto r = reacSched.begin(); r != reacSched.end(); r++)
+		for (auto ri = r->begin(); ri != r->end(); ri++)
+			for ( auto s = (*ri)->subIndex.begin(); s != (*ri)->subIndex.end(); s++ )
+				root[ findRoot( *s ) ] = findRoot( (*ri)->prdIndex );
+	for ( auto e = eqnSched.begin(); e != eqnSched.end(); e++ )
+		for ( auto s = (*e)->subs.begin(); s != (*e)->subs.end(); s++ )
+			root[ findRoot( molInfo.at( *s )->index ) ] = findRoot( (*e)->molIndex );
+
+	vector< int > rootComp( molArena.size(), -1 );
+	int numComps = 0;
+	auto assign = [&]( unsigned int i ) {
+		int& c = rootComp[ findRoot( i ) ];
+		if ( c < 0 )
+			c = numComps++;
+		molComp[i] = c;
+	};
+	molComp.assign( molArena.size(), -1 );
+	for (auto r = reacSched.begin(); r != reacSched.end(); r++)
+		for (auto ri = r->begin(); ri != r->end(); ri++) {
+			assign( (*ri)->prdIndex );
+			for ( auto s = (*ri)->subIndex.begin(); s != (*ri)->subIndex.end(); s++ )
+				assign( *s );
+		}
+	for ( auto e = eqnSched.begin(); e != eqnSched.end(); e++ ) {
+		assign( (*e)->molIndex );
+		for ( auto s = (*e)->subs.begin(); s != (*e)->subs.end(); s++ )
+			assign( molInfo.at( *s )->index );
+	}
+}
+
+void Model::assignGroups()
+{
+	// Reacs step in groups, each with timesteps from its own minTau.
+	// Each component is a group, as it does not interact with the 
+	// others. With multirate, each component is split further by the 
+	// rate class of each reac, which is the internal timestep that its 
+	// own tau would give. The slower groups hold their concs while the 
+	// faster ones take their substeps. Like the components, the groups
+	// are those of the whole schedule when the model is pruned.
+	const auto& reacSched = pruned ? unprunedReacInfo : sortedReacInfo;
+	map< pair< int, double >, unsigned int > ids;
+	reacGroup.assign( reacArena.size(), 0 );
+	groupMinTau.clear();
+	groupSettings = timestepSettings();
+	for (auto r = reacSched.begin(); r != reacSched.end(); r++)
+		for (auto ri = r->begin(); ri != r->end(); ri++) {
+			double tau = min( (*ri)->tau, (*ri)->tau2 );
+			double rate = 0.0;
+			if ( multirate )
+				rate = ( dt > dtScale * tau ) ? neatRound( dtScale * tau ) : dt;
+			auto key = make_pair( molComp[ (*ri)->prdIndex ], rate );
+			auto g = ids.find( key );
+			if ( g == ids.end() ) {
+				g = ids.insert( make_pair( key, groupMinTau.size() ) ).first;
+				groupMinTau.push_back( 1e20 );
+			}
+			reacGroup[ (*ri)->id ] = g->second;
+			groupMinTau[ g->second ] = min( groupMinTau[ g->second ], tau );
+		}
+}
+
+vector< vector< string > > Model::getComponents() const
+{
+	// Names of the reacs and eqns in each weakly connected component of 
+	// the schedule, as of the last reinit.
+	if ( molComp.size() != molArena.size() )
+		throw string( "Error: getComponents needs a reinit after the schedule changes" );
+	int numComps = 0;
+	for ( auto c = molComp.begin(); c != molComp.end(); c++ )
+		numComps = max( numComps, *c + 1 );
+	vector< vector< string > > ret( numComps );
+	for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++)
+		for (auto ri = r->begin(); ri != r->end(); ri++)
+			ret[ molComp[ (*ri)->prdIndex ] ].push_back( (*ri)->name );
+	for ( auto e = sortedEqnInfo.begin(); e != sortedEqnInfo.end(); e++ )
+		ret[ molComp[ (*e)->molIndex ] ].push_back( (*e)->name );
+	// Components that were pruned away entirely are left out.
+	ret.erase( remove_if( ret.begin(), ret.end(), []( const vector< string >& c ) { return c.empty(); } ), ret.end() );
+	return ret;
+}
+
+vector< vector< string > > Model::getSCCs() const
+{
+	// Strongly connected components of the scheduled reacs and eqns, 
+	// linked from each sub to its prd. Reacs in a feedback loop share a
+	// component. The components come in order from upstream to 
+	// downstream, so they form a DAG in that order.
+	unsigned int n = molArena.size();
+	vector< vector< unsigned int > > out( n );
+	vector< const string* > owner( n, 0 );
+	for (auto r = sortedReacInfo.begin(); r != sortedReacInfo.end(); r++)
+		for (auto ri = r->begin(); ri != r->end(); ri++) {
+			owner[ (*ri)->prdIndex ] = &(*ri)->name;
+			for ( auto s = (*ri)->subIndex.begin(); s != (*ri)->subIndex.end(); s++ )
+				out[ *s ].push_back( (*ri)->prdIndex );
+		}
+	for ( auto e = sortedEqnInfo.begin(); e != sortedEqnInfo.end(); e++ ) {
+		owner[ (*e)->molIndex ] = &(*e)->name;
+		for ( auto s = (*e)->subs.begin(); s != (*e)->subs.end(); s++ )
+			out[ molInfo.at( *s )->index ].push_back( (*e)->molIndex );
+	}
+
+	// Tarjan's algorithm, which finds the components downstream first.
+	vector< int > index( n, -1 ), low( n, 0 );
+	vector< bool > onStack( n, false );
+	vector< unsigned int > stack;
+	vector< vector< string > > ret;
+	int counter = 0;
+	function< void( unsigned int ) > visit = [&]( unsigned int v ) {
+		index[v] = low[v] = counter++;
+		stack.push_back( v );
+		onStack[v] = true;
+		for ( auto w = out[v].begin(); w != out[v].end(); w++ ) {
+			if ( index[ *w ] < 0 ) {
+				visit( *w );
+				low[v] = min( low[v], low[ *w ] );
+			} else if ( onStack[ *w ] ) {
+				low[v] = min( low[v], index[ *w ] );
+			}
+		}
+		if ( low[v] == index[v] ) {
+			vector< string > scc;
+			unsigned int w;
+			do {
+				w = stack.back();
+				stack.pop_back();
+				onStack[w] = false;
+				if ( owner[w] )
+					scc.push_back( *owner[w] );
+			} while ( w != v );
+			if ( scc.size() > 0 ) {
+				sort( scc.begin(), scc.end() );
+				ret.push_back( scc );
+			}
+		}
+	};
+	for ( unsigned int v = 0; v < n; v++ )
+		if ( index[v] < 0 )
+			visit( v );
+	reverse( ret.begin(), ret.end() );
+	return ret;
+}
+
+void Model::startSamples()
+{
 	plotvec.clear();
-	plotvec.push_back( conc );
+	sensPlotvec.clear();
+	numSamples = 0;
+	scoreSq.assign( scoreRef.size(), 0.0 );
+	sample();
+}
+
+void Model::sample()
+{
+	// Takes the outputs for a plot time.
+	if ( storePlots )
+		plotvec.push_back( conc );
+	if ( capturing )
+		cycleBuf.push_back( conc );
+	if ( sensParams.size() > 0 )
+		recordSens();
+	for ( unsigned int i = 0; i < scoreRef.size(); i++ ) {
+		if ( numSamples < scoreRef[i].size() ) {
+			double d = ( conc[ scoreIndex[i] ] - scoreRef[i][ numSamples ] ) * scoreScale[i];
+			scoreSq[i] += d * d;
+		}
+	}
+	numSamples++;
+}
+
+void Model::addScoreRef( unsigned int molIndex, const vector< double >& ref, double scale )
+{
+	// Adds a reference for the conc of molIndex at each plot time. The 
+	// score accumulates ( ( conc - ref ) * scale )^2 as the run goes.
+	if ( molIndex >= molArena.size() )
+		throw string( "Error: Score reference index out of range" );
+	if ( ref.size() == 0 )
+		throw string( "Error: Score reference is empty" );
+	scoreIndex.push_back( molIndex );
+	scoreRef.push_back( ref );
+	scoreScale.push_back( scale );
+	scoreSq.push_back( 0.0 );
+}
+
+void Model::clearScoreRefs()
+{
+	scoreIndex.clear();
+	scoreRef.clear();
+	scoreScale.clear();
+	scoreSq.clear();
+}
+
+double Model::getScore() const
+{
+	// Root of the summed mean squared scaled error of each reference.
+	if ( scoreRef.size() == 0 )
+		throw string( "Error: No score references have been added" );
+	double sq = 0.0;
+	for ( unsigned int i = 0; i < scoreRef.size(); i++ ) {
+		if ( numSamples != scoreRef[i].size() )
+			throw string( "Error: Run has " + to_string( numSamples ) + 
+				" plot samples but score reference has " + 
+				to_string( scoreRef[i].size() ) );
+		sq += scoreSq[i] / scoreRef[i].size();
+	}
+	return sqrt( sq );
+}
+
+unique_ptr< Model > Model::clone() const
+{
+	// Deep copy of the model: Info objects, parameters, schedule and
+	// current state. The copy compiles its own Eqn program.
+	unique_ptr< Model > ret( new Model() );
+	for ( auto m = molArena.begin(); m != molArena.end(); m++ ) {
+		ret->molArena.push_back( unique_ptr< MolInfo >( new MolInfo( **m ) ) );
+		ret->molInfo[ (*m)->name ] = ret->molArena.back().get();
+	}
+	for ( auto r = reacArena.begin(); r != reacArena.end(); r++ ) {
+		ret->reacArena.push_back( unique_ptr< ReacInfo >( new ReacInfo( **r ) ) );
+		ret->reacInfo[ (*r)->name ] = ret->reacArena.back().get();
+	}
+	for ( auto e = eqnArena.begin(); e != eqnArena.end(); e++ ) {
+		ret->eqnArena.push_back( unique_ptr< EqnInfo >( new EqnInfo( **e ) ) );
+		ret->eqnInfo[ (*e)->name ] = ret->eqnArena.back().get();
+	}
+	ret->grpIds = grpIds;
+	ret->grpInfo = grpInfo;
+	ret->namedConsts = namedConsts;
+	ret->currentTime = currentTime;
+	ret->step = step;
+	ret->dt = dt;
+	ret->internalDt = internalDt;
+	ret->dtScale = dtScale;
+	ret->multirate = multirate;
+	ret->minTau = minTau;
+	ret->conc = conc;
+	ret->concInit = concInit;
+	ret->plotvec = plotvec;
+	ret->sensParams = sensParams;
+	ret->sensOutputs = sensOutputs;
+	ret->reacSensFields = reacSensFields;
+	ret->concInitSens = concInitSens;
+	ret->sens = sens;
+	ret->sensPlotvec = sensPlotvec;
+	ret->sensRow = sensRow;
+	ret->storePlots = storePlots;
+	ret->scoreIndex = scoreIndex;
+	ret->scoreScale = scoreScale;
+	ret->scoreRef = scoreRef;
+	ret->scoreSq = scoreSq;
+	ret->numSamples = numSamples;
+	ret->initParams = initParams;
+	ret->initConcInit = initConcInit;
+	ret->initSettings = initSettings;
+	ret->reacGroup = reacGroup;
+	ret->molComp = molComp;
+	ret->groupMinTau = groupMinTau;
+	ret->groupSettings = groupSettings;
+	ret->groupDt = groupDt;
+
+	ret->sortedReacInfo.resize( sortedReacInfo.size() );
+	for ( unsigned int seq = 0; seq < sortedReacInfo.size(); seq++ ) {
+		for ( auto ri = sortedReacInfo[seq].begin(); 
+					ri != sortedReacInfo[seq].end(); ri++ ) {
+			ret->sortedReacInfo[seq].push_back( ret->reacArena[ (*ri)->id ].get() );
+		}
+	}
+	for ( auto e = sortedEqnInfo.begin(); e != sortedEqnInfo.end(); e++ ) {
+		ret->sortedEqnInfo.push_back( ret->eqnArena[ (*e)->id ].get() );
+	}
+	ret->pruned = pruned;
+	ret->unprunedReacInfo.resize( unprunedReacInfo.size() );
+	for ( unsigned int seq = 0; seq < unprunedReacInfo.size(); seq++ ) {
+		for ( auto ri = unprunedReacInfo[seq].begin(); 
+					ri != unprunedReacInfo[seq].end(); ri++ ) {
+			ret->unprunedReacInfo[seq].push_back( ret->reacArena[ (*ri)->id ].get() );
+		}
+	}
+	for ( auto e = unprunedEqnInfo.begin(); e != unprunedEqnInfo.end(); e++ ) {
+		ret->unprunedEqnInfo.push_back( ret->eqnArena[ (*e)->id ].get() );
+	}
+	if ( ret->sortedEqnInfo.size() > 0 )
+		ret->parseEqns();
+	return ret;
+}
+
+void Model::writeSched( ostream& os, 
+		const vector< vector< const ReacInfo* > >& reacs, 
+		const vector< const EqnInfo* >& eqns )
+{
+	writePod< unsigned int >( os, reacs.size() );
+	for ( auto sri = reacs.begin(); sri != reacs.end(); sri++ ) {
+		writePod< unsigned int >( os, sri->size() );
+		for ( auto ri = sri->begin(); ri != sri->end(); ri++ )
+			writePod( os, (*ri)->id );
+	}
+	writePod< unsigned int >( os, eqns.size() );
+	for ( auto e = eqns.begin(); e != eqns.end(); e++ )
+		writePod( os, (*e)->id );
+}
+
+void Model::readSched( istream& is, vector< vector< const ReacInfo* > >& reacs,
+		vector< const EqnInfo* >& eqns ) const
+{
+	reacs.resize( readPod< unsigned int >( is ) );
+	for ( auto sri = reacs.begin(); sri != reacs.end(); sri++ ) {
+		unsigned int num = readPod< unsigned int >( is );
+		for ( unsigned int i = 0; i < num; i++ )
+			sri->push_back( reacArena.at( readPod< unsigned int >( is ) ).get() );
+	}
+	unsigned int num = readPod< unsigned int >( is );
+	for ( unsigned int i = 0; i < num; i++ )
+		eqns.push_back( eqnArena.at( readPod< unsigned int >( is ) ).get() );
+}
+
+string Model::serialize() const
+{
+	// Compact binary encoding of the whole model and its current state.
+	// Info objects are written in arena order, so the schedule can refer 
+	// to reacs and eqns by id.
+	ostringstream os;
+	os.write( SERIAL_MAGIC.data(), SERIAL_MAGIC.size() );
+	writePod( os, SERIAL_VERSION );
+
+	writePod< unsigned int >( os, molArena.size() );
+	for ( auto m = molArena.begin(); m != molArena.end(); m++ )
+		(*m)->write( os );
+	writePod< unsigned int >( os, reacArena.size() );
+	for ( auto r = reacArena.begin(); r != reacArena.end(); r++ )
+		(*r)->write( os );
+	writePod< unsigned int >( os, eqnArena.size() );
+	for ( auto e = eqnArena.begin(); e != eqnArena.end(); e++ )
+		(*e)->write( os );
+	writeStrVec( os, grpInfo );
+	writePod< unsigned int >( os, namedConsts.size() );
+	for ( auto c = namedConsts.begin(); c != namedConsts.end(); c++ ) {
+		writeStr( os, c->first );
+		writePod( os, c->second );
+	}
+
+	writeSched( os, sortedReacInfo, sortedEqnInfo );
+	writePod( os, pruned );
+	writeSched( os, unprunedReacInfo, unprunedEqnInfo );
+
+	writePod( os, currentTime );
+	writePod( os, step );
+	writePod( os, dt );
+	writePod( os, internalDt );
+	writePod( os, dtScale );
+	writePod( os, multirate );
+	writePod( os, minTau );
+	writeVec( os, conc );
+	writeVec( os, concInit );
+	writePod< unsigned int >( os, plotvec.size() );
+	for ( auto p = plotvec.begin(); p != plotvec.end(); p++ )
+		writeVec( os, *p );
+	writeStrVec( os, sensParams );
+	writeVec( os, sensOutputs );
+	writeVec( os, sens );
+	writePod< unsigned int >( os, sensPlotvec.size() );
+	for ( auto p = sensPlotvec.begin(); p != sensPlotvec.end(); p++ )
+		writeVec( os, *p );
+	writePod( os, storePlots );
+	writeVec( os, scoreIndex );
+	writeVec( os, scoreScale );
+	for ( auto p = scoreRef.begin(); p != scoreRef.end(); p++ )
+		writeVec( os, *p );
+	writeVec( os, scoreSq );
+	writePod( os, numSamples );
+	return os.str();
+}
+
+void Model::checkIndices() const
+{
+	// Checks that every index into the concs read from a state is within
+	// the mol arena, so that a damaged state cannot reach outside it.
+	unsigned int numMols = molArena.size();
+	bool ok = true;
+	for ( auto m = molArena.begin(); m != molArena.end(); m++ )
+		ok = ok && (*m)->index < numMols;
+	for ( auto r = reacArena.begin(); r != reacArena.end(); r++ )
+		ok = ok && (*r)->indicesBelow( numMols );
+	for ( auto e = eqnArena.begin(); e != eqnArena.end(); e++ )
+		ok = ok && (*e)->molIndex < numMols;
+	for ( auto s = scoreIndex.begin(); s != scoreIndex.end(); s++ )
+		ok = ok && *s < numMols;
+	if ( !ok )
+		throw string( "Error: Model state has a mol index out of range" );
+	if ( conc.size() != numMols || concInit.size() != numMols )
+		throw string( "Error: Model state has conc vectors of the wrong size" );
+	for ( auto p = plotvec.begin(); p != plotvec.end(); p++ ) {
+		if ( p->size() != numMols )
+			throw string( "Error: Model state has plot vectors of the wrong size" );
+	}
+	if ( scoreScale.size() != scoreIndex.size() || scoreSq.size() != scoreIndex.size() )
+		throw string( "Error: Model state has score vectors of the wrong size" );
+}
+
+unique_ptr< Model > Model::deserialize( const string& state )
+{
+	istringstream is( state );
+	string magic( SERIAL_MAGIC.size(), '\0' );
+	is.read( &magic[0], magic.size() );
+	if ( !is || magic != SERIAL_MAGIC )
+		throw string( "Error: Not a HillTau Model state" );
+	if ( readPod< unsigned int >( is ) != SERIAL_VERSION )
+		throw string( "Error: Unsupported HillTau Model state version" );
+
+	unique_ptr< Model > ret( new Model() );
+	unsigned int num = readPod< unsigned int >( is );
+	for ( unsigned int i = 0; i < num; i++ ) {
+		ret->molArena.push_back( unique_ptr< MolInfo >( new MolInfo( is ) ) );
+		ret->molInfo[ ret->molArena.back()->name ] = ret->molArena.back().get();
+	}
+	num = readPod< unsigned int >( is );
+	for ( unsigned int i = 0; i < num; i++ ) {
+		ReacInfo* ri = new ReacInfo( is );
+		ret->reacArena.push_back( unique_ptr< ReacInfo >( ri ) );
+		ri->id = i;
+		ri->grpId = ret->internGrp( ri->grp );
+		ret->reacInfo[ ri->name ] = ri;
+	}
+	num = readPod< unsigned int >( is );
+	for ( unsigned int i = 0; i < num; i++ ) {
+		EqnInfo* ei = new EqnInfo( is );
+		ret->eqnArena.push_back( unique_ptr< EqnInfo >( ei ) );
+		ei->id = i;
+		ei->grpId = ret->internGrp( ei->grp );
+		ret->eqnInfo[ ei->name ] = ei;
+	}
+	ret->grpInfo = readStrVec( is );
+	num = readPod< unsigned int >( is );
+	for ( unsigned int i = 0; i < num; i++ ) {
+		string name = readStr( is );
+		ret->namedConsts[ name ] = readPod< double >( is );
+	}
+
+	ret->readSched( is, ret->sortedReacInfo, ret->sortedEqnInfo );
+	ret->pruned = readPod< bool >( is );
+	ret->readSched( is, ret->unprunedReacInfo, ret->unprunedEqnInfo );
+
+	ret->currentTime = readPod< double >( is );
+	ret->step = readPod< int >( is );
+	ret->dt = readPod< double >( is );
+	ret->internalDt = readPod< double >( is );
+	ret->dtScale = readPod< double >( is );
+	ret->multirate = readPod< bool >( is );
+	ret->minTau = readPod< double >( is );
+	ret->conc = readVec< double >( is );
+	ret->concInit = readVec< double >( is );
+	ret->plotvec.resize( readPod< unsigned int >( is ) );
+	for ( auto p = ret->plotvec.begin(); p != ret->plotvec.end(); p++ )
+		*p = readVec< double >( is );
+	vector< string > params = readStrVec( is );
+	vector< unsigned int > outputs = readVec< unsigned int >( is );
+	ret->setSens( params, outputs );
+	ret->sens = readVec< double >( is );
+	ret->sensPlotvec.resize( readPod< unsigned int >( is ) );
+	for ( auto p = ret->sensPlotvec.begin(); p != ret->sensPlotvec.end(); p++ )
+		*p = readVec< double >( is );
+	ret->storePlots = readPod< bool >( is );
+	ret->scoreIndex = readVec< unsigned int >( is );
+	ret->scoreScale = readVec< double >( is );
+	ret->scoreRef.resize( ret->scoreIndex.size() );
+	for ( auto p = ret->scoreRef.begin(); p != ret->scoreRef.end(); p++ )
+		*p = readVec< double >( is );
+	ret->scoreSq = readVec< double >( is );
+	ret->numSamples = readPod< unsigned int >( is );
+	ret->checkIndices();
+	if ( ret->sortedEqnInfo.size() > 0 )
+		ret->parseEqns();
+	return ret;
 }
 
 void Model::makeReac( const string & name, const string & grp, 
 				const vector< string >& subs, 
 				const map< string, double >& reacObj )
 {
-	auto r = new ReacInfo( name, grp, subs, reacObj, molInfo );
-	reacInfo[ name ] = r;
+	ReacInfo* ri = new ReacInfo( name, grp, subs, reacObj, molInfo );
+	ri->grpId = internGrp( grp );
+	auto old = reacInfo.find( name );
+	if ( old != reacInfo.end() ) { // Redefinition replaces the old reac.
+		ri->id = old->second->id;
+		reacArena[ ri->id ].reset( ri );
+	} else {
+		ri->id = reacArena.size();
+		reacArena.push_back( unique_ptr< ReacInfo >( ri ) );
+	}
+	reacInfo[ name ] = ri;
+	MolInfo* mi = molArena[ ri->prdIndex ].get();
 	// If it is a reac, then by definition we don't yet know its order
-	molInfo[name]->order = -1;
+	mi->order = -1;
 	// Override group of product mol it is == grp of reac.
-	molInfo[name]->grp = grp;
+	mi->grp = grp;
 }
 
 void Model::makeMol( const string & name, const string & grp, double concInit = -1.0 )
 {
 	auto mi = molInfo.find( name );
 	if ( mi == molInfo.end() ) { // Make new one.
-		auto m = new MolInfo( name, grp, concInit );
+		molArena.push_back( unique_ptr< MolInfo >( 
+					new MolInfo( name, grp, concInit ) ) );
+		auto m = molArena.back().get();
 		m->index = molInfo.size();
 		molInfo[ name ] = m;
 	} else if ( concInit >= 0.0 ) {
@@ -516,12 +1703,32 @@ void Model::makeMol( const string & name, const string & grp, double concInit =
 void Model::makeEqn( const string & name, const string & grp, const string& expr, const vector< string >& eqnSubs )
 
 {
-	auto e = new EqnInfo( name, grp, expr, eqnSubs, molInfo, conc );
-	eqnInfo[ name ] = e;
-	molInfo[ name ]->order = 0; // We assume that eqns do not cascade. 
+	EqnInfo* ei = new EqnInfo( name, grp, expr, eqnSubs, molInfo );
+	ei->grpId = internGrp( grp );
+	auto old = eqnInfo.find( name );
+	if ( old != eqnInfo.end() ) { // Redefinition replaces the old eqn.
+		ei->id = old->second->id;
+		eqnArena[ ei->id ].reset( ei );
+	} else {
+		ei->id = eqnArena.size();
+		eqnArena.push_back( unique_ptr< EqnInfo >( ei ) );
+	}
+	eqnInfo[ name ] = ei;
+	MolInfo* mi = molArena[ ei->molIndex ].get();
+	mi->order = 0; // We assume that eqns do not cascade. 
 	// We evaluate all eqns after all the reacs are done, so 0 is good
 	// Override group of output mol it is == grp of reac.
-	molInfo[name]->grp = grp;
+	mi->grp = grp;
+}
+
+unsigned int Model::internGrp( const string& grp )
+{
+	auto gi = grpIds.find( grp );
+	if ( gi != grpIds.end() )
+		return gi->second;
+	unsigned int id = grpIds.size();
+	grpIds[ grp ] = id;
+	return id;
 }
 
 void Model::addGrp( const string& grpname )
@@ -544,6 +1751,420 @@ int Model::getMolOrder( const string& molName ) const
 	return molInfo.at(molName)->order;
 }
 
+MolInfo* Model::getMol( unsigned int index ) const
+{
+	return molArena[ index ].get();
+}
+
+void Model::setConc( unsigned int molIndex, double value )
+{
+	// Assigns a conc, as done for stimuli. The assigned value does not 
+	// depend on any param, so its sensitivities are cleared.
+	conc.at( molIndex ) = value;
+	unsigned int np = sensParams.size();
+	if ( np > 0 )
+		fill( sens.begin() + molIndex * np, sens.begin() + ( molIndex + 1 ) * np, 0.0 );
+}
+
+void Model::runProtocol( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, double cycleTol )
+{
+	// Delivers each stimulus in turn, advancing to its time first. Times
+	// are from the start of the call, and must be sorted.
+	// If cycleTol > 0, runs of repeated stimulus cycles are watched. Once
+	// the concs at the start of successive cycles agree within cycleTol,
+	// as a fraction, the samples of the last cycle are repeated in place
+	// of simulating further cycles.
+	if ( times.size() != molIndices.size() || times.size() != values.size() )
+		throw string( "Error: Protocol arrays differ in length" );
+	for ( unsigned int i = 0; i < times.size(); i++ ) {
+		if ( molIndices[i] >= molArena.size() )
+			throw string( "Error: Protocol mol index out of range" );
+		if ( times[i] < 0.0 || ( i > 0 && times[i] < times[i-1] ) )
+			throw string( "Error: Protocol times must be sorted and not negative" );
+	}
+	// Sensitivities and tapes need every step to be simulated.
+	bool doSkip = ( cycleTol > 0.0 && sensParams.size() == 0 && !recording && !replaying );
+	numSkippedCycles = 0;
+	capturing = false;
+	unsigned int cycStart = 0;
+	unsigned int cycK = 0;
+	vector< double > cycConc;
+	double lastt = 0.0;
+	unsigned int i = 0;
+	while ( i < times.size() ) {
+		advance( times[i] - lastt, 0 );
+		lastt = times[i];
+		if ( doSkip ) {
+			if ( capturing && i == cycStart + cycK ) {
+				capturing = false;
+				unsigned int n = cyclesToSkip( times, molIndices, values, cycStart, cycK, i, cycConc, cycleTol );
+				if ( n > 0 ) {
+					repeatCycle( n );
+					i += n * cycK;
+					currentTime += times[i] - lastt;
+					lastt = times[i];
+					numSkippedCycles += n;
+				}
+			}
+			if ( !capturing ) {
+				cycK = cyclePeriod( times, molIndices, values, i );
+				if ( cycK > 0 ) {
+					capturing = true;
+					cycStart = i;
+					cycConc = conc;
+					cycleBuf.clear();
+				}
+			}
+		}
+		setConc( molIndices[i], values[i] );
+		i++;
+	}
+	capturing = false;
+	cycleBuf.clear();
+}
+
+static bool sameStim( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, unsigned int i, unsigned int j )
+{
+	// True if events i and j deliver the same stimulus, and are followed
+	// by the same interval to the next event.
+	double di = times[i+1] - times[i];
+	double dj = times[j+1] - times[j];
+	return molIndices[i] == molIndices[j] && values[i] == values[j] && 
+		fabs( di - dj ) <= 1.0e-9 * max( di, dj );
+}
+
+unsigned int Model::cyclePeriod( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, unsigned int i ) const
+{
+	// Returns the number of events in the shortest stimulus cycle that 
+	// starts at event i and repeats at least once, or 0 if there is none.
+	for ( unsigned int k = 1; k <= MAX_CYCLE_EVENTS && i + 2 * k < times.size(); k++ ) {
+		unsigned int m = 0;
+		while ( m < k && sameStim( times, molIndices, values, i + m, i + k + m ) )
+			m++;
+		if ( m == k )
+			return k;
+	}
+	return 0;
+}
+
+unsigned int Model::cyclesToSkip( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, unsigned int cycStart, unsigned int cycK, unsigned int i, const vector< double >& cycConc, double cycleTol ) const
+{
+	// Returns the number of cycles from event i that can be filled in 
+	// from the cycle just simulated, from cycStart to i.
+	// The samples must fall at the same points in each cycle.
+	double numDt = ( times[i] - times[cycStart] ) / dt;
+	if ( numDt < 0.5 || fabs( numDt - round( numDt ) ) > 1.0e-6 * numDt || cycleBuf.size() != round( numDt ) )
+		return 0;
+	// Guard against slow drift: the change over the last cycle, carried
+	// over all the skipped ones, must stay within tolerance.
+	double maxCycles = ( times.size() - i ) / cycK;
+	for ( unsigned int j = 0; j < conc.size() && maxCycles >= 1.0; j++ ) {
+		double d = fabs( conc[j] - cycConc[j] );
+		if ( d > 0.0 )
+			maxCycles = min( maxCycles, floor( cycleTol * fabs( conc[j] ) / d ) );
+	}
+	unsigned int n = 0;
+	for ( unsigned int base = i; n < maxCycles && base + cycK < times.size(); base += cycK ) {
+		unsigned int m = 0;
+		while ( m < cycK && sameStim( times, molIndices, values, cycStart + m, base + m ) )
+			m++;
+		if ( m < cycK )
+			break;
+		n++;
+	}
+	return n;
+}
+
+void Model::repeatCycle( unsigned int n )
+{
+	// Takes the samples of the last cycle again for n more cycles. The 
+	// concs at the end are those at the start of the cycle, which have
+	// converged.
+	vector< double > saved = conc;
+	for ( unsigned int c = 0; c < n; c++ ) {
+		for ( auto v = cycleBuf.begin(); v != cycleBuf.end(); v++ ) {
+			conc = *v;
+			sample();
+		}
+	}
+	conc = saved;
+	step += n * cycleBuf.size();
+}
+
+pair< unsigned int, unsigned int > Model::lookupParam( const string& param, const string& use ) const
+{
+	// Returns the reac id and SensField of a param of the form obj.field,
+	// or the mol index and SENS_CONCINIT for a concInit.
+	size_t dot = param.rfind( '.' );
+	if ( dot == string::npos ) {
+		string u = use;
+		u[0] = toupper( u[0] );
+		throw string( "Error: " + u + " param '" + param + "' should be of the form obj.field" );
+	}
+	string obj = param.substr( 0, dot );
+	string field = param.substr( dot + 1 );
+	if ( field == "concInit" || field == "conc" ) {
+		auto mi = molInfo.find( obj );
+		if ( mi == molInfo.end() )
+			throw string( "Error: Unknown molecule in " + use + " param '" + param + "'" );
+		return make_pair( mi->second->index, static_cast< unsigned int >( SENS_CONCINIT ) );
+	}
+	auto ri = reacInfo.find( obj );
+	if ( ri == reacInfo.end() )
+		throw string( "Error: Unknown reaction in " + use + " param '" + param + "'" );
+	unsigned int f = find( SENS_FIELD_NAMES.begin(), SENS_FIELD_NAMES.end(), field ) - SENS_FIELD_NAMES.begin();
+	if ( f >= SENS_CONCINIT )
+		throw string( "Error: Unknown field in " + use + " param '" + param + "'" );
+	return make_pair( ri->second->id, f );
+}
+
+void Model::setSens( const vector< string >& params, const vector< unsigned int >& outputs )
+{
+	// Sets up the params, each of the form obj.field, and the output mols 
+	// for which to compute sensitivities. These are computed from the 
+	// next reinit. An empty params list turns them off.
+	if ( params.size() > 0 && sortedEqnInfo.size() > 0 )
+		throw string( "Error: Sensitivities are not supported for models with Eqns" );
+	vector< vector< pair< unsigned int, unsigned int > > > fields( reacArena.size() );
+	vector< pair< unsigned int, unsigned int > > concInits;
+	for ( unsigned int i = 0; i < params.size(); i++ ) {
+		auto p = lookupParam( params[i], "sensitivity" );
+		if ( p.second == SENS_CONCINIT )
+			concInits.push_back( make_pair( i, p.first ) );
+		else
+			fields[ p.first ].push_back( make_pair( i, p.second ) );
+	}
+	for ( auto o = outputs.begin(); o != outputs.end(); o++ ) {
+		if ( *o >= molArena.size() )
+			throw string( "Error: Sensitivity output index out of range" );
+	}
+	sensParams = params;
+	sensOutputs = outputs;
+	reacSensFields.swap( fields );
+	concInitSens.swap( concInits );
+	sens.clear();
+	sensPlotvec.clear();
+	if ( sensParams.size() > 0 )
+		initSens();
+}
+
+unique_ptr< ParamBinding > Model::bindParams( const vector< string >& params )
+{
+	return unique_ptr< ParamBinding >( new ParamBinding( this, params ) );
+}
+
+ParamBinding::ParamBinding( Model* model, const vector< string >& params )
+	:
+		params( params ),
+		model( model )
+{
+	for ( auto p = params.begin(); p != params.end(); p++ ) {
+		auto tf = model->lookupParam( *p, "bound" );
+		target.push_back( tf.first );
+		field.push_back( tf.second );
+		bool link = false;
+		if ( tf.second == SENS_TAU ) {
+			const ReacInfo* ri = model->reacArena[ tf.first ].get();
+			link = fabs( ri->tau - ri->tau2 ) <= 1.0e-8 + 1.0e-5 * fabs( ri->tau2 );
+		}
+		linkTau2.push_back( link );
+	}
+}
+
+void ParamBinding::setParams( const vector< double >& values )
+{
+	if ( values.size() != params.size() )
+		throw string( "Error: Expected " + to_string( params.size() ) + " param values, got " + to_string( values.size() ) );
+	for ( unsigned int i = 0; i < values.size(); i++ ) {
+		double v = values[i];
+		if ( field[i] == SENS_CONCINIT ) {
+			model->molArena[ target[i] ]->concInit = v;
+			model->concInit[ target[i] ] = v;
+			continue;
+		}
+		ReacInfo* ri = model->reacArena[ target[i] ].get();
+		switch ( field[i] ) {
+			case SENS_KA: ri->setKA( v ); break;
+			case SENS_TAU: 
+				ri->tau = v;
+				if ( linkTau2[i] )
+					ri->tau2 = v;
+				break;
+			case SENS_TAU2: ri->tau2 = v; break;
+			case SENS_GAIN: ri->gain = v; break;
+			case SENS_BASELINE: ri->baseline = v; break;
+			case SENS_KMOD: ri->Kmod = v; break;
+			case SENS_AMOD: ri->Amod = v; break;
+			case SENS_NMOD: ri->Nmod = v; break;
+		}
+	}
+}
+
+vector< double > ParamBinding::getParams() const
+{
+	vector< double > ret( params.size() );
+	for ( unsigned int i = 0; i < params.size(); i++ ) {
+		if ( field[i] == SENS_CONCINIT ) {
+			ret[i] = model->molArena[ target[i] ]->concInit;
+			continue;
+		}
+		const ReacInfo* ri = model->reacArena[ target[i] ].get();
+		switch ( field[i] ) {
+			case SENS_KA: ret[i] = ri->KA; break;
+			case SENS_TAU: ret[i] = ri->tau; break;
+			case SENS_TAU2: ret[i] = ri->tau2; break;
+			case SENS_GAIN: ret[i] = ri->gain; break;
+			case SENS_BASELINE: ret[i] = ri->baseline; break;
+			case SENS_KMOD: ret[i] = ri->Kmod; break;
+			case SENS_AMOD: ret[i] = ri->Amod; break;
+			case SENS_NMOD: ret[i] = ri->Nmod; break;
+		}
+	}
+	return ret;
+}
+
+vector< vector< double > > Model::getSensVec( unsigned int molIndex ) const
+{
+	// Returns the sensitivities of the mol at each plot time, as a 
+	// vector of d conc / d param for each time.
+	auto o = find( sensOutputs.begin(), sensOutputs.end(), molIndex );
+	if ( o == sensOutputs.end() )
+		throw string( "Error: Sensitivities were not set up for mol index " + to_string( molIndex ) );
+	unsigned int np = sensParams.size();
+	unsigned int offset = ( o - sensOutputs.begin() ) * np;
+	vector< vector< double > > ret;
+	for ( auto p = sensPlotvec.begin(); p != sensPlotvec.end(); p++ )
+		ret.push_back( vector< double >( p->begin() + offset, p->begin() + offset + np ) );
+	return ret;
+}
+
+void Model::setRecording( bool flag )
+{
+	// When set, each run from reinit records a tape for later replays.
+	recording = flag;
+	tape.clear();
+	replayDirty.clear();
+	replaying = false;
+}
+
+void Model::setReplay( const vector< string >& names )
+{
+	// Marks the reacs that may differ from the recorded run: the named
+	// reacs, those reading named mols or eqns, and all downstream of them.
+	// The next runs replay the other reacs from the tape. An empty list
+	// goes back to full runs.
+	replayDirty.clear();
+	if ( names.size() == 0 )
+		return;
+	vector< bool > dirty( reacArena.size(), false );
+	vector< bool > molDirty( molArena.size(), false );
+	for ( auto n = names.begin(); n != names.end(); n++ ) {
+		auto mi = molInfo.find( *n );
+		if ( mi == molInfo.end() )
+			throw string( "Error: Unknown object '" + *n + "' for replay" );
+		molDirty[ mi->second->index ] = true;
+	}
+	bool changed = true;
+	while ( changed ) {
+		changed = false;
+		for ( auto r = reacArena.begin(); r != reacArena.end(); r++ ) {
+			if ( dirty[ (*r)->id ] )
+				continue;
+			bool d = molDirty[ (*r)->prdIndex ];
+			for ( auto s = (*r)->subIndex.begin(); !d && s != (*r)->subIndex.end(); s++ )
+				d = molDirty[ *s ];
+			if ( d ) {
+				dirty[ (*r)->id ] = true;
+				molDirty[ (*r)->prdIndex ] = true;
+				changed = true;
+			}
+		}
+		for ( auto e = eqnArena.begin(); e != eqnArena.end(); e++ ) {
+			if ( molDirty[ (*e)->molIndex ] )
+				continue;
+			for ( auto s = (*e)->subs.begin(); s != (*e)->subs.end(); s++ ) {
+				if ( molDirty[ molInfo.at( *s )->index ] ) {
+					molDirty[ (*e)->molIndex ] = true;
+					changed = true;
+					break;
+				}
+			}
+		}
+	}
+	replayDirty.swap( dirty );
+}
+
+void Model::initSens()
+{
+	// Only the concInit params directly affect the initial concs.
+	sens.assign( molArena.size() * sensParams.size(), 0.0 );
+	sensRow.resize( sensParams.size() );
+	for ( auto c = concInitSens.begin(); c != concInitSens.end(); c++ )
+		sens[ c->second * sensParams.size() + c->first ] = 1.0;
+}
+
+void Model::recordSens()
+{
+	unsigned int np = sensParams.size();
+	vector< double > v( sensOutputs.size() * np );
+	for ( unsigned int i = 0; i < sensOutputs.size(); i++ )
+		copy( sens.begin() + sensOutputs[i] * np, 
+			sens.begin() + ( sensOutputs[i] + 1 ) * np, v.begin() + i * np );
+	sensPlotvec.push_back( v );
+}
+
+void Model::reacSens( const ReacInfo& ri, const vector< double >& c, double dt )
+{
+	// Carries d conc / d param through one update of ri, using the concs
+	// from before the update. The update is
+	//     new = e * old + ( 1 - e ) * ( concInf + baseline )
+	// with e = exp( -dt / tau ). dt == 0 is the estimate of the initial 
+	// value done in reinit.
+	unsigned int np = sensParams.size();
+	double* sp = &sens[ ri.prdIndex * np ];
+	double cinf = ri.concInf( c );
+	if ( dt == 0.0 && ri.inhibit && cinf + ri.baseline < 0.0 ) {
+		fill( sp, sp + np, 0.0 ); // Clamped to zero by reinit.
+		return;
+	}
+	double e = 0.0;
+	double dfDtau = 0.0;
+	int tauField = -1;
+	if ( dt > 0.0 ) {
+		bool up = ( cinf - ( c[ ri.prdIndex ] - ri.baseline ) >= 0.0 );
+		double tau = up ? ri.tau : ri.tau2;
+		tauField = up ? SENS_TAU : SENS_TAU2;
+		e = exp( -dt / tau );
+		dfDtau = -e * dt / ( tau * tau );
+	}
+	double f = 1.0 - e;
+	bool useConcInf = ( dt > 0.0 || ri.inhibit );
+	double dp[ NUM_SENS_FIELDS ] = { 0.0 };
+	if ( useConcInf )
+		ri.concInfSens( c, sensDc, dp );
+	else
+		sensDc.clear();	// Initial value is just the baseline.
+
+	for ( unsigned int j = 0; j < np; j++ )
+		sensRow[j] = e * sp[j];
+	for ( auto d = sensDc.begin(); d != sensDc.end(); d++ ) {
+		const double* sd = &sens[ d->first * np ];
+		double w = f * d->second;
+		for ( unsigned int j = 0; j < np; j++ )
+			sensRow[j] += w * sd[j];
+	}
+	const auto& fields = reacSensFields[ ri.id ];
+	for ( auto p = fields.begin(); p != fields.end(); p++ ) {
+		double v = f * dp[ p->second ];
+		if ( p->second == SENS_BASELINE )
+			v += f;
+		else if ( int( p->second ) == tauField )
+			v += ( cinf + ri.baseline - c[ ri.prdIndex ] ) * dfDtau;
+		sensRow[ p->first ] += v;
+	}
+	copy( sensRow.begin(), sensRow.end(), sp );
+}
+
 bool Model::updateMolOrder( int maxOrder, const string& molName ) const
 {
 	auto mi = molInfo.at( molName );
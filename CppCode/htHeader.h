@@ -8,11 +8,18 @@
 ************************************************************************/
 
 class Model;
+class ParamBinding;
+
+/// Parameters for which the Model can compute sensitivities.
+enum SensField { SENS_KA, SENS_TAU, SENS_TAU2, SENS_GAIN, SENS_BASELINE,
+		SENS_KMOD, SENS_AMOD, SENS_NMOD, SENS_CONCINIT, NUM_SENS_FIELDS };
 
 class MolInfo
 {
 	public:
 			MolInfo( const string& name, const string& grp, double concInit );
+			MolInfo( istream& is );
+			void write( ostream& os ) const;
 			string name;
 			string grp;
 			int order;
@@ -27,7 +34,9 @@ class ReacInfo
 			ReacInfo( const string& name, const string& grp, 
 			const vector< string >& subs, 
 			const map< string, double>& reacObj, 
-			const map< string, MolInfo* >& molInfo );
+			const unordered_map< string, MolInfo* >& molInfo );
+			ReacInfo( istream& is );
+			void write( ostream& os ) const;
 			string name;
 			string grp;
 			double KA;
@@ -44,12 +53,19 @@ class ReacInfo
 			double HillCoeff;
 			bool overrideConcInit;
 			vector< string > subs;
+			unsigned int id;	// Position in the Model's reac arena
+			unsigned int grpId;
+			vector< unsigned int > subIndex;	// conc index of each sub
 
 			double concInf( const vector< double >& conc ) const;
+			double concInfSens( const vector< double >& conc, 
+				vector< pair< unsigned int, double > >& dc, double* dp ) const;
 			double eval( Model* model, double dt ) const;
 			double getKA() const;
 			void setKA( double val );
+			void getInitParams( double* p ) const;
 			int getReacOrder( const Model& model );
+			bool indicesBelow( unsigned int numMols ) const;
 
 	private:
 			unsigned int hillIndex;
@@ -62,54 +78,211 @@ class ReacInfo
 class EqnInfo
 {
 	public:
-			EqnInfo( const string& name, const string& grp, const string& eqnStr, const vector< string >& eqnSubs, const map< string, MolInfo* >& molInfo, vector< double >& conc );
+			EqnInfo( const string& name, const string& grp, const string& eqnStr, const vector< string >& eqnSubs, const unordered_map< string, MolInfo* >& molInfo );
+			EqnInfo( istream& is );
+			void write( ostream& os ) const;
+			double eval( vector< double >& conc ) const;
 			string name;
 			string grp;
 			string eqnStr;
-			double eval( vector<double>& conc ) const;
 			static vector< unsigned int > findMolTokens(const string& eqn);
+			static string extractSubs( const string& eqn, const map< string, double >& consts, vector< string >& subs );
 			vector< string > subs;
-	private:
-			// Stuff for parser
 			unsigned int molIndex;
-			exprtk::symbol_table<double> symbol_table;
-			exprtk::expression<double> expression;
+			unsigned int id;	// Position in the Model's eqn arena
+			unsigned int grpId;
+			string indexedStr;	// eqnStr with mol names replaced by conc lookups
+};
+
+/**
+ * All the Eqns of a model compiled into a single exprtk program, which
+ * reads and writes the conc vector by index. The program keeps a view on
+ * the conc vector, which is rebased if the vector storage moves.
+ */
+class EqnProgram
+{
+	public:
+			EqnProgram( const vector< const EqnInfo* >& eqns, vector< double >& conc );
+			void eval( vector< double >& conc );
+			size_t size() const;
+	private:
+			EqnProgram( const EqnProgram& );
+			EqnProgram& operator=( const EqnProgram& );
+			exprtk::vector_view< double > view;
+			exprtk::symbol_table< double > symbol_table;
+			exprtk::expression< double > expression;
 };
 
 class Model
 {
 	public:
 			Model();
-			map< string, MolInfo* > molInfo;
-			map< string, ReacInfo* > reacInfo;
-			map< string, EqnInfo* > eqnInfo;
+			unordered_map< string, MolInfo* > molInfo;
+			unordered_map< string, ReacInfo* > reacInfo;
+			unordered_map< string, EqnInfo* > eqnInfo;
 			vector< string > grpInfo;
 			map< string, double > namedConsts;
 			double currentTime;
 			int step;
 			double dt;
 			double internalDt;	// Timestep to use for internal calculations for time-series. Normally 0.2 * minTau.
+			double dtScale;	// internalDt as a fraction of minTau, when dt is larger.
+			bool multirate;	// If set, each reac steps at the rate its own tau gives.
 			double minTau;	// Smallest time-constant in model.
 			vector< double > conc;
 			vector< double > concInit;
 			vector< vector< double > > plotvec;
+			bool replaying;	// Set by reinit if this run replays the tape.
+			bool storePlots;	// If false, the run does not fill plotvec.
+			unsigned int numSkippedCycles;	// By the last runProtocol.
 			
+			unique_ptr< Model > clone() const;
+			string serialize() const;
+			static unique_ptr< Model > deserialize( const string& state );
 			void makeMol( const string & name, const string & grp, double concInit );
 			void makeReac( const string & name, const string & grp, const vector< string >& subs, const map< string, double >& reacObj );
 			void makeEqn( const string & name, const string & grp, const string& expr, const vector< string >& eqnSubs );
 			void addGrp( const string& grpname );
+			void sortReacs();
 			void setReacSeqDepth( int order );
 			void assignReacSeq( const string& name, int seq );
 			void advance( double runtime, int settle );
 			void innerAdvance( double runtime, double newdt );
 			void allocConc();
 			void parseEqns();
-			void reinit();
+			void evalEqns();
+			void reinit( bool full = false );
+			void restart( const vector< double >& state );
 			vector< double > getConcVec( int index ) const;
 			void modifySched( const vector< string >& saveList, const vector< string >& deleteList );
+			void pruneTo( const vector< string >& outputs );
 			int getMolOrder( const string& molName ) const;
 			bool updateMolOrder(int maxOrder, const string& molName) const;
+			MolInfo* getMol( unsigned int index ) const;
+			void setConc( unsigned int molIndex, double value );
+			void runProtocol( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, double cycleTol );
+			void setSens( const vector< string >& params, const vector< unsigned int >& outputs );
+			unique_ptr< ParamBinding > bindParams( const vector< string >& params );
+			vector< vector< double > > getSensVec( unsigned int molIndex ) const;
+			void addScoreRef( unsigned int molIndex, const vector< double >& ref, double scale );
+			void clearScoreRefs();
+			double getScore() const;
+			void setRecording( bool flag );
+			void setReplay( const vector< string >& names );
+			vector< vector< string > > getComponents() const;
+			vector< vector< string > > getSCCs() const;
 	private:
+			friend class ParamBinding;
+			pair< unsigned int, unsigned int > lookupParam( const string& param, const string& use ) const;
+			void reacSens( const ReacInfo& ri, const vector< double >& c, double dt );
+			void initSens();
+			void recordSens();
+			void setTimesteps( bool findMinTau = true );
+			void findComponents();
+			void assignGroups();
+			void advanceGroups( double runtime );
+			void stepReacs();
+			void updateConcInit();
+			vector< double > timestepSettings() const;
+			void startSamples();
+			void sample();
+			unsigned int cyclePeriod( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, unsigned int i ) const;
+			unsigned int cyclesToSkip( const vector< double >& times, const vector< unsigned int >& molIndices, const vector< double >& values, unsigned int cycStart, unsigned int cycK, unsigned int i, const vector< double >& cycConc, double cycleTol ) const;
+			void repeatCycle( unsigned int n );
+			void breakReacLoop( const vector< ReacInfo* >& byName, int maxOrder );
+			vector< const EqnInfo* > eqnsByName() const;
+			void markSched( const vector< string >& names, vector< bool >& reacs, vector< bool >& eqns ) const;
+			unsigned int internGrp( const string& grp );
+			static void writeSched( ostream& os, const vector< vector< const ReacInfo* > >& reacs, const vector< const EqnInfo* >& eqns );
+			void readSched( istream& is, vector< vector< const ReacInfo* > >& reacs, vector< const EqnInfo* >& eqns ) const;
+			void checkIndices() const;
 			vector< vector< const ReacInfo* > > sortedReacInfo;
 			vector< const EqnInfo* > sortedEqnInfo;
+			// The schedule from before the first pruneTo, to go back to.
+			bool pruned;
+			vector< vector< const ReacInfo* > > unprunedReacInfo;
+			vector< const EqnInfo* > unprunedEqnInfo;
+			unique_ptr< EqnProgram > eqnProgram;
+			// The Model owns all its Info objects. The maps refer into these.
+			vector< unique_ptr< MolInfo > > molArena;
+			vector< unique_ptr< ReacInfo > > reacArena;
+			vector< unique_ptr< EqnInfo > > eqnArena;
+			unordered_map< string, unsigned int > grpIds;
+
+			// Forward sensitivities of conc to the params in sensParams.
+			vector< string > sensParams;
+			vector< unsigned int > sensOutputs;
+			vector< vector< pair< unsigned int, unsigned int > > > reacSensFields; // By reac id: (param, SensField)
+			vector< pair< unsigned int, unsigned int > > concInitSens; // (param, mol index)
+			vector< double > sens;	// d conc / d param, numMols x numParams
+			vector< vector< double > > sensPlotvec;	// Sampled sens of outputs
+			vector< double > sensRow;
+			vector< pair< unsigned int, double > > sensDc;
+
+			// Tape of reac products at each internal step of a recorded run,
+			// in schedule order. Reacs not marked in replayDirty are 
+			// replayed from it rather than evaluated. The tape is a cache
+			// of a run, and is not copied with the model.
+			bool recording;
+			vector< vector< double > > tape;
+			double tapeDt;
+			double tapeInternalDt;
+			double tapeMinTau;
+			vector< double > tapeGroupMinTau;
+			unsigned int tapeNumReacs;
+			unsigned int tapeStep;
+			vector< bool > replayDirty;	// By reac id
+
+			// Reac params, concInits and timestep settings as of the last 
+			// reinit, so that the next one need only evaluate what depends
+			// on a change. Empty when the schedule changes, which forces a
+			// full reinit.
+			vector< double > initParams;	// NUM_INIT_PARAMS by reac id
+			vector< double > initConcInit;
+			vector< double > initSettings;	// From timestepSettings
+
+			// Weakly connected components of the schedule, linked through
+			// reac subs and prds and through the Eqns. Empty when the 
+			// schedule changes, until the next reinit. The reacs step in
+			// groups, each with timesteps from its own minTau: one per 
+			// component, or per component and rate class with multirate.
+			vector< int > molComp;	// By mol index, -1 if not scheduled
+			vector< unsigned int > reacGroup;	// By reac id
+			vector< double > groupMinTau;
+			vector< double > groupDt;	// Internal timestep of each
+			vector< double > groupElapsed;	// Time due this step, 0 if none
+			vector< double > groupSettings;	// timestepSettings of the groups
+
+			// Reference trajectories, against which the squared error is 
+			// accumulated at each plot sample.
+			vector< unsigned int > scoreIndex;
+			vector< double > scoreScale;
+			vector< vector< double > > scoreRef;
+			vector< double > scoreSq;
+			unsigned int numSamples;
+
+			// Samples taken over the stimulus cycle being watched by
+			// runProtocol, to repeat if the cycle has reached steady state.
+			bool capturing;
+			vector< vector< double > > cycleBuf;
+};
+
+/**
+ * Params of a Model, each of the form obj.field, looked up once so that 
+ * they can all be read or written in a single call. Setting KA also 
+ * updates kh, and setting tau also sets tau2 if the two were equal when 
+ * bound. The binding refers into the Model, and must not outlive it.
+ */
+class ParamBinding
+{
+	public:
+			ParamBinding( Model* model, const vector< string >& params );
+			void setParams( const vector< double >& values );
+			vector< double > getParams() const;
+			vector< string > params;
+	private:
+			Model* model;
+			vector< unsigned int > target;	// Reac id, or mol index for concInit
+			vector< unsigned int > field;	// SensField
+			vector< bool > linkTau2;
 };
@@ -1,8 +1,13 @@
 #include <string>
 #include <map>
+#include <unordered_map>
+#include <vector>
+#include <iostream>
+#include <memory>
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <pybind11/stl_bind.h>
+#include <pybind11/numpy.h>
 #include <exprtk.hpp>
 using namespace std;
 
@@ -14,7 +19,134 @@ PYBIND11_MAKE_OPAQUE(std::map<string, MolInfo>);
 PYBIND11_MAKE_OPAQUE(std::map<string, ReacInfo>);
 PYBIND11_MAKE_OPAQUE(std::map<string, EqnInfo>);
 
+double convConst( const map< string, double >& consts, const py::handle& val )
+{
+	// Convert named const to number, or if already a number, return it.
+	if ( py::isinstance< py::str >( val ) ) {
+		string name = val.cast< string >();
+		auto c = consts.find( name );
+		if ( c == consts.end() )
+			throw py::value_error( "Error: Const '" + name + "' not found." );
+		return c->second;
+	}
+	return val.cast< double >();
+}
+
+unique_ptr< Model > buildModel( const py::dict& jsonDict )
+{
+	// Builds the whole model from the jsonDict, which should already have
+	// been scaled to mM. As in the Python version of parseModel, the
+	// Species entries of jsonDict are replaced by their numerical values.
+	unique_ptr< Model > model( new Model() );
+	map< string, double > consts;
+	if ( jsonDict.contains( "Constants" ) && !jsonDict["Constants"].is_none() ) {
+		for ( auto c: jsonDict["Constants"].cast< py::dict >() )
+			consts[ c.first.cast< string >() ] = c.second.cast< double >();
+	}
+	model->namedConsts = consts;
+	py::dict groups = jsonDict["Groups"];
+
+	// First, pull together all the species names. They crop up in
+	// the Species, the Reacs, and the Eqns. They are used as
+	// an index to the conc and concInit vector.
+	// Note that we have an ordering to decide which mol goes in which group:
+	// Species; names of reacs, First term of Eqns, substrates.
+	for ( auto g: groups ) {
+		string grpname = g.first.cast< string >();
+		py::dict grp = g.second.cast< py::dict >();
+		model->addGrp( grpname );
+		if ( grp.contains( "Reacs" ) ) {
+			for ( auto r: grp["Reacs"].cast< py::dict >() ) {
+				for ( const auto& sub: r.second["subs"].cast< vector< string > >() )
+					model->makeMol( sub, grpname, -1.0 );
+			}
+		}
+	}
+
+	map< string, vector< string > > eqnSubs;
+	map< string, string > eqnExprs;
+	for ( auto g: groups ) {
+		string grpname = g.first.cast< string >();
+		py::dict grp = g.second.cast< py::dict >();
+		if ( grp.contains( "Eqns" ) ) {
+			for ( auto e: grp["Eqns"].cast< py::dict >() ) {
+				string lhs = e.first.cast< string >();
+				vector< string >& subs = eqnSubs[ lhs ];
+				eqnExprs[ lhs ] = EqnInfo::extractSubs( 
+						e.second.cast< string >(), consts, subs );
+				for ( const auto& sub: subs )
+					model->makeMol( sub, grpname, -1.0 );
+				model->makeMol( lhs, grpname, -1.0 );
+			}
+		}
+		if ( grp.contains( "Reacs" ) ) {
+			for ( auto r: grp["Reacs"].cast< py::dict >() )
+				model->makeMol( r.first.cast< string >(), grpname, -1.0 );
+		}
+	}
+
+	for ( auto g: groups ) {
+		string grpname = g.first.cast< string >();
+		py::dict grp = g.second.cast< py::dict >();
+		if ( grp.contains( "Species" ) ) {
+			py::dict species = grp["Species"];
+			for ( auto sp: species ) {
+				double conc = convConst( consts, sp.second );
+				model->makeMol( sp.first.cast< string >(), grpname, conc );
+				species[ sp.first ] = conc;
+			}
+		}
+	}
+	model->allocConc();
+
+	// Now set up the reactions and equations. We need the mols all 
+	// defined first.
+	for ( auto g: groups ) {
+		string grpname = g.first.cast< string >();
+		py::dict grp = g.second.cast< py::dict >();
+		if ( grp.contains( "Reacs" ) ) {
+			for ( auto r: grp["Reacs"].cast< py::dict >() ) {
+				map< string, double > reacObj;
+				vector< string > subs;
+				for ( auto field: r.second.cast< py::dict >() ) {
+					string key = field.first.cast< string >();
+					if ( key == "subs" )
+						subs = field.second.cast< vector< string > >();
+					else
+						reacObj[ key ] = convConst( consts, field.second );
+				}
+				model->makeReac( r.first.cast< string >(), grpname, subs, reacObj );
+			}
+		}
+	}
+	for ( auto g: groups ) {
+		string grpname = g.first.cast< string >();
+		py::dict grp = g.second.cast< py::dict >();
+		if ( grp.contains( "Eqns" ) ) {
+			for ( auto e: grp["Eqns"].cast< py::dict >() ) {
+				string lhs = e.first.cast< string >();
+				model->makeEqn( lhs, grpname, eqnExprs[ lhs ], eqnSubs[ lhs ] );
+			}
+		}
+	}
+
+	model->sortReacs();
+	model->reinit();
+	return model;
+}
+
 PYBIND11_MODULE(ht, m) {
+	// Model definition errors are thrown as strings by the engine.
+	py::register_exception_translator( []( exception_ptr p ) {
+		try {
+			if ( p )
+				rethrow_exception( p );
+		} catch ( const string& e ) {
+			PyErr_SetString( PyExc_ValueError, e.c_str() );
+		} catch ( const char* e ) {
+			PyErr_SetString( PyExc_ValueError, e );
+		}
+	} );
 	py::bind_vector<std::vector<double>>(m, "VectorDouble");
     py::class_<MolInfo>(m, "MolInfo")
         .def( 
@@ -28,7 +160,7 @@ PYBIND11_MODULE(ht, m) {
 	/////////////////////////////////////////////////////////////////////
     py::class_<ReacInfo>(m, "ReacInfo")
         .def( 
-			py::init<const std::string &, const std::string &, const vector< string >&, const map< string, double>&, const map< string, MolInfo*>&>())
+			py::init<const std::string &, const std::string &, const vector< string >&, const map< string, double>&, const unordered_map< string, MolInfo* >&>())
 		.def_readwrite("name", &ReacInfo::name)
 		.def_readwrite("grp", &ReacInfo::grp)
 		.def_property("KA", &ReacInfo::getKA, &ReacInfo::setKA)
@@ -51,11 +183,12 @@ PYBIND11_MODULE(ht, m) {
 	/////////////////////////////////////////////////////////////////////
     py::class_<EqnInfo>(m, "EqnInfo")
         .def( 
-			py::init<const std::string &, const std::string &, const std::string&, const vector< string >&, const map< string, MolInfo* >&, vector< double >&>())
+			py::init<const std::string &, const std::string &, const std::string&, const vector< string >&, const unordered_map< string, MolInfo* >&>())
 		.def_readwrite("name", &EqnInfo::name)
 		.def_readwrite("grp", &EqnInfo::grp)
 		.def_readwrite("eqnStr", &EqnInfo::eqnStr)
 		.def_readonly("subs", &EqnInfo::subs)
+		.def_readonly("indexedStr", &EqnInfo::indexedStr)
 		.def( "eval", &EqnInfo::eval, "Evaluator for Eqns" );
 	/////////////////////////////////////////////////////////////////////
 
@@ -69,23 +202,82 @@ PYBIND11_MODULE(ht, m) {
 		.def_readonly("currentTime", &Model::currentTime)
 		.def_readwrite("dt", &Model::dt)
 		.def_readwrite("internalDt", &Model::internalDt)
+		.def_readwrite("dtScale", &Model::dtScale)
+		.def_readwrite("multirate", &Model::multirate)
 		.def_readonly("minTau", &Model::minTau)
 		.def_readwrite("conc", &Model::conc)
 		.def_readwrite("concInit", &Model::concInit)
 		.def_readonly("plotvec", &Model::plotvec)
+		.def_readonly("replaying", &Model::replaying)
+		.def_readwrite("storePlots", &Model::storePlots)
+		.def_readonly("numSkippedCycles", &Model::numSkippedCycles)
+		.def( "clone", &Model::clone, "Returns a deep copy of the model, including its parameters, schedule and current state." )
+		.def( "__deepcopy__", []( const Model& self, py::dict ) { return self.clone(); }, py::arg( "memo" ) )
+		.def( py::pickle(
+			[]( const Model& self ) { return py::bytes( self.serialize() ); },
+			[]( const py::bytes& state ) { return Model::deserialize( state ); } ) )
 		.def( "makeMol", &Model::makeMol, "Create MolInfo object.", py::arg("name"), py::arg("grp"), py::arg("concInit") = -1.0 )
 		.def( "makeReac", &Model::makeReac, "Create ReacInfo object.", py::arg("name"), py::arg("grp"), py::arg("subs"), py::arg("reacParms"))
 		.def( "makeEqn", &Model::makeEqn, "Create EqnInfo object.", py::arg("name"), py::arg("grp"), py::arg("expr"), py::arg( "eqnSubs" ) )
 		.def( "addGrp", &Model::addGrp, "Append grpname string to grpInfo vector.", py::arg("grpname") )
+		.def( "sortReacs", &Model::sortReacs, "Assigns orders to all reactions and builds the evaluation sequence from them." )
 		.def( "setReacSeqDepth", &Model::setReacSeqDepth, "Defines how deep is the sequence of reactions, that is, the size of sortedReacInfo.")
 		.def( "assignReacSeq", &Model::assignReacSeq, "Builds up sortedReacOrder vectors.")
 		.def( "advance", &Model::advance, "Advances the simulation", py::arg( "runtime" ), py::arg( "settle" ) = 0 )
-		.def( "reinit", &Model::reinit, "Reinits all conc values" )
+		.def( "reinit", &Model::reinit, "Reinits all conc values. Only the concInits that depend on a change since the last reinit are estimated again, unless full is set.", py::arg( "full" ) = false )
+		.def( "restart", []( Model& self, py::array_t< double, py::array::c_style | py::array::forcecast > state ) {
+				self.restart( vector< double >( state.data(), state.data() + state.size() ) );
+			}, "Like reinit, but starts from the given concs, such as a snapshot of the model once settled, rather than from concInit.", py::arg( "state" ) )
 		.def( "allocConc", &Model::allocConc, "Allocates and initializes conc vectors" )
+		.def( "parseEqns", &Model::parseEqns, "Compiles all scheduled Eqns into a single program on the conc vector." )
+		.def( "evalEqns", &Model::evalEqns, "Evaluates all scheduled Eqns in one call." )
 		.def( "getConcVec", &Model::getConcVec, "Returns vector of doubles of conc as a function of time for specified mol index." )
 		.def( "getMolOrder", &Model::getMolOrder, "Returns order of named molecule.", py::arg( "molName" ) )
 		.def( "updateMolOrder", &Model::updateMolOrder, "Checks if order of named molecule is <0, if so updates it and returns True.", py::arg( "maxOrder"), py::arg( "molName" ) )
+		.def( "pruneTo", &Model::pruneTo, "Schedules only the reacs and eqns upstream of the named output mols, so that runs cost only as much as the part of the model that they watch. Each call starts from the schedule before the first one, and an empty list goes back to it. Takes effect from the next reinit.", py::arg( "outputs" ) )
+		.def( "getComponents", &Model::getComponents, "Returns the names of the reacs and eqns in each weakly connected component of the schedule. Components do not interact, and each takes timesteps from its own minTau." )
+		.def( "getSCCs", &Model::getSCCs, "Returns the names of the reacs and eqns in each strongly connected component of the schedule, in order from upstream to downstream." )
 		.def( "modifySched", &Model::modifySched, "Modifies scheduling to retain/eliminate subsets of reactions and groups.", py::arg("saveList"), py::arg("deleteList") )
+		.def( "addScoreRef", []( Model& self, unsigned int molIndex, py::array_t< double, py::array::c_style | py::array::forcecast > ref, double scale ) {
+				self.addScoreRef( molIndex, vector< double >( ref.data(), ref.data() + ref.size() ), scale );
+			}, "Adds a reference array for the conc of the mol at each plot time. Each run accumulates the squared error, multiplied by scale, as it goes.", py::arg( "molIndex" ), py::arg( "ref" ), py::arg( "scale" ) = 1.0 )
+		.def( "clearScoreRefs", &Model::clearScoreRefs, "Removes all score references." )
+		.def( "getScore", &Model::getScore, "Returns the root of the summed mean squared scaled error of the run against each score reference." )
+		.def( "setRecording", &Model::setRecording, "When set, each run from reinit records a tape of reac outputs, for later replays.", py::arg( "flag" ) )
+		.def( "setReplay", &Model::setReplay, "Names the reacs, mols or eqns that have changed since the recorded run. Subsequent runs evaluate only these and everything downstream, and replay the rest from the tape. An empty list goes back to full runs.", py::arg( "names" ) )
+		.def( "setConc", &Model::setConc, "Assigns conc of specified mol index, as for a stimulus. Clears its sensitivities.", py::arg( "molIndex" ), py::arg( "value" ) )
+		.def( "runProtocol", []( Model& self, py::array_t< double, py::array::c_style | py::array::forcecast > times, py::array_t< unsigned int, py::array::c_style | py::array::forcecast > molIndices, py::array_t< double, py::array::c_style | py::array::forcecast > values, double cycleTol ) {
+				vector< double > t( times.data(), times.data() + times.size() );
+				vector< unsigned int > m( molIndices.data(), molIndices.data() + molIndices.size() );
+				vector< double > v( values.data(), values.data() + values.size() );
+				// Other threads can run their own models meanwhile.
+				py::gil_scoped_release release;
+				self.runProtocol( t, m, v, cycleTol );
+			}, "Delivers a stimulus protocol in one call. At each of the sorted times, measured from the start of the call, the simulation is advanced and then the conc of molIndices[i] is set to values[i]. If cycleTol > 0, repeated stimulus cycles are skipped once the concs at the start of successive cycles agree within cycleTol, as a fraction, and the samples of the last simulated cycle are repeated instead.", py::arg( "times" ), py::arg( "molIndices" ), py::arg( "values" ), py::arg( "cycleTol" ) = 0.0 )
+		.def( "bindParams", &Model::bindParams, "Returns a ParamBinding for the params, each of the form obj.field, to read or write them all in one call.", py::arg( "params" ), py::keep_alive< 0, 1 >() )
+		.def( "setSens", &Model::setSens, "Sets up computation of sensitivities of the output mols to the params, each of the form obj.field. Takes effect from the next reinit. An empty params list turns it off.", py::arg( "params" ), py::arg( "outputs" ) )
+		.def( "getSensVec", []( const Model& self, unsigned int molIndex ) {
+				auto sv = self.getSensVec( molIndex );
+				size_t np = sv.size() > 0 ? sv[0].size() : 0;
+				py::array_t< double > ret( { sv.size(), np } );
+				auto buf = ret.mutable_unchecked< 2 >();
+				for ( size_t i = 0; i < sv.size(); i++ )
+					for ( size_t j = 0; j < np; j++ )
+						buf( i, j ) = sv[i][j];
+				return ret;
+			}, "Returns array of d conc / d param for specified output mol index, with a row for each plot time.", py::arg( "molIndex" ) )
+		;
+
+	py::class_<ParamBinding>(m, "ParamBinding")
+		.def_readonly("params", &ParamBinding::params)
+		.def( "setParams", []( ParamBinding& self, py::array_t< double, py::array::c_style | py::array::forcecast > values ) {
+				self.setParams( vector< double >( values.data(), values.data() + values.size() ) );
+			}, "Assigns all the bound params. Setting KA also updates kh, and setting tau also sets tau2 if they were equal when bound.", py::arg( "values" ) )
+		.def( "getParams", []( const ParamBinding& self ) {
+				auto v = self.getParams();
+				return py::array_t< double >( v.size(), v.data() );
+			}, "Returns array of the values of the bound params." )
 		;
+	m.def( "buildModel", &buildModel, "Builds a Model from the dict of a HillTau model, which has already been scaled to mM. Does the same as hillTau.parseModel.", py::arg( "jsonDict" ) );
 }
 
@@ -0,0 +1,293 @@
+import os
+import sys
+import argparse
+import importlib.util
+import numpy as np
+
+# Checks that the Python and C++ engines give the same results, and that
+# in each the options which should leave the results alone do so exactly.
+
+ERR_LIMIT = 1e-9    # Allowed difference between the engines, as a fraction of range
+CYCLE_ERR_LIMIT = 1e-6  # Allowed difference from skipping stimulus cycles
+CYCLE_TOL = 1e-6    # cycleTol for runProtocol
+
+# A chain with a fast reac downstream of the output, which pruning drops.
+chainModel = {
+    "FileType": "HillTau", "Version": "1.0",
+    "Groups": { "chain_g": {
+        "Species": { "input": 0.0 },
+        "Reacs": {
+            "mid": { "subs": ["input"], "KA": 1e-3, "tau": 1.0 },
+            "output": { "subs": ["mid"], "KA": 1e-3, "tau": 0.5 },
+            "side": { "subs": ["output"], "KA": 1e-3, "tau": 0.01 }
+        }
+    } }
+}
+
+# Model, stimulus mol, [conc, start, stop, runtime], dt, mols to prune to
+pruneVec = [
+    [chainModel, "input", [1e-3, 1, 3, 6], 0.1, ["output"]],
+    ["bcm", "Ca", [2e-3, 20, 40, 100], 1.0, ["aCaN"]],
+    ["syn_prot_composite", "Ca", [1e-3, 100, 200, 1000], 1.0, ["aCaMKIII"]],
+    ["fb_inhib", "input", [1e-3, 20, 60, 100], 1.0, ["fb"]],
+]
+
+# Model, stimulus mol, [conc, start, stop, runtime], dt
+multirateVec = [
+    ["bcm", "Ca", [2e-3, 20, 40, 100], 1.0],
+    ["syn_prot_composite", "Ca", [1e-3, 100, 200, 1000], 1.0],
+    ["fb_inhib", "input", [1e-3, 20, 60, 100], 1.0],
+    ["kholodenko", "MKKK", [2e-3, 100, 1000, 3000], 10.0],
+]
+
+# Model, stimulus mol, [conc, start, stop, runtime], dt, params to change
+reinitVec = [
+    ["fb_inhib", "input", [1e-3, 20, 60, 100], 1.0, ["output.tau", "fb.KA", "output.KA"]],
+    ["syn_prot_composite", "Ca", [1e-3, 100, 200, 1000], 1.0, ["aS6K.tau", "aCaMKIII.KA", "AminoAcids.concInit"]],
+    ["bcm", "Ca", [2e-3, 20, 40, 100], 1.0, ["aCaN.tau", "synAMPAR.KA", "CaMKII.concInit"]],
+    ["kholodenko", "MKKK", [2e-3, 100, 1000, 3000], 10.0, ["nfb.tau", "output.KA", "MAPK.concInit"]],
+]
+
+# Model, stimulus mol, [conc, on time, period, number of cycles], dt
+protocolVec = [
+    ["fb_inhib", "input", [1e-3, 5, 20, 40], 0.5],
+    ["ff_inhib", "input", [1e-3, 5, 20, 40], 0.5],
+    ["bcm", "Ca", [2e-3, 2, 10, 40], 0.5],
+]
+
+# Model, stimulus mol, [conc, start, stop, runtime], dt. Each model has
+# internalDt = 0.1 at dt = 1, and the runs are short enough that it steps
+# at internalDt throughout.
+samplingVec = [
+    ["osc", "mol", [4e-4, 20, 60, 150], 1.0],
+    ["syn_CaMKIII_old", "Ca", [1e-3, 20, 60, 100], 1.0],
+    ["fb_inhib", "input", [1e-3, 20, 60, 100], 1.0],
+]
+
+def loadEngine( name, fname, path ):
+    # Loads the hillTau module in fname under its own name, so that both
+    # engines can be loaded at once.
+    sys.path.insert( 0, path )
+    spec = importlib.util.spec_from_file_location( name, fname )
+    engine = importlib.util.module_from_spec( spec )
+    spec.loader.exec_module( engine )
+    return engine
+
+def loadModel( ht, model, dt ):
+    if isinstance( model, str ):
+        jsonDict = ht.loadHillTau( model + ".json" )
+    else:
+        jsonDict = dict( model )
+    ht.scaleDict( jsonDict, ht.getQuantityScale( jsonDict ) )
+    ret = ht.parseModel( jsonDict )
+    ret.dt = dt
+    return ret
+
+def runStim( model, mol, stim, full = False ):
+    # Returns the conc of every mol over the run, in order of name.
+    conc, start, stop, runtime = stim
+    i = model.molInfo[mol].index
+    model.reinit( full )
+    base = model.conc[i]
+    model.advance( start )
+    model.conc[i] = conc
+    model.advance( stop - start )
+    model.conc[i] = base
+    model.advance( runtime - stop )
+    return np.array( [ model.getConcVec( model.molInfo[name].index ) for name in sorted( model.molInfo ) ] )
+
+def relDiff( x, y ):
+    # Largest difference between two runs, as a fraction of the range of
+    # each mol in the first.
+    rng = np.ptp( x, axis = 1 )
+    rng[ rng == 0.0 ] = 1.0
+    return np.max( np.max( np.abs( x - y ), axis = 1 ) / rng )
+
+def checkSampling( ht ):
+    # Runs each model in one go, and one dt at a time so that each sample
+    # is taken exactly at a multiple of dt. The samples must come out the
+    # same, not an internal step late.
+    ret = []
+    err = 0.0
+    for model, mol, stim, dt in samplingVec:
+        m = loadModel( ht, model, dt )
+        x = runStim( m, mol, stim )
+        conc, start, stop, runtime = stim
+        i = m.molInfo[mol].index
+        m.reinit()
+        base = m.conc[i]
+        for t in range( int( round( runtime / dt ) ) ):
+            if t * dt == start:
+                m.conc[i] = conc
+            elif t * dt == stop:
+                m.conc[i] = base
+            m.advance( dt )
+        y = np.array( [ m.getConcVec( m.molInfo[name].index ) for name in sorted( m.molInfo ) ] )
+        if x.shape != y.shape:
+            err = max( err, 1.0 )
+        else:
+            err = max( err, relDiff( x, y ) )
+        ret.append( x )
+    return ret, err
+
+def checkPrune( ht ):
+    # Runs each model pruned to some mols and unpruned. Those mols must
+    # come out exactly the same.
+    ret = []
+    err = 0.0
+    for model, mol, stim, dt, outputs in pruneVec:
+        full = runStim( loadModel( ht, model, dt ), mol, stim )
+        m = loadModel( ht, model, dt )
+        m.pruneTo( outputs )
+        pruned = runStim( m, mol, stim )
+        names = sorted( m.molInfo )
+        for name in outputs:
+            i = names.index( name )
+            err = max( err, relDiff( full[i:i+1], pruned[i:i+1] ) )
+        ret.append( pruned )
+    return ret, err
+
+def checkMultirate( ht ):
+    # Runs each model with multirate turned on, off and on again. Each 
+    # run must come out exactly as it does from a fresh model.
+    ret = []
+    err = 0.0
+    for model, mol, stim, dt in multirateVec:
+        single = runStim( loadModel( ht, model, dt ), mol, stim )
+        m = loadModel( ht, model, dt )
+        m.multirate = True
+        multi = runStim( m, mol, stim )
+        m.multirate = False
+        off = runStim( m, mol, stim )
+        m.multirate = True
+        on = runStim( m, mol, stim )
+        err = max( err, relDiff( single, off ), relDiff( multi, on ) )
+        ret.extend( [ single, multi ] )
+    return ret, err
+
+def checkReinit( ht ):
+    # Changes the params one at a time, then dt, then turns multirate on 
+    # and off, and runs each model after each change both with the 
+    # incremental reinit and with a full one. They must come out exactly
+    # the same.
+    ret = []
+    err = 0.0
+    for model, mol, stim, dt, params in reinitVec:
+        inc = loadModel( ht, model, dt )
+        full = loadModel( ht, model, dt )
+        runStim( inc, mol, stim )
+        bindings = [ inc.bindParams( params ), full.bindParams( params ) ]
+        base = bindings[0].getParams()
+        for i in range( len( params ) + 3 ):
+            if i < len( params ):
+                scale = np.ones( len( params ) )
+                scale[:i+1] = 1.5
+                for b in bindings:
+                    b.setParams( base * scale )
+            elif i == len( params ):
+                inc.dt = full.dt = dt / 2.0
+            else:
+                inc.multirate = full.multirate = ( i == len( params ) + 1 )
+            x = runStim( full, mol, stim, full = True )
+            y = runStim( inc, mol, stim )
+            err = max( err, relDiff( x, y ) )
+            ret.append( y )
+    return ret, err
+
+def protocolArrays( model, mol, cycle ):
+    conc, onTime, period, numCycles = cycle
+    times = []
+    values = []
+    for k in range( numCycles ):
+        times.extend( [ k * period, k * period + onTime ] )
+        values.extend( [ conc, 0.0 ] )
+    indices = [ model.molInfo[mol].index ] * len( times )
+    return np.array( times ), np.array( indices, dtype = np.uint32 ), np.array( values )
+
+def runProtocol( model, mol, cycle, cycleTol ):
+    times, indices, values = protocolArrays( model, mol, cycle )
+    model.reinit()
+    model.runProtocol( times, indices, values, cycleTol )
+    return np.array( [ model.getConcVec( model.molInfo[name].index ) for name in sorted( model.molInfo ) ] )
+
+def checkProtocol( ht ):
+    # Runs each protocol with runProtocol, and event by event with 
+    # advance. They must come out exactly the same.
+    ret = []
+    err = 0.0
+    for model, mol, cycle, dt in protocolVec:
+        m = loadModel( ht, model, dt )
+        times, indices, values = protocolArrays( m, mol, cycle )
+        m.reinit()
+        t = 0.0
+        for ti, i, v in zip( times, indices, values ):
+            m.advance( ti - t )
+            m.conc[i] = v
+            t = ti
+        stepped = np.array( [ m.getConcVec( m.molInfo[name].index ) for name in sorted( m.molInfo ) ] )
+        y = runProtocol( m, mol, cycle, 0.0 )
+        err = max( err, relDiff( stepped, y ) )
+        ret.append( y )
+    return ret, err
+
+def checkCycles( ht ):
+    # Runs each protocol skipping the cycles once they repeat, and
+    # stepping through all of them. Each must skip some cycles, and come
+    # out within CYCLE_ERR_LIMIT.
+    ret = []
+    err = 0.0
+    for model, mol, cycle, dt in protocolVec:
+        m = loadModel( ht, model, dt )
+        x = runProtocol( m, mol, cycle, 0.0 )
+        y = runProtocol( m, mol, cycle, CYCLE_TOL )
+        if m.numSkippedCycles == 0:
+            err = max( err, 1.0 )
+        err = max( err, relDiff( x, y ) )
+        ret.append( y )
+    return ret, err
+
+def engineDiff( a, b ):
+    # Largest difference between the runs of two engines.
+    return max( [ relDiff( x, y ) for x, y in zip( a, b ) ] )
+
+# Name, function, allowed error within each engine
+checks = [
+    ["samples on the dt grid", checkSampling, ERR_LIMIT],
+    ["pruned vs unpruned", checkPrune, 0.0],
+    ["multirate on, off, on", checkMultirate, 0.0],
+    ["incremental vs full reinit", checkReinit, 0.0],
+    ["runProtocol vs advance", checkProtocol, 0.0],
+    ["skipped vs stepped cycles", checkCycles, CYCLE_ERR_LIMIT],
+]
+
+def main():
+    parser = argparse.ArgumentParser( description = "This program checks that the Python and C++ engines of HillTau agree" )
+    parser.add_argument( "-py", "--python", type=str, help= "Optional: directory of the Python hillTau.py. Default is ../../PythonCode.", default = "../../PythonCode" )
+    parser.add_argument( "-c", "--cpp", type=str, help= "Optional: directory of the C++ hillTau.py and the ht module it imports. Default is ../../CppCode.", default = "../../CppCode" )
+    args = parser.parse_args()
+    engines = [ ["Python", loadEngine( "pyHillTau", os.path.join( args.python, "hillTau.py" ), args.python )] ]
+    try:
+        engines.append( ["C++", loadEngine( "cppHillTau", os.path.join( args.cpp, "hillTau.py" ), args.cpp )] )
+    except ( ImportError, OSError ) as e:
+        print( "Skipping the C++ engine: {}".format( e ) )
+
+    for name, check, limit in checks:
+        rets = []
+        for ename, ht in engines:
+            print( "Checking {:40s}".format( "{} ({})".format( name, ename ) ), end = "....     " )
+            ret, err = check( ht )
+            rets.append( ret )
+            if err > limit:
+                print( "failed, err = {:.5g}".format( err ) )
+            else:
+                print( "OK, err = {:.5g}".format( err ) )
+        if len( rets ) > 1:
+            print( "Checking {:40s}".format( "{} (engines)".format( name ) ), end = "....     " )
+            err = engineDiff( rets[0], rets[1] )
+            if err > ERR_LIMIT:
+                print( "failed, err = {:.5g}".format( err ) )
+            else:
+                print( "OK, err = {:.5g}".format( err ) )
+
+if __name__ == '__main__':
+    main()
@@ -25,18 +25,24 @@
  '''
 from __future__ import print_function
 import sys
+import copy
 import json
 import re
 import argparse
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 
 lookupQuantityScale = { "M": 1000.0, "mM": 1.0, "uM": 1e-3, "nM": 1e-6, "pM": 1e-9 }
 
 INTERNAL_DT_SCALE = 0.02
+MAX_CYCLE_EVENTS = 16 # Longest stimulus cycle looked for
 
 SIGSTR = "{:.4g}" # Used to format floats to keep to 4 sig fig. Helps when dumping JSON files.
 
+# Reac fields for which the Model can compute sensitivities.
+sensFields = ["KA", "tau", "tau2", "gain", "baseline", "Kmod", "Amod", "Nmod"]
+
 mathFns = ["exp", "log", "ln", "log10", "abs", "sin", "cos", "tan", "sinh", "cosh", "tanh", "sqrt", "pow"]
 
 def loadHillTau( fname ):
@@ -166,6 +172,51 @@ class ReacInfo():
         else:
             return s * h / ( h + self.kh * mod )
 
+    def concInfSens( self, conc ):
+        # Returns concInf, along with its partial derivatives with respect
+        # to the sub concs, as a list of (index, value), and to the reac
+        # params, as a dict keyed by field.
+        ch = conc[self.hillIndex]
+        h = ch ** self.HillCoeff
+        dh = self.HillCoeff * ch ** ( self.HillCoeff - 1.0 )
+        dp = {}
+        if self.oneSub:
+            dp["KA"] = -h / ( self._KA * self._KA )
+            return h / self._KA, [( self.hillIndex, dh / self._KA )], dp
+        mod = 1.0
+        dmodDc = 0.0
+        dmod = {}
+        if self.modIndex != -1:
+            cm = conc[ self.modIndex ]
+            x = pow( cm / self.Kmod, self.Nmod )
+            den = 1.0 + self.Amod * x
+            mod = ( 1.0 + x ) / den
+            dmodDx = ( 1.0 - self.Amod ) / ( den * den )
+            if cm > 0.0 or self.Nmod >= 1.0:
+                dmodDc = dmodDx * self.Nmod * pow( cm / self.Kmod, self.Nmod - 1.0 ) / self.Kmod
+            dmod["Kmod"] = -dmodDx * self.Nmod * x / self.Kmod
+            dmod["Amod"] = -( 1.0 + x ) * x / ( den * den )
+            dmod["Nmod"] = dmodDx * x * np.log( cm / self.Kmod ) if cm > 0.0 else 0.0
+        q = self.kh * mod
+        d = h + q
+        s = conc[ self.reagIndex ] * self.gain
+        if self.inhibit:
+            g = q / d
+            dgDh = -q / ( d * d )
+            dgDq = h / ( d * d )
+        else:
+            g = h / d
+            dgDh = q / ( d * d )
+            dgDq = -h / ( d * d )
+        dc = [( self.hillIndex, s * dgDh * dh ), ( self.reagIndex, self.gain * g )]
+        if self.modIndex != -1:
+            dc.append( ( self.modIndex, s * dgDq * self.kh * dmodDc ) )
+        for field, val in dmod.items():
+            dp[field] = s * dgDq * self.kh * val
+        dp["gain"] = conc[ self.reagIndex ] * g
+        dp["KA"] = s * dgDq * self.HillCoeff * self._KA ** ( self.HillCoeff - 1.0 ) * mod
+        return s * g, dc, dp
+
     def concFracUp( self, t ):
         return 1.0 - np.exp( -t/self.tau )
 
@@ -189,6 +240,10 @@ class ReacInfo():
     def getReacField( self, field ):
         return 0.0
 
+    def initParams( self ):
+        # The params that set this reac's concInit or its share of minTau.
+        return ( self.tau, self.tau2, self._KA, self.kh, self.Kmod, self.Amod, self.Nmod, self.gain, self.baseline, self.inhibit, self.overrideConcInit )
+
     @property
     def KA( self ):
         return self._KA
@@ -233,6 +288,40 @@ class EqnInfo():
         m[self.index] = ret = eval( self.newEq )
         return ret
 
+class ParamBinding():
+    # Params of a Model, each of the form obj.field, looked up once so 
+    # that they can all be read or written in a single call. Setting KA 
+    # also updates kh, and setting tau also sets tau2 if the two were 
+    # equal when bound.
+    def __init__( self, model, params ):
+        self.model = model
+        self.params = list( params )
+        self.targets = []   # ( MolInfo or ReacInfo, field, linkTau2 )
+        for p in self.params:
+            obj, field = model.lookupParam( p, "bound" )
+            if field == "concInit":
+                self.targets.append( ( model.molInfo[obj], field, False ) )
+            else:
+                ri = model.reacInfo[obj]
+                link = ( field == "tau" and np.isclose( ri.tau, ri.tau2 ) )
+                self.targets.append( ( ri, field, link ) )
+
+    def setParams( self, values ):
+        if len( values ) != len( self.params ):
+            raise ValueError( "Error: Expected {} param values, got {}".format( len( self.params ), len( values ) ) )
+        for ( target, field, link ), v in zip( self.targets, values ):
+            v = float( v )
+            if field == "concInit":
+                target.concInit = v
+                self.model.concInit[ target.index ] = v
+            else:
+                setattr( target, field, v )
+                if link:
+                    target.tau2 = v
+
+    def getParams( self ):
+        return np.array( [ getattr( target, field ) for target, field, link in self.targets ] )
+
 class Model():
     def __init__( self, jsonDict ):
         self.jsonDict = jsonDict
@@ -244,6 +333,8 @@ class Model():
         self.namedConsts = {}
         self.sortedReacInfo = []
         self.sortedEqnInfo = []
+        # The schedule from before the first pruneTo, to go back to.
+        self.unprunedSched = None
         self.currentTime = 0.0
         self.step = 0
         self.conc = np.zeros(1)
@@ -252,14 +343,352 @@ class Model():
         self.runtime = 0.0
         self.dt = 1.0
         self.internalDt = 1.0
+        self.dtScale = INTERNAL_DT_SCALE # internalDt as a fraction of minTau
+        self.multirate = False # If set, each reac steps at the rate its own tau gives.
         self.minTau = 1.0
+        # Forward sensitivities of conc to the params in sensParams.
+        self.sensParams = []
+        self.sensOutputs = []
+        self.reacSensFields = {} # Keyed by reac name: [(param, field)]
+        self.concInitSens = [] # [(param, mol index)]
+        self.sens = np.zeros( (0, 0) ) # d conc / d param, numMols x numParams
+        self.sensPlotvec = []
+        # Tape of reac products at each internal step of a recorded run,
+        # in schedule order. Reacs not in replayDirty are replayed from it
+        # rather than evaluated.
+        self.recording = False
+        self.replaying = False
+        self.tape = []
+        self.tapeInfo = None
+        self.tapeStep = 0
+        self.replayDirty = None # Names of reacs to evaluate in a replay
+        # Reac params, concInits and timestep settings as of the last 
+        # reinit, so that the next one need only evaluate what depends on 
+        # a change. None when the schedule changes, which forces a full 
+        # reinit.
+        self.initParams = {}
+        self.initConcInit = None
+        self.initSettings = None # From timestepSettings
+        # Weakly connected components of the schedule, linked through reac
+        # subs and prds and through the Eqns. None when the schedule 
+        # changes, until the next reinit. The reacs step in groups, each 
+        # with timesteps from its own minTau: one per component, or per 
+        # component and rate class with multirate. Each scheduled reac 
+        # holds its group number in group.
+        self.molComp = None # By mol index, -1 if not scheduled
+        self.groupMinTau = []
+        self.groupDt = [] # Internal timestep of each
+        self.groupElapsed = [ 1.0 ] # Time due this step, 0 if none
+        self.groupSettings = None # timestepSettings of the groups
+        # Reference trajectories, against which the squared error is 
+        # accumulated at each plot sample.
+        self.storePlots = True
+        self.scoreRefs = [] # [(mol index, ref array, scale)]
+        self.scoreSq = []
+        self.numSamples = 0
+        # Samples taken over the stimulus cycle being watched by 
+        # runProtocol, to repeat if the cycle has reached steady state.
+        self.numSkippedCycles = 0
+        self.capturing = False
+        self.cycleBuf = []
+
+    def clone( self ):
+        # Deep copy of the model, sharing only the jsonDict it came from.
+        # The tape is a cache of a run, and is not copied.
+        memo = { id( self.jsonDict ): self.jsonDict, id( self.tape ): [] }
+        ret = copy.deepcopy( self, memo )
+        ret.setRecording( False )
+        return ret
+
+    def setRecording( self, flag ):
+        # When set, each run from reinit records a tape for later replays.
+        self.recording = flag
+        self.tape = []
+        self.replayDirty = None
+        self.replaying = False
+
+    def setReplay( self, names ):
+        # Marks the reacs that may differ from the recorded run: the named
+        # reacs, those reading named mols or eqns, and all downstream of 
+        # them. The next runs replay the other reacs from the tape. An 
+        # empty list goes back to full runs.
+        self.replayDirty = None
+        if len( names ) == 0:
+            return
+        for n in names:
+            if not n in self.molInfo:
+                raise ValueError( "Error: Unknown object '{}' for replay".format( n ) )
+        self.replayDirty = set()
+        molDirty = set( names )
+        changed = True
+        while changed:
+            changed = False
+            for name, r in self.reacInfo.items():
+                if name in self.replayDirty:
+                    continue
+                if name in molDirty or any( [ s in molDirty for s in r.subs ] ):
+                    self.replayDirty.add( name )
+                    molDirty.add( name )
+                    changed = True
+            for name, e in self.eqnInfo.items():
+                if not name in molDirty and any( [ s in molDirty for s in e.subs ] ):
+                    molDirty.add( name )
+                    changed = True
+
+    def addScoreRef( self, molIndex, ref, scale = 1.0 ):
+        # Adds a reference for the conc of molIndex at each plot time. The
+        # score accumulates ( ( conc - ref ) * scale )^2 as the run goes.
+        if molIndex < 0 or molIndex >= len( self.molInfo ):
+            raise ValueError( "Error: Score reference index out of range" )
+        ref = np.array( ref, dtype = float ).ravel()
+        if len( ref ) == 0:
+            raise ValueError( "Error: Score reference is empty" )
+        self.scoreRefs.append( ( molIndex, ref, scale ) )
+        self.scoreSq.append( 0.0 )
+
+    def clearScoreRefs( self ):
+        self.scoreRefs = []
+        self.scoreSq = []
+
+    def getScore( self ):
+        # Root of the summed mean squared scaled error of each reference.
+        if len( self.scoreRefs ) == 0:
+            raise ValueError( "Error: No score references have been added" )
+        sq = 0.0
+        for ( molIndex, ref, scale ), s in zip( self.scoreRefs, self.scoreSq ):
+            if self.numSamples != len( ref ):
+                raise ValueError( "Error: Run has {} plot samples but score reference has {}".format( self.numSamples, len( ref ) ) )
+            sq += s / len( ref )
+        return np.sqrt( sq )
+
+    def sample( self ):
+        # Takes the outputs for a plot time.
+        if self.storePlots:
+            self.plotvec.append( np.array( self.conc ) )
+        if self.capturing:
+            self.cycleBuf.append( np.array( self.conc ) )
+        if len( self.sensParams ) > 0:
+            self.recordSens()
+        for i, ( molIndex, ref, scale ) in enumerate( self.scoreRefs ):
+            if self.numSamples < len( ref ):
+                d = ( self.conc[molIndex] - ref[self.numSamples] ) * scale
+                self.scoreSq[i] += d * d
+        self.numSamples += 1
+
+    def setConc( self, molIndex, val ):
+        # Assigns a conc, as done for stimuli. The assigned value does not
+        # depend on any param, so its sensitivities are cleared.
+        self.conc[molIndex] = val
+        if len( self.sensParams ) > 0:
+            self.sens[molIndex] = 0.0
+
+    def runProtocol( self, times, molIndices, values, cycleTol = 0.0 ):
+        # Delivers each stimulus in turn, advancing to its time first. 
+        # Times are from the start of the call, and must be sorted.
+        # If cycleTol > 0, runs of repeated stimulus cycles are watched. 
+        # Once the concs at the start of successive cycles agree within 
+        # cycleTol, as a fraction, the samples of the last cycle are 
+        # repeated in place of simulating further cycles.
+        times = np.asarray( times, dtype = float )
+        if len( times ) != len( molIndices ) or len( times ) != len( values ):
+            raise ValueError( "Error: Protocol arrays differ in length" )
+        if len( times ) == 0:
+            return
+        if np.any( np.asarray( molIndices ) < 0 ) or np.any( np.asarray( molIndices ) >= len( self.molInfo ) ):
+            raise ValueError( "Error: Protocol mol index out of range" )
+        if times[0] < 0.0 or np.any( np.diff( times ) < 0.0 ):
+            raise ValueError( "Error: Protocol times must be sorted and not negative" )
+        # Sensitivities and tapes need every step to be simulated.
+        doSkip = cycleTol > 0.0 and len( self.sensParams ) == 0 and not self.recording and not self.replaying
+        self.numSkippedCycles = 0
+        self.capturing = False
+        times = times.tolist()
+        molIndices = [ int( m ) for m in molIndices ]
+        values = [ float( v ) for v in values ]
+        cycStart = 0
+        cycK = 0
+        cycConc = None
+        lastt = 0.0
+        i = 0
+        try:
+            while i < len( times ):
+                self.advance( times[i] - lastt )
+                lastt = times[i]
+                if doSkip:
+                    if self.capturing and i == cycStart + cycK:
+                        self.capturing = False
+                        n = self.cyclesToSkip( times, molIndices, values, cycStart, cycK, i, cycConc, cycleTol )
+                        if n > 0:
+                            self.repeatCycle( n )
+                            i += n * cycK
+                            self.currentTime += times[i] - lastt
+                            lastt = times[i]
+                            self.numSkippedCycles += n
+                    if not self.capturing:
+                        cycK = Model.cyclePeriod( times, molIndices, values, i )
+                        if cycK > 0:
+                            self.capturing = True
+                            cycStart = i
+                            cycConc = np.array( self.conc )
+                            self.cycleBuf = []
+                self.setConc( molIndices[i], values[i] )
+                i += 1
+        finally:
+            self.capturing = False
+            self.cycleBuf = []
+
+    @staticmethod
+    def sameStim( times, molIndices, values, i, j ):
+        # True if events i and j deliver the same stimulus, and are 
+        # followed by the same interval to the next event.
+        di = times[i+1] - times[i]
+        dj = times[j+1] - times[j]
+        return molIndices[i] == molIndices[j] and values[i] == values[j] and abs( di - dj ) <= 1.0e-9 * max( di, dj )
+
+    @staticmethod
+    def cyclePeriod( times, molIndices, values, i ):
+        # Returns the number of events in the shortest stimulus cycle that
+        # starts at event i and repeats at least once, or 0 if none.
+        k = 1
+        while k <= MAX_CYCLE_EVENTS and i + 2 * k < len( times ):
+            if all( [ Model.sameStim( times, molIndices, values, i + m, i + k + m ) for m in range( k ) ] ):
+                return k
+            k += 1
+        return 0
+
+    def cyclesToSkip( self, times, molIndices, values, cycStart, cycK, i, cycConc, cycleTol ):
+        # Returns the number of cycles from event i that can be filled in
+        # from the cycle just simulated, from cycStart to i.
+        # The samples must fall at the same points in each cycle.
+        numDt = ( times[i] - times[cycStart] ) / self.dt
+        if numDt < 0.5 or abs( numDt - round( numDt ) ) > 1.0e-6 * numDt or len( self.cycleBuf ) != round( numDt ):
+            return 0
+        # Guard against slow drift: the change over the last cycle, 
+        # carried over all the skipped ones, must stay within tolerance.
+        maxCycles = ( len( times ) - i ) // cycK
+        d = np.abs( self.conc - cycConc )
+        moved = d > 0.0
+        if np.any( moved ):
+            maxCycles = min( maxCycles, np.min( np.floor( cycleTol * np.abs( self.conc[moved] ) / d[moved] ) ) )
+        n = 0
+        base = i
+        while n < maxCycles and base + cycK < len( times ):
+            if not all( [ Model.sameStim( times, molIndices, values, cycStart + m, base + m ) for m in range( cycK ) ] ):
+                break
+            n += 1
+            base += cycK
+        return n
+
+    def repeatCycle( self, n ):
+        # Takes the samples of the last cycle again for n more cycles. The
+        # concs at the end are those at the start of the cycle, which 
+        # have converged.
+        saved = self.conc
+        for c in range( n ):
+            for v in self.cycleBuf:
+                self.conc = v
+                self.sample()
+        self.conc = saved
+        self.step += n * len( self.cycleBuf )
+
+    def lookupParam( self, param, use ):
+        # Returns the obj and field of a param of the form obj.field, 
+        # with field "concInit" for a molecule.
+        spl = param.rsplit( '.', 1 )
+        if len( spl ) != 2:
+            raise ValueError( "Error: {} param '{}' should be of the form obj.field".format( use.capitalize(), param ) )
+        obj, field = spl
+        if field == "concInit" or field == "conc":
+            if not obj in self.molInfo:
+                raise ValueError( "Error: Unknown molecule in {} param '{}'".format( use, param ) )
+            return obj, "concInit"
+        if not obj in self.reacInfo:
+            raise ValueError( "Error: Unknown reaction in {} param '{}'".format( use, param ) )
+        if not field in sensFields:
+            raise ValueError( "Error: Unknown field in {} param '{}'".format( use, param ) )
+        return obj, field
+
+    def bindParams( self, params ):
+        # Returns a ParamBinding to read or write all the params at once.
+        return ParamBinding( self, params )
+
+    def setSens( self, params, outputs ):
+        # Sets up the params, each of the form obj.field, and the output 
+        # mols for which to compute sensitivities. These are computed 
+        # from the next reinit. An empty params list turns them off.
+        if len( params ) > 0 and len( self.sortedEqnInfo ) > 0:
+            raise ValueError( "Error: Sensitivities are not supported for models with Eqns" )
+        reacSensFields = {}
+        concInitSens = []
+        for i, p in enumerate( params ):
+            obj, field = self.lookupParam( p, "sensitivity" )
+            if field == "concInit":
+                concInitSens.append( ( i, self.molInfo[obj].index ) )
+            else:
+                reacSensFields.setdefault( obj, [] ).append( ( i, field ) )
+        for o in outputs:
+            if o < 0 or o >= len( self.molInfo ):
+                raise ValueError( "Error: Sensitivity output index out of range" )
+        self.sensParams = list( params )
+        self.sensOutputs = list( outputs )
+        self.reacSensFields = reacSensFields
+        self.concInitSens = concInitSens
+        self.sensPlotvec = []
+        self.initSens()
+
+    def getSensVec( self, molIndex ):
+        # Returns array of d conc / d param for the output mol, with a 
+        # row for each plot time.
+        if not molIndex in self.sensOutputs:
+            raise ValueError( "Error: Sensitivities were not set up for mol index {}".format( molIndex ) )
+        i = self.sensOutputs.index( molIndex )
+        return np.array( [ v[i] for v in self.sensPlotvec ] ).reshape( -1, len( self.sensParams ) )
+
+    def initSens( self ):
+        # Only the concInit params directly affect the initial concs.
+        self.sens = np.zeros( ( len( self.molInfo ), len( self.sensParams ) ) )
+        for param, molIndex in self.concInitSens:
+            self.sens[molIndex, param] = 1.0
+
+    def recordSens( self ):
+        self.sensPlotvec.append( self.sens[ self.sensOutputs ] )
+
+    def reacSens( self, r, c, dt ):
+        # Carries d conc / d param through one update of r, using the 
+        # concs from before the update. The update is
+        #     new = e * old + ( 1 - e ) * ( concInf + baseline )
+        # with e = exp( -dt / tau ). dt == 0 is the estimate of the 
+        # initial value done in reinit.
+        cinf = r.concInf( c )
+        if dt == 0.0 and r.inhibit and cinf + r.baseline < 0.0:
+            self.sens[r.prdIndex] = 0.0 # Clamped to zero by reinit.
+            return
+        e = 0.0
+        dfDtau = 0.0
+        tauField = None
+        if dt > 0.0:
+            up = ( cinf - ( c[r.prdIndex] - r.baseline ) >= 0.0 )
+            tau = r.tau if up else r.tau2
+            tauField = "tau" if up else "tau2"
+            e = np.exp( -dt / tau )
+            dfDtau = -e * dt / ( tau * tau )
+        f = 1.0 - e
+        if dt > 0.0 or r.inhibit:
+            ci, dc, dp = r.concInfSens( c )
+        else:
+            dc, dp = [], {} # Initial value is just the baseline.
+        row = e * self.sens[r.prdIndex]
+        for index, val in dc:
+            row += ( f * val ) * self.sens[index]
+        for param, field in self.reacSensFields.get( r.name, [] ):
+            v = f * dp.get( field, 0.0 )
+            if field == "baseline":
+                v += f
+            elif field == tauField:
+                v += ( cinf + r.baseline - c[r.prdIndex] ) * dfDtau
+            row[param] += v
+        self.sens[r.prdIndex] = row
 
-    '''
-    def setConc( self, molName, val ):
-        assert( molName in self.molInfo )
-        idx = self.molInfo[ molName ].index
-        self.conc[idx] = val
-    '''
     def advance( self, runtime, settle = False ):
         if runtime < 10.0e-6:
             return
@@ -269,6 +698,8 @@ class Model():
             # if there are feedback processes. So to be conservative, 
             # do 10 steps. 
             self.innerAdvance( runtime, runtime / 10.0 )
+        elif len( self.groupDt ) > 1 and self.molComp is not None:
+            self.advanceGroups( runtime )
         else:
             newdt = min( self.dt, self.internalDt )
             adv = max( self.minTau * 10.0, self.dt )
@@ -282,6 +713,86 @@ class Model():
             else:   # all small dt
                 self.innerAdvance( runtime, newdt )
 
+    def advanceGroups( self, runtime ):
+        # Each group of reacs takes the steps that advance would give it on
+        # its own: steps from its own minTau at first, and then steps of dt.
+        # The step taken is the earliest one due among the groups, and the 
+        # others hold. All of them catch up for each sample and at the end.
+        n = len( self.groupDt )
+        h = [ min( self.dt, cdt ) for cdt in self.groupDt ]
+        adv = [ max( ct * 10.0, self.dt ) for ct in self.groupMinTau ]
+        for c in range( n ):
+            if h[c] >= runtime / 2.0:
+                h[c] = 10.0 ** ( np.floor( np.log10( runtime / 2.0 ) ) )
+                adv[c] = runtime
+            elif 2.0 * adv[c] >= runtime:
+                adv[c] = runtime
+        def nextStep( c, t ):
+            end = t + ( h[c] if t < adv[c] else self.dt )
+            if t < adv[c] and end > adv[c]:
+                end = adv[c]
+            return min( end, runtime )
+        last = [0.0] * n
+        nxt = [ nextStep( c, 0.0 ) for c in range( n ) ]
+        self.groupElapsed = [0.0] * n
+        t = 0.0
+        while t < runtime:
+            tNext = min( nxt )
+            doSample = np.floor( (self.currentTime + tNext)/ self.dt + 1.0e-9 ) > self.step
+            for c in range( n ):
+                if doSample or tNext >= runtime or nxt[c] <= tNext + 1.0e-9 * self.dt:
+                    self.groupElapsed[c] = tNext - last[c]
+                    last[c] = tNext
+                    nxt[c] = nextStep( c, tNext )
+                else:
+                    self.groupElapsed[c] = 0.0
+            self.stepReacs()
+            for val in self.sortedEqnInfo:
+                val.eval( self.conc )
+            if doSample:
+                self.step += 1
+                self.sample()
+            t = tNext
+        self.currentTime += runtime
+
+    def stepReacs( self ):
+        # Advances each reac by the time that its group is due to advance,
+        # in groupElapsed. Reacs of groups that are not due this step hold 
+        # their concs.
+        elapsed = self.groupElapsed
+        byGroup = self.molComp is not None
+        doSens = len( self.sensParams ) > 0
+        if self.replaying and self.tapeStep < len( self.tape ) and not doSens:
+            # Clean reacs take their products from the tape, at the 
+            # same point in the schedule as they were computed.
+            tv = self.tape[ self.tapeStep ]
+            self.tapeStep += 1
+            k = 0
+            for ar in self.sortedReacInfo:
+                for r in ar:
+                    h = elapsed[ r.group if byGroup else 0 ]
+                    if not r.name in self.replayDirty:
+                        self.conc[r.prdIndex] = tv[k]
+                    elif h > 0.0:
+                        r.eval( self, h )
+                    k += 1
+        else:
+            rec = None
+            if self.recording and not self.replaying:
+                rec = []
+                self.tape.append( rec )
+            for ar in self.sortedReacInfo:
+                for r in ar:
+                    h = elapsed[ r.group if byGroup else 0 ]
+                    if h > 0.0:
+                        if doSens:
+                            self.reacSens( r, self.conc, h )
+                        v = r.eval( self, h )
+                    else:
+                        v = self.conc[r.prdIndex]
+                    if rec is not None:
+                        rec.append( v )
+
     def innerAdvance( self, runtime, newdt ):
         # The above guarantees that newdt <= self.dt, except dose response
         t = 0.0
@@ -291,16 +802,17 @@ class Model():
                 newdt = runtime - t
 
             # Here we advance the simulation
-            for ar in self.sortedReacInfo:
-                for r in ar:
-                    r.eval( self, newdt )
+            self.groupElapsed = [ newdt ] * max( len( self.groupDt ), 1 )
+            self.stepReacs()
             for val in self.sortedEqnInfo:
                 val.eval( self.conc )
 
-            # Here we decide if we insert data into the plots.
-            if np.floor( (self.currentTime + t + newdt)/ self.dt ) > self.step:
+            # Here we decide if we insert data into the plots. The
+            # tolerance keeps the samples on the dt grid, as the summed
+            # internal steps can fall just short of it.
+            if np.floor( (self.currentTime + t + newdt)/ self.dt + 1.0e-9 ) > self.step:
                 self.step += 1
-                self.plotvec.append( np.array( self.conc ) )
+                self.sample()
             t += newdt
         self.currentTime += runtime
                 
@@ -314,32 +826,276 @@ class Model():
             return y * 2.0
         return y
 
-    def reinit( self ):
+    def reinit( self, full = False ):
         # ConcInit is evaluated only for reactions not explicitly defined.
+        # Unless full is set, only those that depend on a change since the
+        # last reinit are evaluated again.
         self.currentTime = 0
         self.step = 0
-        self.internalDt = self.dt
-        self.minTau = 1.0e20
-        for ar in self.sortedReacInfo:
-            for r in ar:
-                self.minTau = min( self.minTau, r.tau, r.tau2 )
-                if r.overrideConcInit:
-                    if r.inhibit:
-                        self.concInit[ r.prdIndex ] = r.concInf( self.concInit ) + r.baseline
-                        if self.concInit[r.prdIndex] < 0.0:
-                            self.concInit[r.prdIndex] = 0.0
-                    else:
-                        self.concInit[ r.prdIndex ] = r.baseline
-
-        if self.dt > INTERNAL_DT_SCALE * self.minTau:
-            self.internalDt = Model.neatRound( INTERNAL_DT_SCALE * self.minTau )
+        doSens = len( self.sensParams ) > 0
+        if doSens:
+            self.initSens()
+        if full or doSens or self.initConcInit is None or len( self.initConcInit ) != len( self.concInit ):
+            self.setTimesteps()
+            for ar in self.sortedReacInfo:
+                for r in ar:
+                    if r.overrideConcInit:
+                        if doSens:
+                            self.reacSens( r, self.concInit, 0.0 )
+                        self.evalConcInit( r )
+            self.initParams = { name: r.initParams() for name, r in self.reacInfo.items() }
+            self.initSettings = self.timestepSettings()
+        else:
+            self.updateConcInit()
+        self.initConcInit = np.array( self.concInit )
+
+        # A replay needs the same schedule and timesteps as the recording.
+        info = ( self.dt, self.internalDt, self.minTau, tuple( self.groupMinTau ), sum( [ len( ar ) for ar in self.sortedReacInfo ] ) )
+        self.tapeStep = 0
+        if self.replayDirty is not None:
+            self.replaying = len( self.tape ) > 0 and info == self.tapeInfo
+        else:
+            self.replaying = False
+            if self.recording:
+                self.tape = []
+                self.tapeInfo = info
 
         # need to explicitly make new array because Python defaults to 
         # shallow copy.
         # So if you change values in conc, they will change in concInit
         self.conc = np.array( self.concInit )
+        self.startSamples()
+
+    def evalConcInit( self, r ):
+        if r.inhibit:
+            self.concInit[ r.prdIndex ] = r.concInf( self.concInit ) + r.baseline
+            if self.concInit[r.prdIndex] < 0.0:
+                self.concInit[r.prdIndex] = 0.0
+        else:
+            self.concInit[ r.prdIndex ] = r.baseline
+
+    def updateConcInit( self ):
+        # Compares the reac params and concInits with those of the last 
+        # reinit. A reac is evaluated again if its params have changed, or
+        # the concInit of any of its subs or its prd. This goes in schedule
+        # order, so a change to a prd passes on to the reacs downstream.
+        # The timesteps are found again if a tau or a timestep setting has
+        # changed.
+        changed = self.concInit != self.initConcInit
+        settings = self.timestepSettings()
+        tauChanged = settings != self.initSettings
+        self.initSettings = settings
+        for ar in self.sortedReacInfo:
+            for r in ar:
+                p = r.initParams()
+                q = self.initParams.get( r.name )
+                if p != q:
+                    tauChanged = tauChanged or q is None or p[:2] != q[:2]
+                    self.initParams[ r.name ] = p
+                if not r.overrideConcInit:
+                    continue
+                subs = ( r.reagIndex, r.hillIndex, r.modIndex )
+                if p != q or changed[ r.prdIndex ] or any( changed[i] for i in subs if i != -1 ):
+                    self.evalConcInit( r )
+                    changed[ r.prdIndex ] = self.concInit[ r.prdIndex ] != self.initConcInit[ r.prdIndex ]
+        self.setTimesteps( tauChanged )
+
+    def timestepSettings( self ):
+        # The fields other than the taus that the timesteps depend on.
+        return ( self.dt, self.dtScale, self.multirate )
+
+    def restart( self, state ):
+        # Like reinit, but starts from the given concs, such as a snapshot
+        # of the model once settled, rather than from concInit.
+        if len( state ) != len( self.conc ):
+            raise ValueError( "Error: restart needs {} concs, got {}".format( len( self.conc ), len( state ) ) )
+        if len( self.sensParams ) > 0:
+            raise ValueError( "Error: restart does not support sensitivities" )
+        if self.recording or self.replayDirty is not None:
+            raise ValueError( "Error: restart does not support recording or replay" )
+        self.currentTime = 0
+        self.step = 0
+        self.setTimesteps()
+        self.replaying = False
+        self.tapeStep = 0
+        self.conc = np.array( state, dtype = float )
+        self.startSamples()
+
+    def setTimesteps( self, findMinTau = True ):
+        # dt should be < 0.25x smallest tau at input.
+        self.internalDt = self.dt
+        # The groups also depend on the timestep settings with multirate.
+        if findMinTau or self.groupSettings != self.timestepSettings():
+            if self.molComp is None:
+                self.findComponents()
+            self.assignGroups()
+            self.minTau = min( self.groupMinTau, default = 1.0e20 )
+        if self.dt > self.dtScale * self.minTau:
+            self.internalDt = Model.neatRound( self.dtScale * self.minTau )
+        self.groupDt = [ Model.neatRound( self.dtScale * ct ) if self.dt > self.dtScale * ct else self.dt for ct in self.groupMinTau ]
+
+    def findComponents( self ):
+        # Joins each scheduled reac and eqn with its subs, and numbers the
+        # resulting components in schedule order. A pruned model keeps the
+        # components, and so the timesteps, of its whole schedule, so that
+        # the reacs it runs step just as they would unpruned.
+        sri, sei = self.unprunedSched or ( self.sortedReacInfo, self.sortedEqnInfo )
+        root = list( range( len( self.molInfo ) ) )
+        def findRoot( i ):
+            while root[i] != i:
+                root[i] = root[ root[i] ]
+                i = root[i]
+            return i
+        links = [ ( r.prdIndex, [ self.molInfo[s].index for s in r.subs ] ) for ar in sri for r in ar ]
+        links += [ ( e.index, [ self.molInfo[s].index for s in e.subs ] ) for e in sei ]
+        for prd, subs in links:
+            for s in subs:
+                root[ findRoot( s ) ] = findRoot( prd )
+        rootComp = {}
+        self.molComp = [-1] * len( self.molInfo )
+        for prd, subs in links:
+            for i in [ prd ] + subs:
+                self.molComp[i] = rootComp.setdefault( findRoot( i ), len( rootComp ) )
+
+    def assignGroups( self ):
+        # Reacs step in groups, each with timesteps from its own minTau.
+        # Each component is a group, as it does not interact with the 
+        # others. With multirate, each component is split further by the 
+        # rate class of each reac, which is the internal timestep that its 
+        # own tau would give. The slower groups hold their concs while the 
+        # faster ones take their substeps. Like the components, the groups
+        # are those of the whole schedule when the model is pruned.
+        sri = self.unprunedSched[0] if self.unprunedSched else self.sortedReacInfo
+        ids = {}
+        self.groupMinTau = []
+        self.groupSettings = self.timestepSettings()
+        for ar in sri:
+            for r in ar:
+                tau = min( r.tau, r.tau2 )
+                rate = 0.0
+                if self.multirate:
+                    rate = Model.neatRound( self.dtScale * tau ) if self.dt > self.dtScale * tau else self.dt
+                key = ( self.molComp[ r.prdIndex ], rate )
+                if not key in ids:
+                    ids[key] = len( self.groupMinTau )
+                    self.groupMinTau.append( 1.0e20 )
+                r.group = ids[key]
+                self.groupMinTau[r.group] = min( self.groupMinTau[r.group], tau )
+
+    def pruneTo( self, outputs ):
+        # Schedules only the reacs and eqns upstream of the outputs, 
+        # through their subs, so that runs cost only as much as the part 
+        # of the model that they watch. The others hold their concs. Each 
+        # call starts from the schedule before the first one, and an empty
+        # list goes back to it.
+        if self.unprunedSched is None:
+            self.unprunedSched = ( self.sortedReacInfo, self.sortedEqnInfo )
+        sri, sei = self.unprunedSched
+        needed = set()
+        for name in outputs:
+            if not name in self.molInfo:
+                raise ValueError( "Error: Unknown output '{}' to prune to".format( name ) )
+            needed.add( name )
+        producers = { r.name: r for ar in sri for r in ar }
+        producers.update( { e.name: e for e in sei } )
+        frontier = list( needed )
+        while len( frontier ) > 0:
+            obj = producers.get( frontier.pop() )
+            if obj is None:
+                continue
+            for s in obj.subs:
+                if not s in needed:
+                    needed.add( s )
+                    frontier.append( s )
+
+        if len( outputs ) > 0:
+            self.sortedReacInfo = [ [ r for r in ar if r.name in needed ] for ar in sri ]
+            self.sortedReacInfo = [ ar for ar in self.sortedReacInfo if len( ar ) > 0 ]
+            self.sortedEqnInfo = [ e for e in sei if e.name in needed ]
+        else:
+            self.sortedReacInfo, self.sortedEqnInfo = sri, sei
+            self.unprunedSched = None
+        self.initConcInit = None
+        self.molComp = None
+
+    def getComponents( self ):
+        # Names of the reacs and eqns in each weakly connected component of
+        # the schedule, as of the last reinit.
+        if self.molComp is None:
+            raise ValueError( "Error: getComponents needs a reinit after the schedule changes" )
+        ret = [ [] for i in range( max( self.molComp, default = -1 ) + 1 ) ]
+        for ar in self.sortedReacInfo:
+            for r in ar:
+                ret[ self.molComp[ r.prdIndex ] ].append( r.name )
+        for e in self.sortedEqnInfo:
+            ret[ self.molComp[ e.index ] ].append( e.name )
+        # Components that were pruned away entirely are left out.
+        return [ c for c in ret if len( c ) > 0 ]
+
+    def getSCCs( self ):
+        # Strongly connected components of the scheduled reacs and eqns, 
+        # linked from each sub to its prd. Reacs in a feedback loop share a
+        # component. The components come in order from upstream to 
+        # downstream, so they form a DAG in that order.
+        n = len( self.molInfo )
+        out = [ [] for i in range( n ) ]
+        owner = [ None ] * n
+        for obj, prd in [ ( r, r.prdIndex ) for ar in self.sortedReacInfo for r in ar ] + [ ( e, e.index ) for e in self.sortedEqnInfo ]:
+            owner[prd] = obj.name
+            for s in obj.subs:
+                out[ self.molInfo[s].index ].append( prd )
+
+        # Tarjan's algorithm, which finds the components downstream first.
+        # It keeps its own stack of ( mol, next edge ) in place of recursion.
+        index = [-1] * n
+        low = [0] * n
+        onStack = [False] * n
+        stack = []
+        ret = []
+        counter = 0
+        for root in range( n ):
+            if index[root] >= 0:
+                continue
+            work = [ ( root, 0 ) ]
+            while len( work ) > 0:
+                v, i = work.pop()
+                if i == 0:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    stack.append( v )
+                    onStack[v] = True
+                elif i > 0:
+                    low[v] = min( low[v], low[ out[v][i-1] ] )
+                while i < len( out[v] ):
+                    w = out[v][i]
+                    i += 1
+                    if index[w] < 0:
+                        work.append( ( v, i ) )
+                        work.append( ( w, 0 ) )
+                        break
+                    elif onStack[w]:
+                        low[v] = min( low[v], index[w] )
+                else:
+                    if low[v] == index[v]:
+                        scc = []
+                        while True:
+                            w = stack.pop()
+                            onStack[w] = False
+                            if owner[w] is not None:
+                                scc.append( owner[w] )
+                            if w == v:
+                                break
+                        if len( scc ) > 0:
+                            ret.append( sorted( scc ) )
+        ret.reverse()
+        return ret
+
+    def startSamples( self ):
         del self.plotvec[:]
-        self.plotvec.append( np.array( self.conc ) )
+        self.sensPlotvec = []
+        self.numSamples = 0
+        self.scoreSq = [0.0] * len( self.scoreRefs )
+        self.sample()
 
     def getConcVec( self, molIndex ):
         return np.array( [ v[molIndex] for v in self.plotvec ] )
@@ -370,6 +1126,9 @@ class Model():
             self.sortedReacInfo = newsri
             self.sortedEqnInfo = [ val for key, val in self.eqnInfo.items() if not key in deleteList ]
         # If both lists are empty, retain original sortedReacInfo and sortedEqnInfo.
+        if len( saveList ) > 0 or len( deleteList ) > 0:
+            self.initConcInit = None
+            self.molComp = None
 
 def getQuantityScale( jsonDict ): 
     qu = jsonDict.get( "QuantityUnits" )
@@ -595,6 +1354,9 @@ def sortReacs( model ):
 
     maxOrder += 1
     model.sortedReacInfo = [[] for i in range( maxOrder )]
+    model.initConcInit = None
+    model.molComp = None
+    model.unprunedSched = None
     for name, reac in model.reacInfo.items():
         order = model.molInfo[name].order
         model.sortedReacInfo[order].append( reac )
@@ -631,6 +1393,8 @@ def main():
     parser.add_argument( '-s', '--stimulus', type = str, nargs = '+', action='append', help='Optional: Deliver stimulus as follows: --stimulus molecule conc [start [stop]]. Any number of stimuli may be given, each indicated by --stimulus. By default: start = 0, stop = runtime', default = [] )
     parser.add_argument( '-p', '--plots', type = str, help='Optional: plot just the specified molecule(s). The names are specified by a comma-separated list.', default = "" )
     parser.add_argument( '-o', '--output', type = str, metavar = "fname", help='Optional: Generate an output tab-separated text file with columns of time conc1 conc2 and so on.' )
+    parser.add_argument( '-m', '--multirate', action='store_true', help='Flag: Step each reac at the rate its own tau gives, rather than all of them at the rate of the fastest. Slow reacs hold their values between their steps.' )
+    parser.add_argument( '-v', '--validate', action='store_true', help='Flag: Run the model both single-rate and multirate, and report the largest difference of each molecule as a fraction of its range, and the run times. The plots show the multirate run.' )
     args = parser.parse_args()
     jsonDict = loadHillTau( args.model )
     qs = getQuantityScale( jsonDict )
@@ -670,16 +1434,35 @@ def main():
     stimvec.sort( key = Stim.stimOrder )
     model.modifySched( saveList = [], deleteList = list( set( stimMolNames )) )
 
-    model.reinit()
-    currTime = 0.0
-    for s in stimvec:
-        model.advance( s.time - currTime )
-        model.conc[s.mol.index] = s.value
-        currTime = s.time
-    if runtime > currTime:
-        model.advance( runtime - currTime )
-
-    plotvec = np.transpose( np.array( model.plotvec ) )
+    def runStims():
+        model.reinit()
+        currTime = 0.0
+        for s in stimvec:
+            model.advance( s.time - currTime )
+            model.conc[s.mol.index] = s.value
+            currTime = s.time
+        if runtime > currTime:
+            model.advance( runtime - currTime )
+        return np.transpose( np.array( model.plotvec ) )
+
+    if args.validate:
+        t0 = time.time()
+        model.multirate = False
+        ref = runStims()
+        t1 = time.time()
+        model.multirate = True
+        plotvec = runStims()
+        t2 = time.time()
+        print( "Run time: single-rate = {:.4g} s, multirate = {:.4g} s".format( t1 - t0, t2 - t1 ) )
+        print( "Largest multirate difference as a fraction of range:" )
+        for name in sorted( model.molInfo ):
+            i = model.molInfo[name].index
+            rng = np.ptp( ref[i] )
+            err = np.max( np.abs( plotvec[i] - ref[i] ) )
+            print( "{:<24s}{:.3g}".format( name, err / rng if rng > 0 else err ) )
+    else:
+        model.multirate = args.multirate
+        plotvec = runStims()
     x = np.array( range( plotvec.shape[1] ) ) * model.dt
     clPlots = args.plots.split(',')
     if len( args.plots ) > 0 :
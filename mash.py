@@ -32,15 +32,23 @@
 from __future__ import print_function
 import sys
 import os
-from scipy.optimize import minimize
+import hashlib
+import tempfile
+import pickle
+from scipy.optimize import minimize, differential_evolution, lsq_linear, OptimizeResult
 import json
 import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
-import moose
-import moose.model_utils as mu
+try:
+    import moose
+    import moose.model_utils as mu
+except ImportError:
+    moose = None # The sbml reference backend does not need MOOSE.
 import hillTau
+import sbmlSim
 
 t1 = 20
 t2 = 60
@@ -51,6 +59,8 @@ plotDt = 1
 stimVec = [[0, 0.0, 20.0], [0, 1e-3, 40.0], [0, 0, 40.0]]
 stimRange = [ 0.1, 0.2, 0.5, 1, 2.0, 5.0, 10.0 ]
 settleTimeScale = stimRange[-1]  # How much longer is settleTime than midTime?
+FD_STEP = np.sqrt( np.finfo( float ).eps ) # Relative step for FD gradients
+MAX_DT_SCALE = 0.2 # Coarsest internal timestep, as a fraction of minTau
 
 class Stim:
     ### Advance to specified time, and then set the conc to the stim value.
@@ -61,67 +71,366 @@ class Stim:
         self.time = time
         self.molIndex = 0
 
+class Protocol:
+    ### Stimulus protocol compiled into arrays sorted by time. Event i sets
+    ### the conc of mols[ molIds[i] ] to values[i] at times[i]. A negative
+    ### value means the initial conc of the molecule in the HillTau model.
+    ### The events may be split into segments, each a separate stimulus
+    ### such as a dose-response or a train of cycles.
+    def __init__( self, events, segments = None ):
+        # Each event is a tuple of ( mol, conc, time ). Each segment is a
+        # tuple of ( index of first event, start time ), in order.
+        self.mols = sorted( set( [ e[0] for e in events ] ) )
+        ids = { m:i for i, m in enumerate( self.mols ) }
+        times = np.array( [ e[2] for e in events ], dtype = float )
+        order = np.argsort( times, kind = "stable" )
+        self.times = times[order]
+        self.molIds = np.array( [ ids[e[0]] for e in events ], dtype = int )[order]
+        self.values = np.array( [ e[1] for e in events ], dtype = float )[order]
+        if not segments:
+            segments = [ ( 0, 0.0 ) ]
+        first = [ s[0] for s in segments ]
+        segIds = np.searchsorted( first, np.arange( len( events ) ), side = "right" ) - 1
+        self.segIds = segIds[order]
+        self.segStarts = np.array( [ s[1] for s in segments ], dtype = float )
+
+    @property
+    def numSegments( self ):
+        return len( self.segStarts )
+
+    def segment( self, k, offset = 0.0 ):
+        # Protocol of the events of segment k alone, with times measured
+        # from the start of the segment, plus offset. The times are 
+        # rounded so that the shift does not leave them a hair short of
+        # a plot time, which would change the number of samples.
+        sel = ( self.segIds == k )
+        times = np.round( self.times[sel] - self.segStarts[k] + offset, 9 )
+        return Protocol( [ ( self.mols[m], v, t ) for m, v, t in zip( self.molIds[sel].tolist(), self.values[sel].tolist(), times.tolist() ) ] )
+
+    def __len__( self ):
+        return len( self.times )
+
+    def mooseEvents( self ):
+        # List of [ mooseMol, conc, time ] for each event.
+        names = [ getMooseName( m ) for m in self.mols ]
+        return [ [ names[m], v, t ] for m, v, t in zip( self.molIds.tolist(), self.values.tolist(), self.times.tolist() ) ]
+
+    def hillTauArrays( self, model ):
+        # Returns the arrays of mol index and value for each event, as 
+        # used by model.runProtocol.
+        index = []
+        concInit = []
+        for m in self.mols:
+            mi = model.molInfo.get( getHillTauName( m ) )
+            if not mi:
+                raise ValueError( "Nonexistent stimulus molecule: ", getHillTauName( m ) )
+            index.append( mi.index )
+            concInit.append( mi.concInit )
+        if len( self.mols ) == 0:
+            return np.zeros( 0, dtype = np.uint32 ), np.zeros( 0 )
+        values = np.where( self.values < 0, np.array( concInit )[self.molIds], self.values )
+        return np.array( index, dtype = np.uint32 )[self.molIds], values
+
 class Mash:
-    def __init__( self, model, reference, params, outputMolNames, stimVec, jsonDict ):
+    def __init__( self, model, reference, params, outputMolNames, protocol, jsonDict ):
         self.model = model
         self.reference = reference
         self.params = params
         htNames = [ getHillTauName( i ) for i in outputMolNames ]
         self.plotnum = { i:model.molInfo[ i ].index for i in htNames }
-        self.stimVec = stimVec
+        # Only the outputs are scored, so the runs skip the rest. This 
+        # leaves the outputs exactly as they would be unpruned.
+        model.pruneTo( htNames )
+        self.protocol = protocol
+        self.stimIndex, self.stimValues = protocol.hillTauArrays( model )
+        self.cycleTol = 0.0 # Tolerance for skipping steady stimulus cycles
+        self.numSkippedCycles = 0
         self.jsonDict = jsonDict
         self.numIter = 0
         self.simt = 0
         self.molMap = { getMooseName(i):getHillTauName(i) for i in outputMolNames }
+        self.sensParams = []
+        self.sensEnabled = False
+        self.sensLinks = []
+        self.numReplay = 0
+        self.reinitt = 0.0  # Times taken by the parts of the last run
+        self.advancet = 0.0
+        self.telemetry = ""
+        self.telemetryFile = None
+        self.telemetryPid = None
+        # Differences from the reference are scaled by its full range.
+        self.fullReference = reference
+        self.refRange = { name: max( ref ) for name, ref in reference.items() }
+        self.baseDt = model.dt
+        self.baseDtScale = model.dtScale
+        self.setResolution( 1 )
+        model.storePlots = False
+
+    def setResolution( self, factor ):
+        # Samples the runs every factor plot times, and scores them 
+        # against the reference at those times. The model scores each run
+        # as it goes, so the optimizer's runs need not store the 
+        # trajectories. HillTau's run time is set by its internal 
+        # timestep rather than the plot interval, so that is coarsened 
+        # too, up to the 0.2 * minTau that the engine treats as its limit.
+        self.resolution = factor
+        self.reference = { name: ref[::factor] for name, ref in self.fullReference.items() }
+        self.model.dt = self.baseDt * factor
+        self.model.dtScale = self.dtScaleFor( factor )
+        self.model.clearScoreRefs()
+        for name, ref in self.reference.items():
+            self.model.addScoreRef( self.plotnum[ self.molMap[name] ], ref, 1.0 / self.refRange[name] )
+
+    def dtScaleFor( self, factor ):
+        return min( self.baseDtScale * factor, max( self.baseDtScale, MAX_DT_SCALE ) )
+
+    @property
+    def params( self ):
+        return self._params
+
+    @params.setter
+    def params( self, params ):
+        # The binding writes all the params into the model in one call, 
+        # and also assigns tau2 along with tau when they are equal. The 
+        # base values are those of the unscaled model, which the
+        # optimizer's x scales.
+        self._params = list( params )
+        self.binding = self.model.bindParams( self._params )
+        self.baseValues = self.binding.getParams()
 
     def scaleParams( self, x ):
-        for i, scaleFactor in zip( self.params, x ):
-            spl = i.rsplit( '.' ,1)
-            assert( len(spl) == 2 )
-            obj, field = spl
-            if field == "concInit" or field == "conc":
-                mi = self.model.molInfo[ obj ]
-                mi.concInit *= scaleFactor
-                self.model.concInit[ mi.index ] *= scaleFactor
-            elif field == "tau": 
-                # handle implicit assignment of tau2 when they are equal.
-                ri = self.model.reacInfo[ obj ]
-                if np.isclose( ri.tau, ri.tau2 ):
-                    ri.tau = ri.tau2 = ri.tau * scaleFactor
-                else:
-                    ri.tau = ri.tau * scaleFactor
-            else:
-                orig = getattr( self.model.reacInfo[ obj ], field )
-                setattr( self.model.reacInfo[ obj ], field, orig * scaleFactor )
+        self.binding.setParams( self.baseValues * np.asarray( x, dtype = float ) )
 
-    def doRun(self, x ):
+    def simulate( self, x ):
+        # Runs the stimulus protocol with the params scaled by x.
         self.scaleParams( x )
         t0 = time.time()
         self.model.reinit()
-        lastt = 0.0
-        for stim in self.stimVec:
-            self.model.advance( stim.time - lastt )
-            self.model.conc[ stim.molIndex ] = stim.conc
-            lastt = stim.time
-        self.simt += time.time() - t0
+        t1 = time.time()
+        self.model.runProtocol( self.protocol.times, self.stimIndex, self.stimValues, self.cycleTol )
+        self.numSkippedCycles += self.model.numSkippedCycles
+        t2 = time.time()
+        self.reinitt = t1 - t0
+        self.advancet = t2 - t1
+        self.simt += t2 - t0
+        if self.sensEnabled:
+            self.sensVals = self.paramValues()
+        self.binding.setParams( self.baseValues )
+        self.numIter += 1
+
+    def doRun(self, x ):
+        # Runs and returns the output trajectories, for plotting and for
+        # the scores that need them.
+        self.model.storePlots = True
+        try:
+            self.simulate( x )
+        finally:
+            self.model.storePlots = False
         #nt = np.transpose( np.array( self.model.plotvec ) )
         #ret = { name:nt[index] for name, index in self.plotnum.items() }
         ret = { name:self.model.getConcVec( index ) for name, index in self.plotnum.items() }
-        self.scaleParams( 1.0/x )
-        self.numIter += 1
+        if self.sensEnabled:
+            self.sensOut = { name:self.model.getSensVec( index ) for name, index in self.plotnum.items() }
         return ret
 
+    def residuals( self, outDict ):
+        # Differences of the outputs from the reference, scaled so that
+        # the score is the norm of the differences.
+        ret = []
+        for name, ref in self.reference.items():
+            yrange = self.refRange[name]
+            ret.append( ( np.asarray( outDict[self.molMap[name]] ) - ref ) / ( yrange * np.sqrt( len( ref ) ) ) )
+        return np.concatenate( ret )
+
     def doScore( self, outDict ):
+        r = self.residuals( outDict )
+        return np.sqrt( np.dot( r, r ) )
+
+    def doResiduals( self, x ):
+        self.enableSens( False )
+        outDict = self.doRun( x )
+        t0 = time.time()
+        ret = self.residuals( outDict )
+        self.logEval( x, np.sqrt( np.dot( ret, ret ) ), time.time() - t0 )
+        return ret
+
+    def getScore( self ):
+        # Score of the last run, which the model computed as it went.
+        return self.model.getScore()
+
+    def doEval( self, x ):
+        self.enableSens( False )
+        self.simulate( x )
+        t0 = time.time()
+        score = self.getScore()
+        self.logEval( x, score, time.time() - t0 )
+        return score
+
+    def setTelemetry( self, fname ):
+        # Each evaluation is logged as a line of JSON to fname, by 
+        # whichever process does it. An empty fname turns this off.
+        self.telemetry = fname
+        self.telemetryFile = None
+
+    def logEval( self, x, score, scoret ):
+        if len( self.telemetry ) == 0:
+            return
+        # Worker processes open their own handle on the file.
+        if self.telemetryPid != os.getpid():
+            self.telemetryFile = open( self.telemetry, "a", buffering = 1 )
+            self.telemetryPid = os.getpid()
+        rec = { "time": time.time(), "worker": os.getpid(), 
+            "reinit": self.reinitt, "simulate": self.advancet, 
+            "score": scoret, "value": float( score ), 
+            "params": [ float( i ) for i in x ] }
+        self.telemetryFile.write( json.dumps( rec ) + "\n" )
+
+    def __getstate__( self ):
+        # File handles do not go to the workers.
+        ret = dict( self.__dict__ )
+        ret["telemetryFile"] = None
+        ret["telemetryPid"] = None
+        # The binding refers into the model, so it is made afresh.
+        del ret["binding"]
+        return ret
+
+    def __setstate__( self, state ):
+        self.__dict__.update( state )
+        self.binding = self.model.bindParams( self._params )
+
+    def evalChunk( self, x, indices, h ):
+        # Scores x, and then x with each of the params in indices stepped
+        # by h. Each stepped run only evaluates the reacs downstream of 
+        # its param, and replays the rest from the run at x.
+        self.model.setRecording( True )
+        try:
+            scores = [ self.doEval( x ) ]
+            for i in indices:
+                xp = np.array( x )
+                xp[i] += h[i]
+                self.model.setReplay( [ self.params[i].rsplit( '.', 1 )[0] ] )
+                scores.append( self.doEval( xp ) )
+                self.numReplay += int( self.model.replaying )
+        finally:
+            self.model.setRecording( False )
+        return scores
+
+    def upstreamMols( self ):
+        # Names of all the mols that can influence the monitored outputs.
+        reacInfo = self.model.reacInfo
+        eqnInfo = self.model.eqnInfo
+        ret = set( self.plotnum.keys() )
+        frontier = list( ret )
+        while len( frontier ) > 0:
+            name = frontier.pop()
+            if name in reacInfo:
+                subs = reacInfo[ name ].subs
+            elif name in eqnInfo:
+                subs = eqnInfo[ name ].subs
+            else:
+                continue
+            for i in subs:
+                if not i in ret:
+                    ret.add( i )
+                    frontier.append( i )
+        return ret
+
+    def outputChange( self, out0, out1 ):
+        # RMS change in the outputs, as a fraction of the reference range.
         sq = 0.0
         for name, ref in self.reference.items():
-            yrange = max( ref )
-            y = ( outDict[self.molMap[name]] - ref ) / yrange
-            sq += np.dot( y, y ) / len( ref )
-        return np.sqrt( sq )
+            hname = self.molMap[name]
+            y = ( np.array( out1[hname] ) - np.array( out0[hname] ) ) / max( ref )
+            sq += np.dot( y, y ) / len( y )
+        return np.sqrt( sq / len( self.reference ) )
 
-    def doEval( self, x ):
-        ret = self.doRun( x )
-        return self.doScore( ret )
+    def screenParams( self, threshold, step = 0.1 ):
+        # Drops the params that are not upstream of the outputs, and then
+        # those for which a step of the param changes the outputs by less
+        # than threshold. Returns a list of ( param, reason ) for each 
+        # dropped param.
+        upstream = self.upstreamMols()
+        dropped = []
+        for i in self.params:
+            if not i.rsplit( '.', 1 )[0] in upstream:
+                dropped.append( ( i, "not upstream of outputs" ) )
+        skip = set( [ i[0] for i in dropped ] )
+        x0 = np.ones( len( self.params ) )
+        # The stepped runs only evaluate what is downstream of the param.
+        self.model.setRecording( True )
+        try:
+            out0 = self.doRun( x0 )
+            for i, p in enumerate( self.params ):
+                if p in skip:
+                    continue
+                x = np.array( x0 )
+                x[i] += step
+                self.model.setReplay( [ p.rsplit( '.', 1 )[0] ] )
+                change = self.outputChange( out0, self.doRun( x ) )
+                if change < threshold:
+                    dropped.append( ( p, "output change {:.3g} for a {:g}% step".format( change, step * 100 ) ) )
+        finally:
+            self.model.setRecording( False )
+        skip = set( [ i[0] for i in dropped ] )
+        self.params = [ i for i in self.params if not i in skip ]
+        return dropped
+
+    def paramValues( self ):
+        return self.binding.getParams()
+
+    def setupSens( self ):
+        # Asks the model to compute sensitivities of the outputs to the 
+        # params. Returns False if it cannot do so.
+        # When tau and tau2 are equal, scaleParams scales both of them, 
+        # so the tau2 sensitivity is added on to that of tau.
+        sensParams = list( self.params )
+        sensLinks = []
+        for i, p in enumerate( self.params ):
+            obj, field = p.rsplit( '.', 1 )
+            if field == "tau":
+                ri = self.model.reacInfo[ obj ]
+                if np.isclose( ri.tau, ri.tau2 ):
+                    sensLinks.append( ( i, len( sensParams ) ) )
+                    sensParams.append( obj + ".tau2" )
+        try:
+            self.model.setSens( sensParams, list( self.plotnum.values() ) )
+        except ValueError as e:
+            print( "{}. Using finite-difference gradients.".format( e ) )
+            return False
+        self.model.setSens( [], [] )
+        self.sensParams = sensParams
+        self.sensLinks = sensLinks
+        return True
+
+    def enableSens( self, flag ):
+        # Sensitivities are only computed for the runs that need gradients.
+        if len( self.sensParams ) == 0 or flag == self.sensEnabled:
+            return
+        self.model.setSens( self.sensParams if flag else [], list( self.plotnum.values() ) )
+        self.sensEnabled = flag
+
+    def doEvalAndGrad( self, x ):
+        # Returns the score and its exact gradient with respect to x, 
+        # from the sensitivities computed along with the run.
+        self.enableSens( True )
+        outDict = self.doRun( x )
+        t0 = time.time()
+        sq = 0.0
+        dsq = np.zeros( len( self.sensParams ) )
+        for name, ref in self.reference.items():
+            yrange = self.refRange[name]
+            hname = self.molMap[name]
+            y = ( outDict[hname] - ref ) / yrange
+            sq += np.dot( y, y ) / len( ref )
+            dsq += 2.0 * np.dot( y, self.sensOut[hname] ) / ( yrange * len( ref ) )
+        score = np.sqrt( sq )
+        if score > 0.0:
+            dsq /= 2.0 * score
+        for i, j in self.sensLinks:
+            dsq[i] += dsq[j]
+        self.logEval( x, score, time.time() - t0 )
+        # Params are scale factors on the values used in the run.
+        return score, dsq[:len( self.params )] * self.sensVals / x
 
     def dumpScaledFile( self, x, fname ):
         # This is significantly more complicated because the values may
@@ -159,12 +468,611 @@ class Mash:
         with open( fname, 'w' ) as f:
             json.dump( jd, f, indent = 4 )
 
+class BatchedMash( Mash ):
+    ### Runs each segment of the protocol as its own experiment, starting
+    ### from a snapshot of the model settled at baseline, rather than as
+    ### one long run. Each segment runs on its own clone of the model, on
+    ### a thread of its own, so an evaluation takes about as long as the
+    ### settling and the longest segment. The scores of the segments are
+    ### combined with the weights, which by default are in proportion to
+    ### their lengths, so that the score is that of the segments end to 
+    ### end. The reference holds the segments end to end too.
+    def __init__( self, model, references, params, outputMolNames, protocol, jsonDict, settleTime, weights = None ):
+        self.settleTime = settleTime
+        self.segProtocols = [ protocol.segment( k ) for k in range( protocol.numSegments ) ]
+        self.segModels = []
+        self.segReferences = references
+        reference = { name: np.concatenate( [ r[name] for r in references ] ) for name in references[0] }
+        Mash.__init__( self, model, reference, params, outputMolNames, protocol, jsonDict )
+        # The segments run on clones of the model as set up above, so 
+        # that they run just as it would.
+        self.segModels = [ model.clone() for p in self.segProtocols ]
+        self.segStims = [ p.hillTauArrays( m ) for m, p in zip( self.segModels, self.segProtocols ) ]
+        self.params = self._params
+        self.setResolution( 1 )
+        if weights is None:
+            weights = self.segLengths
+        if len( weights ) != len( references ):
+            raise ValueError( "Error: Expected {} segment weights, got {}".format( len( references ), len( weights ) ) )
+        self.weights = np.array( weights, dtype = float ) / np.sum( weights )
+        for m in self.segModels:
+            m.storePlots = False
+        self.executor = None
+        self.executorPid = None
+
+    @Mash.params.setter
+    def params( self, params ):
+        Mash.params.fset( self, params )
+        self.segBindings = [ m.bindParams( self._params ) for m in self.segModels ]
+
+    def setResolution( self, factor ):
+        # The base model only settles, and the segment models score.
+        self.resolution = factor
+        refs = [ { name: vec[::factor] for name, vec in r.items() } for r in self.segReferences ]
+        self.reference = { name: np.concatenate( [ r[name] for r in refs ] ) for name in refs[0] }
+        self.segLengths = [ len( next( iter( r.values() ) ) ) for r in refs ]
+        self.model.dt = self.baseDt * factor
+        self.model.dtScale = self.dtScaleFor( factor )
+        self.model.clearScoreRefs()
+        for m, ref in zip( self.segModels, refs ):
+            m.dt = self.baseDt * factor
+            m.dtScale = self.model.dtScale
+            m.clearScoreRefs()
+            for name, vec in ref.items():
+                m.addScoreRef( self.plotnum[ self.molMap[name] ], vec, 1.0 / self.refRange[name] )
+
+    def __getstate__( self ):
+        ret = Mash.__getstate__( self )
+        del ret["segBindings"]
+        ret["executor"] = None
+        ret["executorPid"] = None
+        return ret
+
+    def __setstate__( self, state ):
+        Mash.__setstate__( self, state )
+        self.segBindings = [ m.bindParams( self._params ) for m in self.segModels ]
+
+    def runSegment( self, k, values, state ):
+        model = self.segModels[k]
+        self.segBindings[k].setParams( values )
+        model.restart( state )
+        stimIndex, stimValues = self.segStims[k]
+        model.runProtocol( self.segProtocols[k].times, stimIndex, stimValues, self.cycleTol )
+        return model.numSkippedCycles
+
+    def simulate( self, x ):
+        values = self.baseValues * np.asarray( x, dtype = float )
+        self.binding.setParams( values )
+        t0 = time.time()
+        self.model.reinit()
+        self.model.advance( self.settleTime, True )
+        state = np.array( self.model.conc )
+        t1 = time.time()
+        # Forked worker processes do not inherit the threads.
+        if self.executorPid != os.getpid():
+            self.executor = ThreadPoolExecutor( max_workers = len( self.segModels ) )
+            self.executorPid = os.getpid()
+        runs = [ self.executor.submit( self.runSegment, k, values, state ) for k in range( len( self.segModels ) ) ]
+        self.numSkippedCycles += sum( [ r.result() for r in runs ] )
+        t2 = time.time()
+        self.reinitt = t1 - t0
+        self.advancet = t2 - t1
+        self.simt += t2 - t0
+        self.binding.setParams( self.baseValues )
+        self.numIter += 1
+
+    def doRun( self, x ):
+        for m in self.segModels:
+            m.storePlots = True
+        try:
+            self.simulate( x )
+        finally:
+            for m in self.segModels:
+                m.storePlots = False
+        return { name: np.concatenate( [ m.getConcVec( index ) for m in self.segModels ] ) for name, index in self.plotnum.items() }
+
+    def getScore( self ):
+        scores = np.array( [ m.getScore() for m in self.segModels ] )
+        return np.sqrt( np.dot( self.weights, scores * scores ) )
+
+    def residuals( self, outDict ):
+        # Each segment is scaled by its weight as well as its length.
+        bounds = np.cumsum( [ 0 ] + self.segLengths )
+        ret = []
+        for name, ref in self.reference.items():
+            y = ( np.asarray( outDict[self.molMap[name]] ) - ref ) / self.refRange[name]
+            for k, w in enumerate( self.weights ):
+                lo, hi = bounds[k], bounds[k+1]
+                ret.append( y[lo:hi] * np.sqrt( w / ( hi - lo ) ) )
+        return np.concatenate( ret )
+
+    def setupSens( self ):
+        # The settled snapshot does not carry sensitivities.
+        print( "Batched segments use finite-difference gradients." )
+        return False
+
+# Each worker process holds its own copy of the Mash, and hence the model.
+workerMash = None
+
+def initWorker( mash ):
+    global workerMash
+    workerMash = mash
+
+def makePool( mash, numWorkers ):
+    # Each worker is initialized with a pickled copy of the Mash, so it
+    # does not have to parse the model again.
+    if numWorkers > 1:
+        return ProcessPoolExecutor( max_workers = numWorkers, 
+            initializer = initWorker, initargs = ( mash, ) )
+    return None
+
+def workerEval( x ):
+    t0 = time.time()
+    simt = workerMash.simt
+    score = workerMash.doEval( x )
+    return score, workerMash.simt - simt, time.time() - t0
+
+def workerResiduals( x ):
+    t0 = time.time()
+    simt = workerMash.simt
+    ret = workerMash.doResiduals( x )
+    return ret, workerMash.simt - simt, time.time() - t0
+
+def workerEvalChunk( args ):
+    t0 = time.time()
+    simt = workerMash.simt
+    numReplay = workerMash.numReplay
+    scores = workerMash.evalChunk( *args )
+    return scores, workerMash.simt - simt, time.time() - t0, workerMash.numReplay - numReplay
+
+class FDGradient:
+    ### Computes the score and its finite-difference gradient with respect
+    ### to the params. The perturbed param sets are split into chunks, 
+    ### which are evaluated concurrently on a pool of worker processes, 
+    ### each with a copy of the Mash.
+    def __init__( self, mash, bounds, numWorkers, pool = None ):
+        self.mash = mash
+        self.lo = np.array( [ b[0] for b in bounds ] )
+        self.hi = np.array( [ b[1] for b in bounds ] )
+        self.numWorkers = numWorkers
+        self.pool = pool
+        self.numGrad = 0
+        self.numStepped = 0
+        self.wallt = 0.0    # Wall-clock time spent evaluating gradients
+        self.evalt = 0.0    # Summed time of the individual evaluations
+
+    def evalSteps( self, x, h ):
+        # Returns the score at x followed by that for each stepped param.
+        t0 = time.time()
+        indices = np.arange( len( x ) )
+        if self.pool:
+            # Each chunk also has to score x, to record its own base run.
+            chunks = [ c for c in np.array_split( indices, self.numWorkers ) if len( c ) > 0 ]
+            ret = list( self.pool.map( workerEvalChunk, [ ( x, c, h ) for c in chunks ] ) )
+            scores = ret[0][0][:1]
+            for i in ret:
+                scores.extend( i[0][1:] )
+                self.mash.numIter += len( i[0] )
+                self.mash.simt += i[1]
+                self.evalt += i[2]
+                self.mash.numReplay += i[3]
+        else:
+            scores = self.mash.evalChunk( x, indices, h )
+            self.evalt += time.time() - t0
+        self.numStepped += len( x )
+        self.wallt += time.time() - t0
+        return scores
+
+    def __call__( self, x ):
+        # Forward differences, switching to backward differences where 
+        # the step would cross the upper bound.
+        h = FD_STEP * np.maximum( 1.0, np.abs( x ) )
+        h = np.where( x + h > self.hi, -h, h )
+        scores = self.evalSteps( x, h )
+        self.numGrad += 1
+        grad = ( np.array( scores[1:] ) - scores[0] ) / h
+        return scores[0], grad
+
+CHECKPOINT_VERSION = 2
+
+class Checkpoint:
+    ### Saves the reference outputs, the params being fitted, the random
+    ### seed and the history of evaluations to a file. The optimizers are
+    ### deterministic given these, so a resumed run repeats the same 
+    ### steps, taking the results in the history rather than simulating
+    ### them, and goes on from where the saved run stopped. Each entry
+    ### records the resolution it was run at, as set by stage.
+    def __init__( self, fname, interval, signature ):
+        self.fname = fname
+        self.interval = interval
+        self.signature = signature
+        self.reference = None
+        self.params = None
+        self.seed = None
+        self.history = []   # [ ( kind, x, result, stage ) ] in order of evaluation
+        self.cache = {}
+        self.stage = 1
+        self.bestx = None
+        self.best = np.inf
+        self.numHits = 0
+        self.lastSave = time.time()
+
+    def load( self ):
+        if not os.path.isfile( self.fname ):
+            raise ValueError( "Error: Checkpoint file '{}' not found".format( self.fname ) )
+        with open( self.fname, "rb" ) as f:
+            data = pickle.load( f )
+        if data.get( "version" ) != CHECKPOINT_VERSION:
+            raise ValueError( "Error: Checkpoint '{}' is from an incompatible version of mash".format( self.fname ) )
+        if data["signature"] != self.signature:
+            raise ValueError( "Error: Checkpoint '{}' was made with different models, stimuli or optimization settings".format( self.fname ) )
+        self.reference = data["reference"]
+        self.params = data["params"]
+        self.seed = data["seed"]
+        self.history = []
+        self.cache = {}
+        for kind, x, result, stage in data["history"]:
+            self.add( kind, x, result, stage )
+
+    def save( self ):
+        data = { "version": CHECKPOINT_VERSION, "signature": self.signature,
+            "reference": self.reference, "params": self.params,
+            "seed": self.seed, "history": self.history,
+            "bestx": self.bestx, "best": self.best }
+        # Write to a temporary file first, so a kill never leaves a
+        # partial checkpoint.
+        fd, tmp = tempfile.mkstemp( dir = os.path.dirname( os.path.abspath( self.fname ) ), suffix = ".tmp" )
+        with os.fdopen( fd, "wb" ) as f:
+            pickle.dump( data, f )
+        os.replace( tmp, self.fname )
+        self.lastSave = time.time()
+
+    def add( self, kind, x, result, stage ):
+        x = np.array( x, dtype = float )
+        self.history.append( ( kind, x, result, stage ) )
+        self.cache[ ( kind, x.tobytes(), stage ) ] = result
+        if kind == "eval":
+            score = result
+        elif kind == "grad":
+            score = result[0]
+        elif kind == "resid":
+            score = np.sqrt( np.dot( result, result ) )
+        else:
+            score = result.fun
+        if score < self.best:
+            self.best = score
+            self.bestx = x if kind != "local" else np.array( result.x )
+
+    def lookup( self, kind, x ):
+        ret = self.cache.get( ( kind, np.array( x, dtype = float ).tobytes(), self.stage ) )
+        if ret is not None:
+            self.numHits += 1
+        return ret
+
+    def store( self, kind, x, result ):
+        self.add( kind, x, result, self.stage )
+        if time.time() - self.lastSave >= self.interval:
+            self.save()
+
+    def wrap( self, kind, func ):
+        # Returns func, with its results taken from or stored in the 
+        # history.
+        def cached( x ):
+            ret = self.lookup( kind, x )
+            if ret is None:
+                ret = func( x )
+                if kind == "grad":
+                    ret = ( ret[0], np.array( ret[1] ) )
+                self.store( kind, x, ret )
+            return ret
+        return cached
+
+def runSignature( args, protocol ):
+    # Hash of everything that determines the course of the optimization.
+    h = hashlib.sha256()
+    h.update( referenceKey( args.chemModel, protocol, args.monitor, args.reference ).encode() )
+    with open( args.HillTauModel, 'rb' ) as f:
+        h.update( f.read() )
+    settings = [ args.addParams, args.removeParams, args.tolerance, 
+        args.gradient, args.method, args.popsize, args.maxiter, 
+        args.patience, args.screen, args.skip_cycles, args.batched,
+        args.segment_weights, args.multires ]
+    h.update( json.dumps( settings ).encode() )
+    return h.hexdigest()
+
+class PopulationEvaluator:
+    ### Scores a population of param sets, concurrently on the worker pool
+    ### if there is one. Keeps track of the best set seen so far. Members
+    ### already in the checkpoint history are not evaluated again. It can
+    ### also return the residuals for each set, rather than the score.
+    def __init__( self, mash, numWorkers, pool = None, checkpoint = None ):
+        self.mash = mash
+        self.numWorkers = numWorkers
+        self.pool = pool
+        self.checkpoint = checkpoint
+        self.bestx = None
+        self.best = np.inf
+        self.numEval = 0
+        self.numGen = 0
+        self.wallt = 0.0
+        self.evalt = 0.0
+
+    def __call__( self, xs ):
+        # xs has a row for each member of the population.
+        return np.array( self.evaluate( xs, "eval" ) )
+
+    def residuals( self, xs ):
+        # Returns a list of the residual vectors for each row of xs.
+        return self.evaluate( xs, "resid" )
+
+    def evaluate( self, xs, kind ):
+        t0 = time.time()
+        rets = [ None ] * len( xs )
+        todo = list( range( len( xs ) ) )
+        if self.checkpoint:
+            rets = [ self.checkpoint.lookup( kind, x ) for x in xs ]
+            todo = [ i for i, r in enumerate( rets ) if r is None ]
+        if self.pool and len( todo ) > 0:
+            chunk = int( np.ceil( len( todo ) / self.numWorkers ) )
+            func = workerEval if kind == "eval" else workerResiduals
+            ret = self.pool.map( func, [ xs[i] for i in todo ], chunksize = chunk )
+            for i, ( r, simt, evalt ) in zip( todo, ret ):
+                rets[i] = r
+                self.mash.numIter += 1
+                self.mash.simt += simt
+                self.evalt += evalt
+        else:
+            func = self.mash.doEval if kind == "eval" else self.mash.doResiduals
+            for i in todo:
+                rets[i] = func( xs[i] )
+            self.evalt += time.time() - t0
+        if self.checkpoint:
+            for i in todo:
+                self.checkpoint.store( kind, xs[i], rets[i] )
+        if kind == "eval":
+            scores = np.array( rets )
+        else:
+            scores = np.array( [ np.sqrt( np.dot( r, r ) ) for r in rets ] )
+        i = np.argmin( scores )
+        if scores[i] < self.best:
+            self.best = scores[i]
+            self.bestx = np.array( xs[i] )
+        self.numEval += len( xs )
+        self.numGen += 1
+        self.wallt += time.time() - t0
+        return rets
+
+class Plateau:
+    ### Tells when the best score has not improved by more than a 
+    ### fraction tol over the last patience generations.
+    def __init__( self, evaluator, patience, tol ):
+        self.evaluator = evaluator
+        self.patience = patience
+        self.tol = tol
+        self.best = np.inf
+        self.stale = 0
+
+    def __call__( self ):
+        best = self.evaluator.best
+        if best < self.best * ( 1.0 - self.tol ):
+            self.best = best
+            self.stale = 0
+        else:
+            self.stale += 1
+        return self.stale >= self.patience
+
+def runDE( evaluator, plateau, bounds, args, rng, x0 ):
+    # Differential evolution on the log of the scale factors, with x0 in
+    # the initial population. The population is scored a generation at 
+    # a time.
+    n = len( bounds )
+    logBounds = [ ( np.log( lo ), np.log( hi ) ) for lo, hi in bounds ]
+    popsize = max( 1, int( np.ceil( args.popsize / n ) ) ) if args.popsize > 0 else 15
+    def stop( xk, convergence = 0.0 ):
+        dotter( xk )
+        return plateau()
+    ret = differential_evolution( lambda u: evaluator( np.exp( u.T ) ), 
+        logBounds, maxiter = args.maxiter, popsize = popsize, 
+        polish = False, updating = "deferred", vectorized = True, 
+        x0 = np.log( x0 ), seed = rng, callback = stop )
+    return ret.nit
+
+def runCMAES( evaluator, plateau, bounds, args, rng, x0 ):
+    # CMA-ES on the log of the scale factors, starting from x0. Samples
+    # outside the bounds are clipped to them.
+    n = len( bounds )
+    lo = np.log( [ b[0] for b in bounds ] )
+    hi = np.log( [ b[1] for b in bounds ] )
+    lam = args.popsize if args.popsize > 0 else 4 + int( 3 * np.log( n ) )
+    lam = max( lam, 4 )
+    mu = lam // 2
+    w = np.log( mu + 0.5 ) - np.log( np.arange( 1, mu + 1 ) )
+    w /= w.sum()
+    mueff = 1.0 / np.dot( w, w )
+    cc = ( 4.0 + mueff / n ) / ( n + 4.0 + 2.0 * mueff / n )
+    cs = ( mueff + 2.0 ) / ( n + mueff + 5.0 )
+    c1 = 2.0 / ( ( n + 1.3 ) ** 2 + mueff )
+    cmu = min( 1.0 - c1, 2.0 * ( mueff - 2.0 + 1.0 / mueff ) / ( ( n + 2.0 ) ** 2 + mueff ) )
+    damps = 1.0 + 2.0 * max( 0.0, np.sqrt( ( mueff - 1.0 ) / ( n + 1.0 ) ) - 1.0 ) + cs
+    chiN = np.sqrt( n ) * ( 1.0 - 1.0 / ( 4.0 * n ) + 1.0 / ( 21.0 * n * n ) )
+    mean = np.log( x0 )
+    sigma = 1.0
+    pc = np.zeros( n )
+    ps = np.zeros( n )
+    C = np.eye( n )
+    gen = -1
+    for gen in range( args.maxiter ):
+        D2, B = np.linalg.eigh( C )
+        D = np.sqrt( np.maximum( D2, 1e-20 ) )
+        u = mean + sigma * ( rng.standard_normal( ( lam, n ) ) * D ) @ B.T
+        u = np.clip( u, lo, hi )
+        y = ( u - mean ) / sigma
+        idx = np.argsort( evaluator( np.exp( u ) ) )[:mu]
+        yw = w @ y[idx]
+        mean = mean + sigma * yw
+        ps = ( 1.0 - cs ) * ps + np.sqrt( cs * ( 2.0 - cs ) * mueff ) * ( B @ ( ( B.T @ yw ) / D ) )
+        hsig = np.linalg.norm( ps ) / np.sqrt( 1.0 - ( 1.0 - cs ) ** ( 2 * ( gen + 1 ) ) ) / chiN < 1.4 + 2.0 / ( n + 1.0 )
+        pc = ( 1.0 - cc ) * pc + hsig * np.sqrt( cc * ( 2.0 - cc ) * mueff ) * yw
+        C = ( 1.0 - c1 - cmu ) * C + c1 * ( np.outer( pc, pc ) + ( 1.0 - hsig ) * cc * ( 2.0 - cc ) * C ) + cmu * ( y[idx].T * w ) @ y[idx]
+        sigma *= np.exp( ( cs / damps ) * ( np.linalg.norm( ps ) / chiN - 1.0 ) )
+        dotter( mean )
+        if plateau():
+            break
+    return gen + 1
+
+def runSurrogate( evaluator, plateau, bounds, args, rng, x0 ):
+    # Model-based search on the log of the scale factors. The score is 
+    # the norm of the residuals of the outputs from the reference, and 
+    # the model takes each residual to be linear in the params, fitted 
+    # to the runs so far that are near the best one. Each generation 
+    # takes the Gauss-Newton step of the model within a trust region 
+    # about the best point, and with workers to spare, shorter steps 
+    # too. Directions in which the nearby runs are too sparse to fit the
+    # model are filled in with runs along them. The region grows when 
+    # the steps do as well as the model predicts, and shrinks when they 
+    # do not. The search stops when the region or the predicted 
+    # improvement has shrunk away. Starts from x0, and returns the 
+    # number of generations.
+    n = len( bounds )
+    lo = np.log( [ b[0] for b in bounds ] )
+    hi = np.log( [ b[1] for b in bounds ] )
+    batch = args.popsize if args.popsize > 0 else max( 1, args.workers )
+    width = 0.2
+    minWidth = 1.0e-4
+    maxWidth = 2.0
+    # Start with a step along each param.
+    u0 = np.log( x0 )
+    steps = np.eye( n ) * width
+    U = np.vstack( [ u0, u0 + np.where( u0 + steps > hi, -steps, steps ) ] )
+    R = evaluator.residuals( np.exp( U ) )
+    F = [ np.dot( r, r ) for r in R ]
+    gen = -1
+    for gen in range( args.maxiter ):
+        c = int( np.argmin( F ) )
+        uc = U[c]
+        rc = R[c]
+        d = U - uc
+        dist = np.abs( d ).max( 1 )
+        near = [ i for i in np.argsort( dist )[:2 * n + 1] if i != c and dist[i] <= 2.0 * width ]
+        D = d[near]
+        J = np.linalg.lstsq( D, np.array( [ R[i] for i in near ] ) - rc, rcond = None )[0].T
+        sv = np.zeros( n )
+        if len( near ) > 0:
+            _, s, Vt = np.linalg.svd( D )
+            sv[:len( s )] = s
+        else:
+            Vt = np.eye( n )
+        geom = [ np.clip( uc + width * Vt[j], lo, hi ) for j in range( n ) if sv[j] < 0.2 * width ]
+        def step( rad ):
+            # Returns the step within rad and the predicted improvement.
+            s = lsq_linear( J, -rc, bounds = ( np.maximum( lo - uc, -rad ), np.minimum( hi - uc, rad ) ) ).x
+            m = rc + J @ s
+            return uc + s, F[c] - np.dot( m, m )
+        cand, pred = [ list( i ) for i in zip( step( width ) ) ]
+        # The shorter steps are fractions of the full one, which may be
+        # well within the region.
+        length = np.abs( cand[0] - uc ).max()
+        radii = [ width ] + [ length * 0.5 ** i for i in range( 1, batch - len( geom ) ) ]
+        for rad in radii[1:]:
+            u, p = step( rad )
+            cand.append( u )
+            pred.append( p )
+        # Stop as L-BFGS-B does, when the improvement in the score is 
+        # below the tolerance, here as predicted by a sound model.
+        score = np.sqrt( F[c] )
+        if score - np.sqrt( max( F[c] - pred[0], 0.0 ) ) <= args.tolerance * max( score, 1.0 ) and len( geom ) == 0:
+            break
+        Rn = evaluator.residuals( np.exp( np.array( cand + geom ) ) )
+        Fn = [ np.dot( r, r ) for r in Rn ]
+        k = int( np.argmin( Fn[:len( radii )] ) )
+        if Fn[k] < F[c]:
+            rho = ( F[c] - Fn[k] ) / pred[k] if pred[k] > 0.0 else 0.0
+            atEdge = np.abs( cand[k] - uc ).max() > 0.9 * radii[k]
+            width = min( radii[k] * ( 2.0 if rho > 0.75 and atEdge else 1.0 ), maxWidth )
+        elif len( geom ) == 0:
+            # A step can fail because the model was fitted to too few
+            # runs, in which case the new runs fix it.
+            width = min( radii[-1], length ) / 2.0
+        U = np.vstack( [ U, cand, geom ] if len( geom ) > 0 else [ U, cand ] )
+        R.extend( Rn )
+        F.extend( Fn )
+        dotter( np.exp( U[ np.argmin( F ) ] ) )
+        if width < minWidth or plateau():
+            break
+    return gen + 1
+
+def localSearch( mash, x0, bounds, tol, callback = None ):
+    # L-BFGS-B from x0, using sensitivity gradients if the mash has them
+    # set up, and serial finite differences otherwise.
+    if len( mash.sensParams ) > 0:
+        objective = mash.doEvalAndGrad
+    else:
+        objective = FDGradient( mash, bounds, 1 )
+    return minimize( objective, x0, method = "L-BFGS-B", jac = True, tol = tol, bounds = bounds, callback = callback )
+
+def workerLocalSearch( args ):
+    t0 = time.time()
+    simt = workerMash.simt
+    numIter = workerMash.numIter
+    ret = localSearch( workerMash, *args )
+    return ret, workerMash.numIter - numIter, workerMash.simt - simt, time.time() - t0
+
+def runMultistart( mash, pool, starts, bounds, tol, checkpoint = None ):
+    # Local searches from each of the starts, concurrently on the pool if
+    # there is one. Returns the best result and the summed search time.
+    # Searches already in the checkpoint history are not run again.
+    rets = [ checkpoint.lookup( "local", x ) if checkpoint else None for x in starts ]
+    todo = [ i for i, r in enumerate( rets ) if r is None ]
+    evalt = 0.0
+    if pool:
+        ret = pool.map( workerLocalSearch, [ ( starts[i], bounds, tol ) for i in todo ] )
+        for i, ( r, numIter, simt, t ) in zip( todo, ret ):
+            rets[i] = r
+            mash.numIter += numIter
+            mash.simt += simt
+            evalt += t
+            dotter( r.x )
+            if checkpoint:
+                checkpoint.store( "local", starts[i], r )
+    else:
+        for i in todo:
+            t0 = time.time()
+            rets[i] = localSearch( mash, starts[i], bounds, tol, callback = dotter )
+            evalt += time.time() - t0
+            if checkpoint:
+                checkpoint.store( "local", starts[i], rets[i] )
+    best = min( rets, key = lambda r: r.fun )
+    best.nit = sum( [ r.nit for r in rets ] )
+    return best, evalt
+
+def telemetrySummary( fname, wallt ):
+    # Prints a table of the logged evaluation times for each process.
+    rows = {}
+    with open( fname ) as f:
+        for line in f:
+            rec = json.loads( line )
+            row = rows.setdefault( rec["worker"], np.zeros( 4 ) )
+            row += [ 1, rec["reinit"], rec["simulate"], rec["score"] ]
+    if len( rows ) == 0:
+        return
+    total = sum( rows.values() )
+    print( "\n{:>10s} {:>8s} {:>10s} {:>11s} {:>9s}".format( "Worker", "Evals", "Reinit(s)", "Simulate(s)", "Score(s)" ) )
+    for pid, row in rows.items():
+        name = "main" if pid == os.getpid() else str( pid )
+        print( "{:>10s} {:8d} {:10.3f} {:11.3f} {:9.3f}".format( name, int( row[0] ), row[1], row[2], row[3] ) )
+    print( "{:>10s} {:8d} {:10.3f} {:11.3f} {:9.3f}".format( "Total", int( total[0] ), total[1], total[2], total[3] ) )
+    # Processes work concurrently, so the simulator time is shared out 
+    # over them to compare with the wall time.
+    simt = ( total[1] + total[2] ) / len( rows )
+    outside = max( 0.0, wallt - simt )
+    print( "{:.1f} evaluations/s over {:.2f}s of optimization. Time outside the simulator = {:.2f}s ({:.0f}%)".format( total[0] / wallt, wallt, outside, 100.0 * outside / wallt ) )
+
 # Callback function for minimizer. Just prints out dots.
 def dotter( xk ):
     print( ".", end = "", flush = True )
 
 
-def makeMash( args, stimVec, referenceOutputs ):
+def makeMash( args, protocol, referenceOutputs ):
     #jsonDict = hillTau.loadHillTau( "HT_MODELS/opt_fb_inhib.json" )
     jsonDict = hillTau.loadHillTau( args.HillTauModel )
 
@@ -179,16 +1087,9 @@ def makeMash( args, stimVec, referenceOutputs ):
     hillTau.scaleDict( jsonDict, hillTau.getQuantityScale( jsonDict ) )
     model = hillTau.parseModel( jsonDict )
     model.dt = plotDt
-    for i in stimVec:
-        mi = model.molInfo.get( i.hillTauMol )
-        if mi:
-            inputMolIndex = mi.index
-            i.molIndex = inputMolIndex
-            if i.conc < 0:  # Hack to specify use of initial conc
-                i.conc = mi.concInit
-        else:
-            raise ValueError( "Nonexistent stimulus molecule: ", i.hillTauMol )
-    return Mash( model, referenceOutputs, pv, args.monitor, stimVec, jsonDict )
+    if args.batched is not None:
+        return BatchedMash( model, referenceOutputs, pv, args.monitor, protocol, jsonDict, settleSamples( args ) * plotDt, args.segment_weights )
+    return Mash( model, referenceOutputs, pv, args.monitor, protocol, jsonDict )
 
 def plotBoilerplate( xlabel = 'Time (s)', ylabel = 'Conc ($\mu$M)', title = "" ):
     ax = plt.subplot( 1, 1, 1 )
@@ -199,7 +1100,11 @@ def plotBoilerplate( xlabel = 'Time (s)', ylabel = 'Conc ($\mu$M)', title = "" )
     ax.set_title( title )
     return ax
 
-def runMoose( chem, stimVec, outMols ):
+def runMoose( chem, protocol, outMols ):
+    if moose is None:
+        raise ValueError( "Error: MOOSE is not installed. Use '--reference sbml' for SBML models." )
+    if moose.exists( "/model" ): # Left over from an earlier run.
+        moose.delete( "/model" )
     filename, file_extension = os.path.splitext(chem)
     if file_extension == ".g":
         modelId = moose.loadModel( chem, 'model', 'gsl' )
@@ -224,23 +1129,133 @@ def runMoose( chem, stimVec, outMols ):
     for i in range( 10, 20 ):
         moose.setClock( i, plotDt )
 
+    stimEl = []
+    for i in protocol.mols:
+        mooseMol = getMooseName( i )
+        el = moose.wildcardFind( "/model/kinetics/" + mooseMol + ",/model/kinetics/##/" + mooseMol )
+        if len( el ) > 0:
+            stimEl.append( el[0] )
+        else:
+            print( "Warning: Stimulus molecule '{}' not found in MOOSE".format( mooseMol ) )
+            stimEl.append( None )
+
     moose.reinit()
     lastt = 0.0
 
-    for stim in stimVec:
-        #print( "STIM = ", stim.mol, "   ", stim.conc, " ", stim.time )
-        el = moose.wildcardFind( "/model/kinetics/" + stim.mooseMol + ",/model/kinetics/##/" + stim.mooseMol )
-        if len( el ) > 0:
-            if stim.time > lastt:
-                moose.start( stim.time - lastt )
-                lastt = stim.time
-            el[0].concInit = stim.conc # assign conc even if no sim advance
-        else:
-            print( "Warning: Stimulus molecule '{}' not found in MOOSE".format( stim.mooseMol ) )
+    for t, m, v in zip( protocol.times.tolist(), protocol.molIds.tolist(), protocol.values.tolist() ):
+        if stimEl[m]:
+            if t > lastt:
+                moose.start( t - lastt )
+                lastt = t
+            stimEl[m].concInit = v # assign conc even if no sim advance
 
     vecs = { i.name:i.vector for i in moose.wildcardFind("/model/tabs/#") }
     return vecs
 
+def runSbml( chem, protocol, outMols ):
+    # Same inputs and outputs as runMoose, using the built-in simulator.
+    filename, file_extension = os.path.splitext(chem)
+    if file_extension != ".xml":
+        raise ValueError( "Error: The sbml reference backend needs an SBML (.xml) model, got '{}'".format( chem ) )
+    model = sbmlSim.SbmlModel( chem )
+    return model.run( protocol.mooseEvents(), [ getMooseName( i ) for i in outMols ], plotDt )
+
+# Each backend takes the chemical model file, the Protocol and the list of
+# monitored molecules, and returns a dict of { mooseName: vector } of the
+# concs sampled every plotDt.
+REFERENCE_BACKENDS = { "moose": runMoose, "sbml": runSbml }
+
+def chooseBackend( name, chem ):
+    # 'auto' uses MOOSE if it is installed, and otherwise the built-in 
+    # simulator for SBML models.
+    if name != "auto":
+        return name
+    if moose is None and os.path.splitext( chem )[1] == ".xml":
+        return "sbml"
+    return "moose"
+
+def runReference( backend, chem, protocol, outMols ):
+    return REFERENCE_BACKENDS[ backend ]( chem, protocol, outMols )
+
+def referenceKey( chem, protocol, outMols, backend = "moose" ):
+    # Hash of everything that determines the reference outputs.
+    h = hashlib.sha256()
+    with open( chem, 'rb' ) as f:
+        h.update( f.read() )
+    stims = protocol.mooseEvents()
+    key = [ stims, plotDt, list( outMols ) ]
+    if backend != "moose":
+        key.append( backend )
+    h.update( json.dumps( key ).encode() )
+    return h.hexdigest()
+
+def loadCachedReference( cacheDir, key ):
+    fname = os.path.join( cacheDir, key + ".npz" )
+    if not os.path.isfile( fname ):
+        return None
+    try:
+        with np.load( fname ) as data:
+            ret = { name:data[name] for name in data.files }
+    except ( OSError, ValueError ):
+        return None
+    os.utime( fname ) # Mark as recently used, for eviction.
+    return ret
+
+def saveCachedReference( cacheDir, key, vecs, maxBytes ):
+    os.makedirs( cacheDir, exist_ok = True )
+    # Write to a temporary file first, so readers never see a partial one.
+    fd, tmp = tempfile.mkstemp( dir = cacheDir, suffix = ".tmp" )
+    with os.fdopen( fd, 'wb' ) as f:
+        np.savez( f, **vecs )
+    os.replace( tmp, os.path.join( cacheDir, key + ".npz" ) )
+    # Evict least recently used entries till the cache fits in maxBytes.
+    entries = [ os.path.join( cacheDir, i ) for i in os.listdir( cacheDir ) if i.endswith( ".npz" ) ]
+    entries.sort( key = os.path.getmtime )
+    total = sum( [ os.path.getsize( i ) for i in entries ] )
+    for i in entries[:-1]:
+        if total <= maxBytes:
+            break
+        total -= os.path.getsize( i )
+        os.remove( i )
+
+def getReference( args, protocol ):
+    # Returns the reference outputs, from the cache if possible.
+    if args.no_cache:
+        return runReference( args.reference, args.chemModel, protocol, args.monitor ), False
+    key = referenceKey( args.chemModel, protocol, args.monitor, args.reference )
+    ret = loadCachedReference( args.cache_dir, key )
+    if ret is not None:
+        return ret, True
+    ret = runReference( args.reference, args.chemModel, protocol, args.monitor )
+    saveCachedReference( args.cache_dir, key, ret, args.cache_size * 1.0e6 )
+    return ret, False
+
+def workerReference( args ):
+    global plotDt
+    cmdArgs, protocol, plotDt = args
+    return getReference( cmdArgs, protocol )
+
+def settleSamples( args ):
+    # The settling time before each batched segment, args.batched, as a 
+    # whole number of plotDt. The reference and HillTau both settle for 
+    # this long.
+    return int( np.ceil( args.batched / plotDt - 1.0e-9 ) )
+
+def getBatchedReference( args, protocol ):
+    # Returns a list of the reference outputs for each segment of the 
+    # protocol, run on its own after settling at baseline. The segments
+    # go to worker processes if there are any. 
+    skip = settleSamples( args )
+    protocols = [ protocol.segment( k, skip * plotDt ) for k in range( protocol.numSegments ) ]
+    numWorkers = min( args.workers, len( protocols ) )
+    if numWorkers > 1:
+        with ProcessPoolExecutor( max_workers = numWorkers ) as pool:
+            rets = list( pool.map( workerReference, [ ( args, p, plotDt ) for p in protocols ] ) )
+    else:
+        rets = [ getReference( args, p ) for p in protocols ]
+    cached = all( [ r[1] for r in rets ] )
+    return [ { name: vec[skip:] for name, vec in r[0].items() } for r in rets ], cached
+
 def paramVec( jsonDict ):
     pv = []
     for grp in jsonDict['Groups'].values():
@@ -272,38 +1287,40 @@ def paramVec( jsonDict ):
 
     return pv
 
-def parseDoser( stimVec, d, t ):
+def parseDoser( events, d, t ):
     assert( len(d) == 3 )
     mol, midconc, settleTime = d
     midconc = float( midconc )
     settleTime = float( settleTime )
     #print("'{}'     '{}'     '{}'".format( mol, midconc, settleTime) )
     # Build dose=response
-    stimVec.append( Stim( mol, 0.0, t ) )
+    events.append( ( mol, 0.0, t ) )
     t += settleTime
     for x in stimRange: 
-        stimVec.append( Stim( mol, midconc * x, t ) )
+        events.append( ( mol, midconc * x, t ) )
         t += settleTime
-    stimVec.append( Stim( mol, 0.0, t ) ) 
+    events.append( ( mol, 0.0, t ) ) 
     t += settleTime
     return t
 
-def parseCycle( stimVec, c, t ):
+def parseCycle( events, c, t ):
     mol = c[0]
     conc, onTime, offTime = [ float( x ) for x in c[1:4] ]
     numCycles = int( c[4] )
-    stimVec.append( Stim( mol, 0.0, t ) )
+    events.append( ( mol, 0.0, t ) )
     for i in range( numCycles ):
         t += float( offTime )
-        stimVec.append( Stim( mol, float( conc ), t ) )
+        events.append( ( mol, float( conc ), t ) )
         t += float( onTime )
-        stimVec.append( Stim( mol, 0.0, t ) )
+        events.append( ( mol, 0.0, t ) )
     t += float( offTime ) # final zero level stim
-    stimVec.append( Stim( mol, 0.0, t ) )
+    events.append( ( mol, 0.0, t ) )
     return t
 
 def parseStims( stimArg, builtin, cyclic, doser ):
-    stimVec = []
+    # Returns the stimuli compiled into a Protocol.
+    events = []
+    segments = []   # ( index of first event, start time ) of each stimulus
     t = 0.0
     for b in builtin:
         assert( len(b) == 3 ) # molecule, midconc, midTime
@@ -313,25 +1330,32 @@ def parseStims( stimArg, builtin, cyclic, doser ):
         #print("'{}'     '{}'        '{}'".format( mol, midconc, midTime) )
         settleTime = midTime * settleTimeScale
         # Build dose=response
-        t = parseDoser( stimVec, [mol, midconc, settleTime], t)
+        segments.append( ( len( events ), t ) )
+        t = parseDoser( events, [mol, midconc, settleTime], t)
         # Build cyclic stimulus
         sr0 = stimRange[0]
-        t = parseCycle( stimVec, [mol, midconc, midTime*sr0, midTime*sr0, len(stimRange)*25 ], t)
-        t = parseCycle( stimVec, [mol, midconc, midTime, midTime, int( len(stimRange) * 2.5 ) ], t)
+        segments.append( ( len( events ), t ) )
+        t = parseCycle( events, [mol, midconc, midTime*sr0, midTime*sr0, len(stimRange)*25 ], t)
+        segments.append( ( len( events ), t ) )
+        t = parseCycle( events, [mol, midconc, midTime, midTime, int( len(stimRange) * 2.5 ) ], t)
 
     for c in cyclic:
         assert( len(c) == 5 ) # molecule, conc, start, stop, numCycles
-        t = parseCycle( stimVec, c, t )
+        segments.append( ( len( events ), t ) )
+        t = parseCycle( events, c, t )
 
     for d in doser:
         assert( len(d) == 3 ) # molecule, midconc, settleTime
-        t = parseDoser( stimVec, d, t )
+        segments.append( ( len( events ), t ) )
+        t = parseDoser( events, d, t )
 
     for s in stimArg:
         assert( len( s ) >= 3 and len(s) % 2 == 1 )
+        # These have absolute times.
+        segments.append( ( len( events ), 0.0 ) )
         for i in range( 1, len( s ), 2 ):
-            stimVec.append( Stim( s[0], float( s[i] ), float(s[i+1]) ) )
-    return sorted( stimVec, key = lambda x: x.time )
+            events.append( ( s[0], float( s[i] ), float(s[i+1]) ) )
+    return Protocol( events, segments )
 
 def oldparseStims( stimArg, builtin, cyclic, doser ):
     stimVec = []
@@ -413,39 +1437,184 @@ def main():
     parser.add_argument( '-p', '--plot', action='store_true', help='Flag: when set, it plots the chem output, the original HillTau output, and the optimized HillTau output')
     parser.add_argument( "-t", "--tolerance", type = float, help = "Optional: tolerance for convergence of optimization.", default = 1.0e-6 )
     parser.add_argument( '-o', '--optfile', type = str, help='Optional: File name for saving optimized HillTau model. If not set, no file is saved.', default = "" )
+    parser.add_argument( "-w", "--workers", type = int, help = "Optional: Number of worker processes for evaluating the finite-difference gradients used in the optimization. Each worker has its own copy of the model. Default is 1, which evaluates them serially.", default = 1 )
+    parser.add_argument( "-g", "--gradient", type = str, choices = ["sens", "fd"], help = "Optional: How to compute gradients for the optimization. 'sens' computes exact gradients from parameter sensitivities propagated along with the HillTau run, needing one run per gradient. 'fd' uses finite differences, needing a run for each parameter. Models with Eqns always use 'fd'. Default is 'sens'.", default = "sens" )
+    parser.add_argument( "--method", type = str, choices = ["lbfgsb", "de", "cmaes", "surrogate", "multistart"], help = "Optional: Optimization method. 'lbfgsb' is a local search from the original params. 'de' (differential evolution) and 'cmaes' (CMA-ES) are global searches on the log of the scale factors, whose best result is refined by a local search. Their populations are scored concurrently on the workers. 'surrogate' fits a model of how the outputs depend on the params to the runs so far, and takes steps that the model predicts will improve the score, within a trust region about the best params. It needs far fewer runs than finite-difference gradients, so it suits models that are slow to run or cannot compute sensitivities. Each batch of runs goes to the workers. 'multistart' runs local searches from the original params and from random starting points, concurrently on the workers. Default is 'lbfgsb'.", default = "lbfgsb" )
+    parser.add_argument( "--popsize", type = int, help = "Optional: Population size per generation for 'de' and 'cmaes', least number of runs per generation for 'surrogate', or number of starts for 'multistart'. Default is 0, which uses the usual size for the method, for 'surrogate' the number of workers, and for 'multistart', the larger of 4 and the number of workers.", default = 0 )
+    parser.add_argument( "--maxiter", type = int, help = "Optional: Maximum number of generations for 'de', 'cmaes' and 'surrogate'. Default is 200.", default = 200 )
+    parser.add_argument( "--patience", type = int, help = "Optional: Stop 'de', 'cmaes' and 'surrogate' when the best score has not improved by more than the tolerance, as a fraction, for this many generations. Default is 10.", default = 10 )
+    parser.add_argument( "--seed", type = int, help = "Optional: Seed for the random numbers used by 'de', 'cmaes' and 'multistart'.", default = None )
+    parser.add_argument( "--skip_cycles", type = float, nargs = "?", metavar = "tol", const = 1.0e-4, help = "Optional: Skip repeated stimulus cycles once the HillTau model reaches a periodic steady state, that is, when the concentrations at the start of successive cycles agree within tol as a fraction. The outputs of the last simulated cycle are repeated instead. The number of cycles skipped at once is limited so that any slow drift stays within tol. Runs that compute sensitivities or replay other runs simulate every cycle. Default tol if the flag is given is 1e-4.", default = None )
+    parser.add_argument( "--batched", type = float, nargs = "?", metavar = "settle_time", const = 100.0, help = "Optional: Run each stimulus, that is, each dose-response, each train of cycles, and each --stimulus molecule, as a separate experiment rather than one after another. Both the chemical and HillTau models start each one from their state after settling for settle_time seconds at baseline. The HillTau runs for the stimuli go on concurrently, and their scores are combined. Gradients are by finite differences. Default settle_time if the flag is given is 100.", default = None )
+    parser.add_argument( "--segment_weights", type = float, nargs = "+", metavar = "weight", help = "Optional: Weights for the scores of the stimuli in --batched runs, one for each, in the order in which they are delivered: builtin, cyclic, dose_response, then stimulus. Default is in proportion to their durations, which gives the same score as running them end to end.", default = None )
+    parser.add_argument( "--multires", type = int, nargs = "*", metavar = "factor", help = "Optional: Fit in stages from coarse to fine. Each stage samples the HillTau runs, and the reference, at intervals of factor times the plot interval, and starts from the result of the one before. Coarse stages also take longer internal HillTau timesteps, so they run faster. A last stage fits at full resolution. Global searches are done in the first stage. Default factors if the flag is given alone are 16 4.", default = None )
+    parser.add_argument( "--telemetry", type = str, metavar = "FILE", help = "Optional: File in which to log each evaluation as a line of JSON, with its reinit, simulate and score times, params, score and worker process id. A summary table of the times is printed at the end.", default = "" )
+    parser.add_argument( "--checkpoint", type = str, metavar = "FILE", help = "Optional: File in which to save a checkpoint of the optimization, every --checkpoint_interval seconds and at the end. It holds the reference outputs, the params, the random seed, the history of evaluations and the best params so far.", default = "" )
+    parser.add_argument( "--checkpoint_interval", type = float, help = "Optional: Time in seconds between checkpoints. Default is 60.", default = 60.0 )
+    parser.add_argument( "--resume", action = "store_true", help = "Flag: when set, resumes the optimization saved in the --checkpoint file. The reference outputs come from the checkpoint, and the optimizer repeats its steps using the saved evaluations until it reaches new points." )
+    parser.add_argument( "--reference", type = str, choices = ["auto", "moose", "sbml"], help = "Optional: Simulator for the reference outputs of the chemical model. 'moose' uses MOOSE, which reads SBML and GENESIS (.g) models. 'sbml' uses the built-in stiff ODE simulator in sbmlSim.py, which reads SBML models and needs only scipy. 'auto' uses MOOSE if it is installed, and otherwise 'sbml'. Default is 'auto'.", default = "auto" )
+    parser.add_argument( "--no-cache", action = "store_true", help = "Flag: when set, the reference outputs are always computed by running the chemical model, and are not stored in the cache." )
+    parser.add_argument( "--cache_dir", type = str, help = "Optional: Directory for caching reference outputs. They are keyed by the chemical model file, stimuli, plotDt and monitored molecules. Default is ~/.cache/mash", default = os.path.join( os.path.expanduser( "~" ), ".cache", "mash" ) )
+    parser.add_argument( "--cache_size", type = float, help = "Optional: Maximum size of the reference cache in MB. Least recently used entries are evicted beyond this. Default is 200.", default = 200.0 )
+    parser.add_argument( "--screen", type = float, nargs = "?", metavar = "threshold", const = 1.0e-3, help = "Optional: Screen out parameters before optimization. Parameters which are not upstream of the monitored molecules are dropped, as are those for which a 10%% change alters the outputs by less than threshold, as an RMS fraction of the reference range. Default threshold if the flag is given is 1e-3.", default = None )
     args = parser.parse_args()
+    args.reference = chooseBackend( args.reference, args.chemModel )
 
     if len( args.builtin ) > 0:
         plotDt = min( plotDt, float( args.builtin[0][2] ) * stimRange[0] * 0.2 )
-    stimVec = parseStims( args.stimulus, args.builtin, args.cyclic, args.dose_response )
+    protocol = parseStims( args.stimulus, args.builtin, args.cyclic, args.dose_response )
+    checkpoint = None
+    if len( args.checkpoint ) > 0:
+        checkpoint = Checkpoint( args.checkpoint, args.checkpoint_interval, runSignature( args, protocol ) )
+        if args.resume:
+            checkpoint.load()
+            print( "Resuming from checkpoint '{}' with {} saved evaluations, best score = {:3g}".format( args.checkpoint, len( checkpoint.history ), checkpoint.best ) )
+    elif args.resume:
+        raise ValueError( "Error: --resume needs a --checkpoint file" )
     t0 = time.time()
-    referenceOutputs = runMoose( args.chemModel, stimVec, args.monitor )
-    t1 = time.time()
-    print( "Completed reference run of '{}' in {:.2f}s".format( args.chemModel, t1 -t0 ) )
+    if checkpoint and checkpoint.reference is not None:
+        referenceOutputs = checkpoint.reference
+        t1 = time.time()
+        print( "Loaded reference for '{}' from checkpoint".format( args.chemModel ) )
+    else:
+        if args.batched is not None:
+            referenceOutputs, cached = getBatchedReference( args, protocol )
+        else:
+            referenceOutputs, cached = getReference( args, protocol )
+        t1 = time.time()
+        if cached:
+            print( "Loaded cached reference for '{}' in {:.2f}s".format( args.chemModel, t1 -t0 ) )
+        else:
+            print( "Completed {} reference run of '{}' in {:.2f}s".format( args.reference, args.chemModel, t1 -t0 ) )
+        if checkpoint:
+            checkpoint.reference = referenceOutputs
 
-    mash = makeMash( args, stimVec, referenceOutputs )
+    mash = makeMash( args, protocol, referenceOutputs )
+    if args.skip_cycles is not None:
+        mash.cycleTol = args.skip_cycles
+    if checkpoint and checkpoint.params is not None:
+        mash.params = list( checkpoint.params )
+    elif args.screen is not None:
+        numParams = len( mash.params )
+        dropped = mash.screenParams( args.screen )
+        print( "Screening dropped {} of {} params:".format( len( dropped ), numParams ) )
+        for name, reason in dropped:
+            print( "{:20s}  {}".format( name, reason ) )
+    seed = args.seed
+    if checkpoint:
+        checkpoint.params = list( mash.params )
+        # A resumed run needs the same random numbers.
+        if checkpoint.seed is None:
+            checkpoint.seed = seed if seed is not None else int( np.random.SeedSequence().entropy % 2**32 )
+        seed = checkpoint.seed
+        checkpoint.save()
     
     initParams = np.ones( len( mash.params ) )
     initRet = mash.doRun( initParams )
     bounds = [(0.01, 100.0)] * len( mash.params )
 
     x0 = initParams
+    initScore = mash.doScore( initRet )
+
+    # Coarse stages sample the runs every factor plot times.
+    factors = [ 1 ]
+    if args.multires is not None:
+        factors = [ k for k in ( args.multires or [ 16, 4 ] ) if k > 1 ] + [ 1 ]
 
-    ret = minimize( mash.doEval, x0, method = "L-BFGS-B", tol = args.tolerance, bounds = bounds, callback = dotter )
+    fdGrad = None
+    popEval = None
+    useSens = ( args.gradient == "sens" and mash.setupSens() )
+    if len( args.telemetry ) > 0:
+        open( args.telemetry, "w" ).close()
+        mash.setTelemetry( args.telemetry )
+    t2 = time.time()
+    if useSens:
+        objective = mash.doEvalAndGrad
+    else:
+        fdGrad = objective = FDGradient( mash, bounds, args.workers )
+    if checkpoint:
+        objective = checkpoint.wrap( "grad", objective )
+    rng = np.random.default_rng( seed )
+    numIter = 0
+    tol = args.tolerance
+    try:
+        for stage, factor in enumerate( factors ):
+            # The workers need copies of the Mash at this resolution.
+            t3 = time.time()
+            numEval = mash.numIter
+            mash.setResolution( factor )
+            if checkpoint:
+                checkpoint.stage = factor
+            pool = makePool( mash, args.workers )
+            if fdGrad:
+                fdGrad.pool = pool
+            try:
+                # Global searches are done at the first stage only.
+                if args.method == "multistart" and stage == 0:
+                    numStarts = args.popsize if args.popsize > 0 else max( 4, args.workers )
+                    lo = np.log( [ b[0] for b in bounds ] )
+                    hi = np.log( [ b[1] for b in bounds ] )
+                    starts = [ x0 ] + [ np.exp( rng.uniform( lo, hi ) ) for i in range( numStarts - 1 ) ]
+                    ret, evalt = runMultistart( mash, pool, starts, bounds, args.tolerance, checkpoint )
+                    print( "\nMultistart: {} local searches on {} worker(s), wall time = {:.2f}s, serial time = {:.2f}s".format( numStarts, args.workers, time.time() - t3, evalt ) )
+                else:
+                    if args.method == "surrogate" or ( args.method in ["de", "cmaes"] and stage == 0 ):
+                        popEval = PopulationEvaluator( mash, args.workers, pool, checkpoint )
+                        plateau = Plateau( popEval, args.patience, args.tolerance )
+                        search = { "de": runDE, "cmaes": runCMAES, "surrogate": runSurrogate }[ args.method ]
+                        numGen = search( popEval, plateau, bounds, args, rng, x0 )
+                        if popEval.bestx is not None:
+                            x0 = np.clip( popEval.bestx, 0.01, 100.0 )
+                        print( "\nGlobal search: {} generations, {} evaluations on {} worker(s), wall time = {:.2f}s, serial time = {:.2f}s, best score = {:3g}".format( numGen, popEval.numEval, args.workers, popEval.wallt, popEval.evalt, popEval.best ) )
+                    if args.method == "surrogate":
+                        # It converges by itself, so needs no local search.
+                        ret = OptimizeResult( x = x0, fun = popEval.best, nit = numGen )
+                    else:
+                        ret = minimize( objective, x0, method = "L-BFGS-B", jac = True, tol = tol, bounds = bounds, callback = dotter )
+            finally:
+                if pool:
+                    pool.shutdown()
+            x0 = ret.x
+            numIter += ret.nit
+            # L-BFGS-B stops when the score changes by less than tol. 
+            # Later stages start close to the end, where the changes are
+            # small, so they need a tolerance in proportion to the score.
+            tol = args.tolerance * min( ret.fun, 1.0 )
+            if len( factors ) > 1:
+                print( "\nStage {}: plot interval = {:g}s, {} evaluations, {} iterations, score = {:3g}, wall time = {:.2f}s".format( stage + 1, plotDt * factor, mash.numIter - numEval, ret.nit, ret.fun, time.time() - t3 ) )
+    finally:
+        if checkpoint:
+            checkpoint.save()
+    ret.nit = numIter
+    optt = time.time() - t2
+    mash.setTelemetry( "" )
 
     finalRet = mash.doRun( ret.x )
     print( "\n{:20s}   {}".format( "Object.field", "Scale factor" ) )
     for i, j in zip( mash.params, ret.x ):
         print( "{:20s}  {:4f}".format( i, j ) )
 
-    print( "Timings: reference= {:.2f}s, optimization= {:.2f}s, HillTau Cumulative = {:.2f}s \nNumber of evaluations = {}, number of optimization iterations = {}, \nInitial score = {:3g}, Final score = {:3g}".format( t1 - t0, time.time() - t1, mash.simt, mash.numIter, ret.nit,  mash.doScore( initRet ), ret.fun ) )
+    print( "Timings: reference= {:.2f}s, optimization= {:.2f}s, HillTau Cumulative = {:.2f}s \nNumber of evaluations = {}, number of optimization iterations = {}, \nInitial score = {:3g}, Final score = {:3g}".format( t1 - t0, time.time() - t1, mash.simt, mash.numIter, ret.nit, initScore, ret.fun ) )
+
+    if fdGrad and fdGrad.wallt > 0.0:
+        print( "Gradients: {} evaluations on {} worker(s), wall time = {:.2f}s, serial time = {:.2f}s, speedup = {:.2f}".format( fdGrad.numGrad, args.workers, fdGrad.wallt, fdGrad.evalt, fdGrad.evalt / fdGrad.wallt ) )
+        print( "{} of {} stepped runs replayed the reacs upstream of their param".format( mash.numReplay, fdGrad.numStepped ) )
+
+    if checkpoint and checkpoint.numHits > 0:
+        print( "Took {} evaluations from the checkpoint history".format( checkpoint.numHits ) )
+
+    if mash.numSkippedCycles > 0:
+        print( "Skipped {} steady stimulus cycles over {} evaluations".format( mash.numSkippedCycles, mash.numIter ) )
+
+    if len( args.telemetry ) > 0:
+        telemetrySummary( args.telemetry, optt )
 
     if len( args.optfile ) > 0:
         mash.dumpScaledFile( ret.x, args.optfile )
 
 
     if args.plot:
-        for name, ref in referenceOutputs.items():
+        for name, ref in mash.reference.items():
             hname = mash.molMap[ name ]
             fig = plt.figure( figsize = (6,6), facecolor='white' )
             ax = plotBoilerplate( xlabel = "Time (s)", title = hname )
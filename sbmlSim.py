@@ -0,0 +1,483 @@
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth
+# Floor, Boston, MA 02110-1301, USA.
+#
+
+'''
+*******************************************************************
+ * File:            sbmlSim.py
+ * Description:     Stiff ODE simulator for SBML chemical kinetic models,
+ *                  used by mash to compute reference outputs without MOOSE.
+ * Author:          Upinder S. Bhalla
+ * E-mail:          bhalla@ncbs.res.in
+ ********************************************************************/
+
+/**********************************************************************
+** This program reads mass-action and Michaelis-Menten models in SBML,
+** as written by MOOSE, and runs them with the stiff integrators of scipy.
+**           copyright (C) 2021 Upinder S. Bhalla. and NCBS
+**********************************************************************/
+'''
+from __future__ import print_function
+import math
+import argparse
+import xml.etree.ElementTree as ET
+import numpy as np
+import scipy.sparse as sp
+from scipy.integrate import solve_ivp
+
+# Scale of the base units to SI, as used by MOOSE and HillTau.
+UNIT_SCALE = { "mole": 1.0, "item": 1.0 / 6.02214076e23, "litre": 1.0e-3,
+    "metre": 1.0, "second": 1.0, "dimensionless": 1.0 }
+
+MATH_FUNCS = { "exp": "exp", "ln": "log", "abs": "abs", "floor": "floor",
+    "ceiling": "ceil", "sin": "sin", "cos": "cos", "tan": "tan" }
+
+EVAL_ENV = { "exp": math.exp, "log": math.log, "log10": math.log10,
+    "abs": abs, "floor": math.floor, "ceil": math.ceil, "sin": math.sin,
+    "cos": math.cos, "tan": math.tan, "sqrt": math.sqrt }
+
+def tagName( elm ):
+    return elm.tag.rsplit( '}', 1 )[-1]
+
+def children( elm, name ):
+    # Children of elm with tag name, ignoring the namespace.
+    return [ i for i in elm if tagName( i ) == name ]
+
+def child( elm, name ):
+    ret = children( elm, name )
+    return ret[0] if len( ret ) > 0 else None
+
+def listOf( elm, listName, name ):
+    lst = child( elm, listName )
+    return [] if lst is None else children( lst, name )
+
+def parseMath( elm ):
+    # Converts MathML into nested tuples: ( "cn", value ), ( "ci", name ),
+    # ( "time", ) or ( "apply", op, [ args ] ).
+    tag = tagName( elm )
+    if tag == "math":
+        return parseMath( list( elm )[0] )
+    if tag == "ci":
+        return ( "ci", elm.text.strip() )
+    if tag == "cn":
+        kind = elm.get( "type", "real" )
+        if kind in ( "e-notation", "rational" ):
+            a = float( elm.text.strip() )
+            b = float( list( elm )[0].tail.strip() )
+            return ( "cn", a * 10.0 ** b if kind == "e-notation" else a / b )
+        return ( "cn", float( elm.text.strip() ) )
+    if tag == "csymbol" and elm.get( "definitionURL", "" ).endswith( "/time" ):
+        return ( "time", )
+    if tag == "apply":
+        args = list( elm )
+        op = tagName( args[0] )
+        if op == "log" and len( args ) > 2 and tagName( args[1] ) == "logbase":
+            return ( "apply", "logbase", [ parseMath( list( args[1] )[0] ), parseMath( args[2] ) ] )
+        if op == "root" and len( args ) > 2 and tagName( args[1] ) == "degree":
+            return ( "apply", "power", [ parseMath( args[2] ), ( "apply", "divide", [ ( "cn", 1.0 ), parseMath( list( args[1] )[0] ) ] ) ] )
+        return ( "apply", op, [ parseMath( i ) for i in args[1:] ] )
+    raise ValueError( "Error: Unsupported MathML element '{}'".format( tag ) )
+
+def unitScale( unitDefs, unitId, default ):
+    # Returns the SI scale of a unit, from its definition or a base unit.
+    if not unitId:
+        return default
+    if unitId in UNIT_SCALE:
+        return UNIT_SCALE[ unitId ]
+    if not unitId in unitDefs:
+        raise ValueError( "Error: Unknown unit '{}'".format( unitId ) )
+    ret = 1.0
+    for u in listOf( unitDefs[ unitId ], "listOfUnits", "unit" ):
+        base = UNIT_SCALE.get( u.get( "kind" ) )
+        if base is None:
+            raise ValueError( "Error: Unsupported unit kind '{}'".format( u.get( "kind" ) ) )
+        mult = float( u.get( "multiplier", 1.0 ) ) * 10.0 ** float( u.get( "scale", 0 ) )
+        ret *= ( mult * base ) ** float( u.get( "exponent", 1.0 ) )
+    return ret
+
+class SbmlModel:
+    ### Chemical kinetic model read from SBML. The concentrations are
+    ### held in the model's own units, and converted to SI on the way in
+    ### and out. Kinetic laws that are sums of products of concentrations,
+    ### which covers mass-action and the reactions of MOOSE enzymes, are
+    ### evaluated together as arrays, with an exact sparse Jacobian. Any
+    ### other laws are compiled into Python expressions.
+    def __init__( self, fname ):
+        root = ET.parse( fname ).getroot()
+        model = child( root, "model" )
+        if model is None:
+            raise ValueError( "Error: No model in SBML file '{}'".format( fname ) )
+        unitDefs = { u.get( "id" ): u for u in listOf( model, "listOfUnitDefinitions", "unitDefinition" ) }
+        substance = unitScale( unitDefs, model.get( "substanceUnits" ), 1.0 )
+        volume = unitScale( unitDefs, model.get( "volumeUnits" ), 1.0e-3 )
+        self.concScale = substance / volume # Model conc units to SI.
+
+        self.consts = {}
+        self.volume = {}
+        for c in listOf( model, "listOfCompartments", "compartment" ):
+            self.volume[ c.get( "id" ) ] = float( c.get( "size", 1.0 ) )
+            self.consts[ c.get( "id" ) ] = self.volume[ c.get( "id" ) ]
+        for p in listOf( model, "listOfParameters", "parameter" ):
+            self.consts[ p.get( "id" ) ] = float( p.get( "value", 0.0 ) )
+
+        self.speciesIds = []
+        self.index = {}     # Species id to index
+        self.names = {}     # Species name to index, first one found
+        concInit = []
+        self.vols = []
+        self.amountOnly = []
+        fixed = []
+        for s in listOf( model, "listOfSpecies", "species" ):
+            i = len( self.speciesIds )
+            sid = s.get( "id" )
+            self.speciesIds.append( sid )
+            self.index[ sid ] = i
+            self.names.setdefault( s.get( "name", sid ), i )
+            vol = self.volume.get( s.get( "compartment" ), 1.0 )
+            self.vols.append( vol )
+            if s.get( "initialConcentration" ) is not None:
+                concInit.append( float( s.get( "initialConcentration" ) ) )
+            else:
+                concInit.append( float( s.get( "initialAmount", 0.0 ) ) / vol )
+            self.amountOnly.append( s.get( "hasOnlySubstanceUnits" ) == "true" )
+            fixed.append( s.get( "boundaryCondition" ) == "true" or s.get( "constant" ) == "true" )
+        self.concInit = np.array( concInit )
+        self.vols = np.array( self.vols )
+        numSpecies = len( self.speciesIds )
+
+        # Assignment rules give a variable as a function of the others.
+        self.rules = {}
+        for r in listOf( model, "listOfRules", "assignmentRule" ):
+            var = r.get( "variable" )
+            self.rules[ var ] = parseMath( child( r, "math" ) )
+            if var in self.index:
+                fixed[ self.index[ var ] ] = True
+        self.ruleSpecies = [ ( self.index[ v ], self.compileExpr( m, {} )[0] ) for v, m in self.rules.items() if v in self.index ]
+
+        # Stoichiometry, scaled to give the rate of change of conc.
+        reacs = listOf( model, "listOfReactions", "reaction" )
+        rows = []
+        cols = []
+        vals = []
+        scale = np.where( fixed, 0.0, 1.0 / self.vols )
+        terms = []      # ( reac, coeff, [ species ] ) for the array laws
+        general = []    # ( reac, code, deps ) for the compiled laws
+        for j, r in enumerate( reacs ):
+            for ref, sign in [ ( "listOfReactants", -1.0 ), ( "listOfProducts", 1.0 ) ]:
+                for s in listOf( r, ref, "speciesReference" ):
+                    i = self.index[ s.get( "species" ) ]
+                    rows.append( i )
+                    cols.append( j )
+                    vals.append( sign * float( s.get( "stoichiometry", 1.0 ) ) * scale[i] )
+            law = child( r, "kineticLaw" )
+            if law is None or child( law, "math" ) is None:
+                raise ValueError( "Error: Reaction '{}' has no kinetic law".format( r.get( "id" ) ) )
+            local = { p.get( "id" ): float( p.get( "value", 0.0 ) ) for p in listOf( law, "listOfLocalParameters", "localParameter" ) + listOf( law, "listOfParameters", "parameter" ) }
+            m = parseMath( child( law, "math" ) )
+            poly = self.toPoly( m, local )
+            if poly is None:
+                general.append( ( j, ) + self.compileExpr( m, local ) )
+            else:
+                for mols, coeff in poly.items():
+                    if coeff != 0.0:
+                        terms.append( ( j, coeff, list( mols ) ) )
+        stoich = sp.csr_matrix( ( vals, ( rows, cols ) ), shape = ( numSpecies, len( reacs ) ) )
+
+        # Each array term is a coeff times the product of up to width
+        # concs. Unused slots point to an extra entry fixed at 1.
+        width = max( [ len( t[2] ) for t in terms ] + [ 1 ] )
+        self.termCoeff = np.array( [ t[1] for t in terms ] )
+        self.termMols = np.full( ( len( terms ), width ), numSpecies, dtype = int )
+        for k, t in enumerate( terms ):
+            self.termMols[ k, :len( t[2] ) ] = t[2]
+        termReac = sp.csr_matrix( ( np.ones( len( terms ) ), ( [ t[0] for t in terms ], range( len( terms ) ) ) ), shape = ( len( reacs ), len( terms ) ) )
+        self.termStoich = ( stoich @ termReac ).tocsr()
+        used = self.termMols < numSpecies
+        self.jacRows = np.nonzero( used )[0]
+        self.jacCols = self.termMols[ used ]
+        self.jacUsed = used
+        self.general = general
+        self.generalStoich = stoich[:, [ g[0] for g in general ] ].tocsr()
+        self.numSpecies = numSpecies
+        self.ext = np.ones( numSpecies + 1 )
+        self.typicalConc = max( np.max( np.abs( self.concInit ), initial = 0.0 ), 1.0e-30 )
+
+    def lookup( self, name, local ):
+        # Returns ( "species", index ), ( "const", value ) or ( "rule", math ).
+        if name in local:
+            return ( "const", local[ name ] )
+        if name in self.rules:
+            return ( "rule", self.rules[ name ] )
+        if name in self.index:
+            return ( "species", self.index[ name ] )
+        if name in self.consts:
+            return ( "const", self.consts[ name ] )
+        raise ValueError( "Error: Unknown symbol '{}' in SBML math".format( name ) )
+
+    def toPoly( self, m, local ):
+        # Returns m as a dict of { ( species, ... ): coeff }, with a
+        # species repeated for each power, or None if it is not a
+        # polynomial in the concs.
+        if m[0] == "cn":
+            return { (): m[1] }
+        if m[0] == "time":
+            return None
+        if m[0] == "ci":
+            kind, val = self.lookup( m[1], local )
+            if kind == "const":
+                return { (): val }
+            if kind == "rule":
+                return self.toPoly( val, local )
+            if self.amountOnly[ val ]:
+                return { ( val, ): self.vols[ val ] }
+            return { ( val, ): 1.0 }
+        op = m[1]
+        args = [ self.toPoly( i, local ) for i in m[2] ]
+        if any( [ a is None for a in args ] ):
+            return None
+        if op == "plus":
+            return polySum( args )
+        if op == "minus":
+            if len( args ) == 1:
+                return polyScale( args[0], -1.0 )
+            return polySum( [ args[0], polyScale( args[1], -1.0 ) ] )
+        if op == "times":
+            ret = { (): 1.0 }
+            for a in args:
+                ret = polyProduct( ret, a )
+            return ret
+        if op == "divide" and isConst( args[1] ):
+            return polyScale( args[0], 1.0 / constValue( args[1] ) )
+        if op == "power" and isConst( args[1] ):
+            n = constValue( args[1] )
+            if n >= 0 and n == int( n ):
+                ret = { (): 1.0 }
+                for i in range( int( n ) ):
+                    ret = polyProduct( ret, args[0] )
+                return ret
+        if all( [ isConst( a ) for a in args ] ):
+            code, deps = self.compileExpr( m, local )
+            return { (): eval( code, EVAL_ENV, { "y": None, "t": 0.0 } ) }
+        return None
+
+    def toExpr( self, m, local, deps ):
+        # Returns m as a Python expression in y, the concs, and t.
+        if m[0] == "cn":
+            return repr( m[1] )
+        if m[0] == "time":
+            return "t"
+        if m[0] == "ci":
+            kind, val = self.lookup( m[1], local )
+            if kind == "const":
+                return repr( val )
+            if kind == "rule":
+                return "(" + self.toExpr( val, local, deps ) + ")"
+            deps.add( val )
+            if self.amountOnly[ val ]:
+                return "(y[{}]*{!r})".format( val, self.vols[ val ] )
+            return "y[{}]".format( val )
+        op = m[1]
+        args = [ self.toExpr( i, local, deps ) for i in m[2] ]
+        if op == "plus":
+            return "(" + "+".join( args ) + ")" if len( args ) > 0 else "0.0"
+        if op == "times":
+            return "(" + "*".join( args ) + ")" if len( args ) > 0 else "1.0"
+        if op == "minus":
+            return "(-" + args[0] + ")" if len( args ) == 1 else "(" + args[0] + "-" + args[1] + ")"
+        if op == "divide":
+            return "(" + args[0] + "/" + args[1] + ")"
+        if op == "power":
+            return "(" + args[0] + "**" + args[1] + ")"
+        if op == "root":
+            return "sqrt(" + args[0] + ")"
+        if op == "log":
+            return "log10(" + args[0] + ")"
+        if op == "logbase":
+            return "(log(" + args[1] + ")/log(" + args[0] + "))"
+        if op in MATH_FUNCS:
+            return MATH_FUNCS[ op ] + "(" + args[0] + ")"
+        raise ValueError( "Error: Unsupported MathML operator '{}'".format( op ) )
+
+    def compileExpr( self, m, local ):
+        deps = set()
+        expr = self.toExpr( m, local, deps )
+        return compile( expr, "<sbml>", "eval" ), sorted( deps )
+
+    def generalRate( self, g, y, t ):
+        return eval( g[1], EVAL_ENV, { "y": y, "t": t } )
+
+    def termRates( self, y ):
+        self.ext[:-1] = y
+        return self.termCoeff * np.prod( self.ext[ self.termMols ], axis = 1 )
+
+    def rhs( self, t, y ):
+        ret = self.termStoich @ self.termRates( y )
+        if len( self.general ) > 0:
+            ret += self.generalStoich @ np.array( [ self.generalRate( g, y, t ) for g in self.general ] )
+        return ret
+
+    def jacobian( self, t, y ):
+        # The derivative of each term with respect to a conc is the
+        # product of the other concs in it, found from the products
+        # before and after its slot.
+        self.ext[:-1] = y
+        f = self.ext[ self.termMols ]
+        ones = np.ones( ( len( f ), 1 ) )
+        before = np.cumprod( np.hstack( [ ones, f[:, :-1] ] ), axis = 1 )
+        after = np.cumprod( np.hstack( [ ones, f[:, :0:-1] ] ), axis = 1 )[:, ::-1]
+        d = ( before * after )[ self.jacUsed ] * self.termCoeff[ self.jacRows ]
+        dterm = sp.csr_matrix( ( d, ( self.jacRows, self.jacCols ) ), shape = ( len( f ), self.numSpecies ) )
+        ret = self.termStoich @ dterm
+        if len( self.general ) > 0:
+            rows = []
+            cols = []
+            vals = []
+            y = np.array( y )
+            for k, g in enumerate( self.general ):
+                v0 = self.generalRate( g, y, t )
+                for i in g[2]:
+                    h = 1.0e-7 * max( abs( y[i] ), self.typicalConc )
+                    saved = y[i]
+                    y[i] = saved + h
+                    rows.append( k )
+                    cols.append( i )
+                    vals.append( ( self.generalRate( g, y, t ) - v0 ) / h )
+                    y[i] = saved
+            dg = sp.csr_matrix( ( vals, ( rows, cols ) ), shape = ( len( self.general ), self.numSpecies ) )
+            ret = ret + self.generalStoich @ dg
+        return ret.tocsc()
+
+    def applyRules( self, y ):
+        for i, code in self.ruleSpecies:
+            y[i] = eval( code, EVAL_ENV, { "y": y, "t": 0.0 } )
+
+    def findSpecies( self, name ):
+        # Looks up a species by name, or failing that by id.
+        if name in self.names:
+            return self.names[ name ]
+        return self.index.get( name )
+
+    def run( self, events, outMols, plotDt, endt = 0.0, method = "BDF", rtol = 1.0e-6, atol = None ):
+        # Runs the model from its initial concs, delivering each of the
+        # events, which are [ mol, conc, time ] sorted by time. Each event
+        # sets the conc of the molecule, which stays fixed thereafter if
+        # it is a buffered one. A negative conc means the initial conc.
+        # Returns a dict of { mol: vector } of concs sampled every plotDt
+        # till the later of endt and the last event, for each of the 
+        # outMols in the model. Concs are in SI units, that is, mM.
+        outIndex = {}
+        for i in outMols:
+            j = self.findSpecies( i )
+            if j is not None:
+                outIndex[i] = j
+        stimIndex = {}
+        for mol, conc, t in events:
+            if not mol in stimIndex:
+                stimIndex[mol] = self.findSpecies( mol )
+                if stimIndex[mol] is None:
+                    print( "Warning: Stimulus molecule '{}' not found in SBML model".format( mol ) )
+        y = np.array( self.concInit )
+        stims = [ c / self.concScale for mol, c, t in events if c >= 0.0 ]
+        self.typicalConc = max( [ abs( i ) for i in y ] + stims + [ 1.0e-30 ] )
+        if atol is None:
+            atol = 1.0e-9 * self.typicalConc
+        jac = self.jacobian if method != "LSODA" else lambda t, y: self.jacobian( t, y ).toarray()
+
+        if len( events ) > 0:
+            endt = max( endt, events[-1][2] )
+        numSamples = int( np.floor( endt / plotDt + 1.0e-9 ) ) + 1
+        sampleTimes = np.arange( numSamples ) * plotDt
+        samples = np.zeros( ( numSamples, self.numSpecies ) )
+        samples[0] = y
+        nextSample = 1
+        lastt = 0.0
+        for mol, conc, t in events + [ [ None, 0.0, endt ] ]:
+            if t > lastt:
+                last = np.searchsorted( sampleTimes, t * ( 1.0 + 1.0e-12 ), side = "right" )
+                # The run also has to stop at t, which may be a sample.
+                teval = np.minimum( sampleTimes[ nextSample:last ], t )
+                onSample = len( teval ) > 0 and teval[-1] == t
+                if not onSample:
+                    teval = np.append( teval, t )
+                sol = solve_ivp( self.rhs, ( lastt, t ), y, method = method, t_eval = teval, jac = jac, rtol = rtol, atol = atol )
+                if not sol.success:
+                    raise ValueError( "Error: SBML integration failed at t = {}: {}".format( lastt, sol.message ) )
+                samples[ nextSample:last ] = ( sol.y if onSample else sol.y[:, :-1] ).T
+                nextSample = last
+                y = sol.y[:, -1]
+                lastt = t
+            if mol is not None and stimIndex[ mol ] is not None:
+                i = stimIndex[ mol ]
+                y[i] = conc / self.concScale if conc >= 0.0 else self.concInit[i]
+        for row in samples:
+            self.applyRules( row )
+        return { name: samples[:, i] * self.concScale for name, i in outIndex.items() }
+
+def polySum( polys ):
+    ret = {}
+    for p in polys:
+        for k, v in p.items():
+            ret[k] = ret.get( k, 0.0 ) + v
+    return ret
+
+def polyScale( p, scale ):
+    return { k: v * scale for k, v in p.items() }
+
+def polyProduct( a, b ):
+    ret = {}
+    for ka, va in a.items():
+        for kb, vb in b.items():
+            k = tuple( sorted( ka + kb ) )
+            ret[k] = ret.get( k, 0.0 ) + va * vb
+    return ret
+
+def isConst( p ):
+    return all( [ len( k ) == 0 for k in p.keys() ] )
+
+def constValue( p ):
+    return p.get( (), 0.0 )
+
+def main():
+    parser = argparse.ArgumentParser( description = "Runs an SBML chemical kinetic model with a stiff ODE integrator, and prints or plots the outputs." )
+    parser.add_argument( "model", type = str, help = "Required: Filepath for SBML model" )
+    parser.add_argument( "-m", "--monitor", type = str, nargs = '+', metavar = "molName", help = "Optional: Molecules to monitor, as a list of space-separated names.", default = ["output"] )
+    parser.add_argument( "-r", "--runtime", type = float, help = "Optional: Run time for model, in seconds. Default is 100.", default = 100.0 )
+    parser.add_argument( "-dt", "--dt", type = float, help = "Optional: Time step for outputs, in seconds. Default is 1.", default = 1.0 )
+    parser.add_argument( '-s', '--stimulus', type = str, nargs = '+', metavar = 'args', action='append', help='Optional: Deliver stimulus as follows: --stimulus molecule conc time [conc time]... Concs are in mM.', default = [] )
+    parser.add_argument( "--method", type = str, choices = ["BDF", "LSODA", "Radau"], help = "Optional: scipy integration method. Default is 'BDF'.", default = "BDF" )
+    parser.add_argument( '-p', '--plot', action='store_true', help='Flag: when set, it plots the outputs')
+    args = parser.parse_args()
+    events = []
+    for s in args.stimulus:
+        for i in range( 1, len( s ), 2 ):
+            events.append( [ s[0], float( s[i] ), float( s[i+1] ) ] )
+    events.sort( key = lambda e: e[2] )
+    model = SbmlModel( args.model )
+    ret = model.run( events, args.monitor, args.dt, endt = args.runtime, method = args.method )
+    if args.plot:
+        import matplotlib.pyplot as plt
+        for name, vec in ret.items():
+            plt.plot( np.arange( len( vec ) ) * args.dt, vec * 1000, label = name )
+        plt.xlabel( "Time (s)" )
+        plt.ylabel( "Conc (uM)" )
+        plt.legend()
+        plt.show()
+    else:
+        for name, vec in ret.items():
+            print( name, vec )
+
+if __name__ == '__main__':
+    main()